@@ -0,0 +1,4 @@
+"""Benchmarks of the API on synthetic data.
+
+Run with ``python -m benchmarks.run`` (see ``--help``), or ``make bench``.
+"""
@@ -0,0 +1,117 @@
+import random
+from datetime import datetime, timedelta
+
+from typing import List, Iterator
+
+from timefliptt.app import db
+from timefliptt.blueprints.base_models import TimeFlipDevice, Category, Task, HistoryElement, HistoryRollup
+
+COLORS = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f']
+
+
+class HistoryGenerator:
+    """Deterministic generator of a catalog (devices, categories and tasks) and of the history of the devices.
+
+    Each device gets a contiguous history of `num_elements / num_devices` elements spread over `years`,
+    with small gaps (disconnections) between some elements and a few elements without task (pause).
+    """
+
+    BATCH_SIZE = 10000
+    END = datetime(2021, 1, 1)
+
+    def __init__(
+            self,
+            num_elements: int,
+            num_devices: int = 4,
+            num_categories: int = 8,
+            num_tasks: int = 40,
+            years: float = 2,
+            seed: int = 42
+    ):
+        self.num_elements = num_elements
+        self.num_devices = num_devices
+        self.num_categories = num_categories
+        self.num_tasks = num_tasks
+        self.years = years
+        self.seed = seed
+
+        self.start = self.END - timedelta(days=365 * years)
+
+    def create_catalog(self) -> List[int]:
+        """Create the catalog, and return the ids of the devices
+        """
+
+        rand = random.Random(self.seed)
+
+        devices = []
+        for i in range(self.num_devices):
+            device = TimeFlipDevice.create(':'.join(['{:02X}'.format(i)] * 6), '000000', 'device{}'.format(i))
+            db.session.add(device)
+            devices.append(device)
+
+        categories = []
+        for i in range(self.num_categories):
+            category = Category.create('category{}'.format(i))
+            db.session.add(category)
+            categories.append(category)
+
+        db.session.flush()
+
+        for i in range(self.num_tasks):
+            db.session.add(Task.create('task{}'.format(i), rand.choice(categories), rand.choice(COLORS)))
+
+        db.session.commit()
+
+        return [device.id for device in devices]
+
+    def elements(self, device_ids: List[int], task_ids: List[int]) -> Iterator[dict]:
+        """Yield the rows of the history, device after device
+        """
+
+        rand = random.Random(self.seed)
+        mean_length = (self.END - self.start).total_seconds() / max(1, self.num_elements // len(device_ids))
+
+        for i, device_id in enumerate(device_ids):
+            num_elements = self.num_elements // len(device_ids) + (i < self.num_elements % len(device_ids))
+            start = self.start
+
+            for _ in range(num_elements):
+                length = timedelta(seconds=rand.uniform(.1, 1.9) * mean_length * .9)
+                end = start + length
+                facet = rand.randrange(0, 63)
+
+                yield dict(
+                    start=start,
+                    end=end,
+                    original_facet=facet,
+                    comment='comment {}'.format(facet) if rand.random() < .1 else None,
+                    timeflip_device_id=device_id,
+                    task_id=rand.choice(task_ids) if rand.random() < .95 else None
+                )
+
+                start = end
+                if rand.random() < .5:  # disconnected for a while
+                    start += timedelta(seconds=rand.uniform(0, .2) * mean_length)
+
+    def generate(self):
+        """Fill the (empty) database
+        """
+
+        device_ids = self.create_catalog()
+        task_ids = [task_id for task_id, in db.session.query(Task.id)]
+
+        connection = db.session.connection()
+        batch = []
+
+        for row in self.elements(device_ids, task_ids):
+            batch.append(row)
+            if len(batch) >= self.BATCH_SIZE:
+                connection.execute(HistoryElement.__table__.insert(), batch)
+                batch = []
+
+        if len(batch) > 0:
+            connection.execute(HistoryElement.__table__.insert(), batch)
+
+        # Core inserts do not go through the ORM events
+        HistoryRollup.rebuild(connection)
+        db.session.commit()
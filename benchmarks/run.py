@@ -0,0 +1,231 @@
+"""Time the history and statistics endpoints on synthetic histories of increasing size.
+
+Results are written as JSON, so that runs can be compared.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from typing import List, Tuple, Dict, Any
+
+import flask
+from flask.testing import FlaskClient
+
+import timefliptt
+from timefliptt.app import create_app, db
+from timefliptt.config import Config
+from timefliptt.blueprints.api.cache import dump_cache
+from timefliptt.blueprints.api.views.views_history import Cursor
+from timefliptt.blueprints.base_models import HistoryElement, Category, DataVersion
+
+from benchmarks.generator import HistoryGenerator
+
+Case = Tuple[str, str, Dict[str, Any], List[Tuple[str, Any]]]
+
+
+def get_cases(generator: HistoryGenerator) -> List[Case]:
+    """Get the benchmarked requests, as (name, endpoint, view arguments, query arguments)
+    """
+
+    end = generator.END
+    last_year = end - timedelta(days=365)
+    last_month = end - timedelta(days=30)
+    unaligned_month = (last_month + timedelta(minutes=7), end - timedelta(minutes=13))
+    category = Category.query.first().id
+    num_pages = int(math.ceil(HistoryElement.query.count() / 25))
+
+    def frame(start: datetime, end: datetime) -> List[Tuple[str, str]]:
+        return [('start', start.isoformat()), ('end', end.isoformat())]
+
+    cases = [
+        ('history-first-page', 'api.history-els', {}, []),
+        ('history-last-page', 'api.history-els', {}, [('page', num_pages - 1)]),
+        ('history-last-page-cursor', 'api.history-els', {}, [('after', Cursor.encode(26)), ('count', 'false')]),
+        ('history-category', 'api.history-els', {}, [('category', category)]),
+        ('history-old-day', 'api.history-els', {}, frame(last_year, last_year + timedelta(days=1))),
+        ('history-search', 'api.history-els', {}, [('q', 'comment 12')]),
+        ('cumulative-tasks-search', 'api.statistics-cumulative-tasks', {}, [('q', 'comment 12')]),
+        ('export-csv-month', 'api.history-export', {}, frame(last_year, last_year + timedelta(days=30))),
+        ('export-csv-all', 'api.history-export', {}, []),
+        ('export-ndjson-all', 'api.history-export', {}, [('format', 'ndjson')]),
+    ]
+
+    for objects in ('tasks', 'categories', 'timeflips'):
+        cases.extend([
+            ('cumulative-{}-all'.format(objects), 'api.statistics-cumulative-{}'.format(objects), {}, []),
+            ('cumulative-{}-month'.format(objects), 'api.statistics-cumulative-{}'.format(objects), {},
+             frame(*unaligned_month)),
+            ('periodic-{}-weekly'.format(objects), 'api.statistics-periodic-{}'.format(objects),
+             {'period': 7 * 86400}, frame(last_year, end)),
+            ('periodic-{}-hourly'.format(objects), 'api.statistics-periodic-{}'.format(objects),
+             {'period': 3600}, frame(end - timedelta(days=4), end)),
+            ('periodic-{}-stream-daily'.format(objects), 'api.statistics-periodic-{}-stream'.format(objects),
+             {'period': 86400}, frame(generator.start, end)),
+        ])
+
+    cases.extend([
+        ('pivot-category-timeflip', 'api.statistics-pivot', {}, [('dimension', 'category'), ('dimension', 'timeflip')]),
+        ('pivot-task-weekly', 'api.statistics-pivot', {},
+         [('dimension', 'task'), ('dimension', 'period'), ('period', 7 * 86400)] + frame(last_year, end)),
+    ])
+
+    return cases
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of (sorted) `values`
+    """
+
+    return values[max(0, int(math.ceil(p / 100 * len(values))) - 1)]
+
+
+def run_case(client: FlaskClient, url: str, repeat: int, warm: bool) -> Dict[str, Any]:
+
+    def request() -> Tuple[float, int]:
+        if not warm:
+            DataVersion.bump(db.session.connection())  # as a write would, so that the cached responses are dropped
+            db.session.commit()
+            dump_cache().invalidate()
+
+        start = time.perf_counter()
+        response = client.get(url, buffered=False)
+        size = sum(len(chunk) for chunk in response.iter_encoded())  # do not keep the (streamed) content
+        response.close()
+        elapsed = time.perf_counter() - start
+
+        if response.status_code != 200:
+            raise RuntimeError('{} returned {}'.format(url, response.status_code))
+
+        return elapsed, size
+
+    request()  # warm up
+
+    latencies = []
+    size = 0
+    for _ in range(repeat):
+        elapsed, size = request()
+        latencies.append(elapsed)
+
+    # memory is measured apart, since tracing slows things down
+    tracemalloc.start()
+    request()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+
+    return dict(
+        url=url,
+        repeat=repeat,
+        response_size=size,
+        throughput=len(latencies) / sum(latencies),
+        latency=dict(
+            min=latencies[0],
+            mean=sum(latencies) / len(latencies),
+            p50=percentile(latencies, 50),
+            p90=percentile(latencies, 90),
+            p99=percentile(latencies, 99),
+            max=latencies[-1],
+        ),
+        peak_memory=peak
+    )
+
+
+def run(num_elements: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """Generate (or reuse) a database with `num_elements` history elements and time all cases on it
+    """
+
+    db_file = os.path.join(
+        args.db_dir, 'bench-{}-{}-{}-{}.sqlite'.format(num_elements, args.devices, args.years, args.seed))
+    exists = os.path.exists(db_file)
+
+    config = Config()
+    config.DB_FILE = db_file
+    app = create_app(config)
+    app.config['SERVER_NAME'] = 'localhost.localdomain:5000'
+
+    generator = HistoryGenerator(num_elements, num_devices=args.devices, years=args.years, seed=args.seed)
+    generation_time = None
+
+    with app.app_context():
+        if not exists:
+            db.create_all()
+
+            start = time.perf_counter()
+            generator.generate()
+            generation_time = time.perf_counter() - start
+
+        client = app.test_client()
+        results = []
+
+        for name, endpoint, view_args, query in get_cases(generator):
+            if args.only and not any(pattern in name for pattern in args.only):
+                continue
+
+            url = flask.url_for(endpoint, **view_args) + '?' + '&'.join('{}={}'.format(k, v) for k, v in query)
+            print('{:>10} | {}'.format(num_elements, name), file=sys.stderr)
+
+            result = run_case(client, url, args.repeat, args.warm)
+            result['name'] = name
+            results.append(result)
+
+        db.session.remove()
+
+    if not args.keep:
+        os.remove(db_file)
+
+    return dict(
+        num_elements=num_elements,
+        db_size=os.path.getsize(db_file) if args.keep else None,
+        generation_time=generation_time,
+        cases=results
+    )
+
+
+def get_arguments_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument(
+        '-n', '--num-elements', type=int, nargs='+', default=[10000, 100000],
+        help='Sizes of the history (e.g., from 10000 to 10000000)')
+    parser.add_argument('-d', '--devices', type=int, default=4, help='Number of devices')
+    parser.add_argument('-y', '--years', type=float, default=2, help='Time span of the history, in years')
+    parser.add_argument('-s', '--seed', type=int, default=42, help='Seed of the generator')
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='Number of timed requests per case')
+    parser.add_argument('-w', '--warm', action='store_true', help='Let the response cache serve repeated requests')
+    parser.add_argument('-O', '--only', nargs='*', help='Only run the cases whose name contains one of these')
+    parser.add_argument('--db-dir', default=tempfile.gettempdir(), help='Where to store the databases')
+    parser.add_argument('--keep', action='store_true', help='Keep the databases (which are reused by later runs)')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout, help='Output (JSON)')
+
+    return parser
+
+
+def main():
+    args = get_arguments_parser().parse_args()
+
+    report = dict(
+        date=datetime.now().isoformat(),
+        version=timefliptt.__version__,
+        python=platform.python_version(),
+        sqlite=sqlite3.sqlite_version,
+        platform=platform.platform(),
+        parameters=dict(devices=args.devices, years=args.years, seed=args.seed, repeat=args.repeat, warm=args.warm),
+        runs=[run(num_elements, args) for num_elements in args.num_elements]
+    )
+
+    json.dump(report, args.output, indent=2)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,7 @@ class FlaskTestCase(TestCase):
 
         config = Config()
         config.DB_FILE = self.db_file
+        config.COUNT_QUERIES = True
 
         self.app = create_app(config)
         self.app.config['SERVER_NAME'] = '127.0.0.1:5000'
@@ -1,3 +1,6 @@
+import csv
+import io
+import json
 import random
 import math
 from datetime import datetime, timedelta, date
@@ -6,10 +9,16 @@ from tests import FlaskTestCase
 from typing import List
 
 import flask
+import flask_sqlalchemy
 from flask.views import MethodView
 
-from timefliptt.blueprints.base_models import HistoryElement, TimeFlipDevice, Category, Task
-from timefliptt.blueprints.api.views.views_history import HistoryElementMixin
+from timefliptt.app import db
+
+from timefliptt.blueprints.base_models import HistoryElement, HistoryRollup, TimeFlipDevice, Category, Task
+from timefliptt.blueprints.api.views.views_history import (
+    HistoryElementMixin, HistoryElementsView, HistoryExportView, Cursor)
+from timefliptt.blueprints.history_compaction import HistoryCompactor
+from timefliptt.blueprints.history_import import HistoryImporter
 from timefliptt.blueprints.api.schemas import Parser, HistoryElementSchema
 
 
@@ -158,6 +167,36 @@ class HistoryElementMixinCase(FlaskTestCase):
         test(start=self.elements[self.num_elements - 10].start.date())
         test(end=self.elements[self.num_elements - 10].end.date())
 
+    def test_filter_time_window_ok(self):
+        """Bounded time frames go through the R*Tree, which should give the very same elements
+        """
+
+        def test(start: datetime, end: datetime):
+            elements, _ = HistoryElementMixin.query_elements(start=start, end=end)
+            actual_elements = list(filter(lambda e: e.start < end and e.end > start, self.elements))
+
+            self.assertEqual(sorted(e.id for e in elements), sorted(e.id for e in actual_elements))
+
+        second = timedelta(seconds=1)
+
+        for element in self.elements[::4]:
+            test(element.start, element.end)
+            test(element.start + second, element.end - second)
+            test(element.end, element.end + second)  # touching
+            test(element.end - timedelta(microseconds=1), element.end + second)
+            test(element.start - second, element.start)  # touching
+
+        # the R*Tree follows the modifications
+        element = self.elements[0]
+        element.start, element.end = self.elements[-1].end, self.elements[-1].end + timedelta(hours=1)
+        self.db_session.add(element)
+        self.db_session.delete(self.elements[1])
+        self.db_session.commit()
+
+        self.elements = self.elements[2:] + [element]
+        test(element.start, element.end)
+        test(element.start - timedelta(days=30), element.end)
+
     def test_filter_start_end_ok(self):
 
         def test(start: datetime = datetime.min, end: datetime = datetime.max):
@@ -192,6 +231,15 @@ class HistoryElementMixinCase(FlaskTestCase):
         test(start=self.elements[self.num_elements - 10].start)
         test(end=self.elements[self.num_elements - 10].end)
 
+        # aware datetimes are taken in UTC
+        start = self.elements[self.num_elements - 10].start
+        response = self.client.get(
+            flask.url_for('test'), query_string={'start': (start + timedelta(hours=2)).isoformat() + '+02:00'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(e['id'] for e in response.get_json()['elements']),
+            sorted(e.id for e in self.elements if e.end > start))
+
     def test_filter_tasks_ok(self):
         def test(tasks: List[int] = None):
             actual_elements = self.elements
@@ -301,6 +349,56 @@ class HistoryElementMixinCase(FlaskTestCase):
         # test none
         test([self.device.id + 5])
 
+    def test_filter_comments_ok(self):
+        comments = ['Meeting with Bob', 'code review (meeting)', 'Réunion', 'say "hi"']
+        for element, comment in zip(self.elements, comments):
+            element.comment = comment
+            self.db_session.add(element)
+
+        self.db_session.commit()
+
+        def test(q: str, expected: List[HistoryElement]):
+            response = self.client.get(flask.url_for('test') + '?q={}'.format(q))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                sorted(e['id'] for e in response.get_json()['elements']), sorted(e.id for e in expected))
+
+        test('meeting', self.elements[:2])
+        test('MEET', self.elements[:2])  # prefix, case insensitive
+        test('bob meeting', self.elements[:1])  # all words
+        test('reunion', self.elements[2:3])  # without diacritics
+        test('"hi', self.elements[3:4])  # not a FTS query
+        test('NOT', [])
+        test('whatever', [])
+
+        # with other filters
+        response = self.client.get(flask.url_for('test') + '?q=meeting&task={}'.format(self.elements[1].task_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.elements[1].id, [e['id'] for e in response.get_json()['elements']])
+
+        # the index follows the modifications
+        self.elements[0].comment = 'nothing'
+        self.db_session.add(self.elements[0])
+        self.db_session.delete(self.elements[1])
+        self.db_session.commit()
+
+        test('meeting', [])
+        test('nothing', self.elements[:1])
+
+        response = self.client.patch(flask.url_for('api.history-els') + '?id={}'.format(self.elements[2].id), json={
+            'comment': 'another meeting'
+        })
+        self.assertEqual(response.status_code, 200)
+        test('meeting', self.elements[2:3])
+
+        # empty search
+        for q in ('', ' ', '%20%09'):
+            response = self.client.get(flask.url_for('test') + '?q={}'.format(q))
+            self.assertEqual(response.status_code, 422)
+
+        response = self.client.get(flask.url_for('api.history-els') + '?q=%20')
+        self.assertEqual(response.status_code, 422)
+
     def test_negative_task_ko(self):
         response = self.client.get(flask.url_for('test') + '?task=-1')
         self.assertEqual(response.status_code, 422)
@@ -313,6 +411,44 @@ class HistoryElementMixinCase(FlaskTestCase):
         response = self.client.get(flask.url_for('test') + '?timeflip=-1')
         self.assertEqual(response.status_code, 422)
 
+    def test_filters_use_indexes_ok(self):
+        def explain(query: flask_sqlalchemy.BaseQuery) -> List[str]:
+            def _explain(conn, cursor, statement, parameters, context, executemany):
+                return 'EXPLAIN QUERY PLAN ' + statement, parameters
+
+            connection = self.db_session.connection()
+            db.event.listen(connection, 'before_cursor_execute', _explain, retval=True)
+
+            try:
+                return [row[3] for row in connection.execute(query.statement)]
+            finally:
+                db.event.remove(connection, 'before_cursor_execute', _explain)
+
+        task, category, device = self.tasks[0].id, self.categories[0].id, self.device.id
+
+        for filters in [
+            {},
+            {'task': [task]},
+            {'timeflip': [device]},
+            {'category': [category]},
+            {'task': [task], 'timeflip': [device]},
+            {'category': [category], 'timeflip': [device]},
+            {'task': [task], 'category': [category]},
+        ]:
+            query, _ = HistoryElementMixin.query_elements(
+                start=self.elements[5].start, end=self.elements[10].end, **filters)
+
+            plan = explain(query)
+            self.assertTrue(plan[0].startswith('SEARCH history_element USING'), (filters, plan))
+
+            # the time frame is looked up in the R*Tree (with constraints on both coordinates)
+            self.assertTrue(any(
+                line.startswith('SCAN history_element_rtree VIRTUAL TABLE INDEX 2:') for line in plan), plan)
+
+            # the tasks of the categories are found through an index as well
+            if 'category' in filters:
+                self.assertTrue(any('USING COVERING INDEX ix_task_category_id' in line for line in plan), plan)
+
 
 class HistoryTestCase(FlaskTestCase):
     def setUp(self):
@@ -391,6 +527,98 @@ class HistoryTestCase(FlaskTestCase):
         self.assertEqual(len(elmts(self.num_elements + 1, 1, expected_status=404)), 0)
         self.assertEqual(len(elmts(-2, 1, expected_status=422)), 0)
 
+        # test bounds of page size
+        self.assertEqual(len(elmts(0, 0, expected_status=422)), 0)
+        self.assertEqual(len(elmts(0, 1001, expected_status=422)), 0)
+
+    def test_get_history_elements_cursor_ok(self):
+        def get(url: str, expected_status: int = 200) -> dict:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, expected_status)
+            return response.get_json()
+
+        page_size = 3
+
+        # follow the next pages from the first one (without counting)
+        data = get(flask.url_for('api.history-els') + '?page_size={}&count=false'.format(page_size))
+        self.assertIsNone(data['total_elements'])
+        self.assertIsNone(data['previous_page'])
+
+        ids = [e['id'] for e in data['history']]
+        pages = [data]
+        while data['next_page'] is not None:
+            self.assertIn('after=', data['next_page'])
+            data = get(data['next_page'])
+            self.assertIsNone(data['total_elements'])
+            self.assertLessEqual(len(data['history']), page_size)
+            ids.extend(e['id'] for e in data['history'])
+            pages.append(data)
+
+        self.assertEqual(ids, list(range(self.num_elements, 0, -1)))
+        self.assertEqual(len(pages), int(math.ceil(self.num_elements / page_size)))
+
+        # ... and then back
+        for page in reversed(pages[:-1]):
+            self.assertIn('before=', data['previous_page'])
+            data = get(data['previous_page'])
+            self.assertEqual(data['history'], page['history'])
+
+        self.assertIsNone(data['previous_page'])
+
+        # filters are kept
+        data = get(flask.url_for('api.history-els') + '?page_size=1&task={}'.format(self.task.id))
+        self.assertEqual(data['total_elements'], self.num_elements)
+        self.assertIn('task={}'.format(self.task.id), data['next_page'])
+
+        data = get(flask.url_for('api.history-els') + '?page_size=1&task={}'.format(self.other_task.id))
+        self.assertEqual(data['total_elements'], 0)
+        self.assertEqual(data['history'], [])
+        self.assertIsNone(data['next_page'])
+
+        # wrong cursors
+        get(flask.url_for('api.history-els') + '?after=whatever', expected_status=422)
+        get(flask.url_for('api.history-els') + '?page=0&after={}'.format(Cursor.encode(1)), expected_status=422)
+
+    def test_get_history_elements_follow_catalog_ok(self):
+        def elmts() -> List[dict]:
+            response = self.client.get(flask.url_for('api.history-els') + '?page_size={}'.format(self.num_elements))
+            self.assertEqual(response.status_code, 200)
+            return response.get_json()['history']
+
+        data = elmts()
+        self.assertEqual(data, HistoryElementSchema(many=True).dump(
+            HistoryElement.query.order_by(HistoryElement.id.desc()).all()))
+
+        # modify the task through the API ...
+        response = self.client.patch(flask.url_for('api.task', id=self.task.id), json={'name': 'new name'})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertTrue(all(e['task']['name'] == 'new name' for e in elmts()))
+
+        # ... or directly
+        self.task.color = '#ffffff'
+        self.db_session.add(self.task)
+        self.db_session.commit()
+
+        self.assertTrue(all(e['task']['color'] == '#ffffff' for e in elmts()))
+
+    def test_get_history_elements_query_count_ok(self):
+        def num_queries() -> int:
+            response = self.client.get(flask.url_for('api.history-els') + '?page_size={}'.format(self.num_elements))
+            self.assertEqual(response.status_code, 200)
+            return int(response.headers['X-Query-Count'])
+
+        n = num_queries()
+
+        # one different task per element does not result in more queries
+        for i, element in enumerate(self.elements):
+            element.task = Task.create('t{}'.format(i), self.category, '#000000')
+            self.db_session.add(element)
+
+        self.db_session.commit()
+
+        self.assertEqual(num_queries(), n)
+
     def test_get_history_element_ok(self):
         self.assertEqual(self.num_elements, HistoryElement.query.count())
         element = self.elements[0]
@@ -443,6 +671,23 @@ class HistoryTestCase(FlaskTestCase):
         self.assertEqual(start, e.start)
         self.assertEqual(end, e.end)
 
+    def test_modify_history_element_aware_dates_ok(self):
+        self.assertEqual(self.num_elements, HistoryElement.query.count())
+        element = self.elements[0]
+
+        start = datetime(2021, 1, 1, 0, 30)
+        end = start + timedelta(seconds=10)
+
+        response = self.client.patch(flask.url_for('api.history-el', id=element.id), json={
+            'start': start.isoformat() + '+01:00',  # 23:30 UTC
+            'end': end.isoformat() + '+01:00'
+        })
+        self.assertEqual(response.status_code, 200)
+
+        e = HistoryElement.query.get(element.id)
+        self.assertEqual(start - timedelta(hours=1), e.start)
+        self.assertEqual(end - timedelta(hours=1), e.end)
+
     def test_modify_history_element_negative_task_ok(self):
         self.assertEqual(self.num_elements, HistoryElement.query.count())
         element = self.elements[0]
@@ -498,6 +743,7 @@ class HistoryTestCase(FlaskTestCase):
         response = self.client.delete(
             flask.url_for('api.history-els') + '?' + '&'.join('id={}'.format(e.id) for e in elements))
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['count'], len(elements))
 
         self.assertEqual(self.num_elements - len(elements), HistoryElement.query.count())
         for e in elements:
@@ -525,10 +771,7 @@ class HistoryTestCase(FlaskTestCase):
             })
         self.assertEqual(response.status_code, 200)
 
-        data = response.get_json()
-        for element in data:
-            self.assertEqual(comment, element['comment'])
-            self.assertEqual(task.id, element['task']['id'])
+        self.assertEqual(response.get_json()['count'], len(elements))
 
         for element in elements:
             e = HistoryElement.query.get(element.id)
@@ -545,9 +788,7 @@ class HistoryTestCase(FlaskTestCase):
             })
         self.assertEqual(response.status_code, 200)
 
-        data = response.get_json()
-        for element in data:
-            self.assertIsNone(element['task'])
+        self.assertEqual(response.get_json()['count'], len(elements))
 
         for element in elements:
             e = HistoryElement.query.get(element.id)
@@ -569,6 +810,461 @@ class HistoryTestCase(FlaskTestCase):
             })
         self.assertEqual(response.status_code, 404)
 
+    def test_modify_history_elements_filter_ok(self):
+        elements = self.elements[2:6]
+        for element in elements:
+            element.task_id = self.other_task.id
+            self.db_session.add(element)
+
+        self.db_session.commit()
+
+        # chunks of ids
+        HistoryElementsView.CHUNK_SIZE, chunk_size = 3, HistoryElementsView.CHUNK_SIZE
+
+        try:
+            response = self.client.patch(
+                flask.url_for('api.history-els') + '?task={}'.format(self.other_task.id), json={'task': self.task.id})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['count'], len(elements))
+        finally:
+            HistoryElementsView.CHUNK_SIZE = chunk_size
+
+        self.assertEqual(
+            HistoryElement.query.filter(HistoryElement.task_id.is_(self.task.id)).count(), self.num_elements)
+
+        # filters and ids are combined
+        response = self.client.patch(
+            flask.url_for('api.history-els') + '?id={}&id={}&start={}'.format(
+                self.elements[0].id, self.elements[-1].id, self.elements[-1].start.isoformat()),
+            json={'comment': 'whatever'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['count'], 1)
+
+        self.assertEqual(HistoryElement.query.get(self.elements[-1].id).comment, 'whatever')
+        self.assertNotEqual(HistoryElement.query.get(self.elements[0].id).comment, 'whatever')
+
+        # rollups are up to date
+        rollups = self.db_session.query(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration).order_by(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id).all()
+
+        HistoryRollup.rebuild(self.db_session.connection())
+        self.assertEqual(rollups, self.db_session.query(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration).order_by(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id).all())
+
+    def test_delete_history_elements_filter_ok(self):
+        elements = self.elements[2:6]
+        for element in elements:
+            element.task_id = self.other_task.id
+            self.db_session.add(element)
+
+        self.db_session.commit()
+
+        response = self.client.delete(flask.url_for('api.history-els') + '?task={}'.format(self.other_task.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['count'], len(elements))
+
+        self.assertEqual(HistoryElement.query.count(), self.num_elements - len(elements))
+        self.assertEqual(HistoryElement.query.filter(HistoryElement.task_id.is_(self.other_task.id)).count(), 0)
+        self.assertEqual(
+            HistoryRollup.query.filter(HistoryRollup.task_id.is_(self.other_task.id)).count(), 0)
+
+        # nothing left
+        response = self.client.delete(flask.url_for('api.history-els') + '?task={}'.format(self.other_task.id))
+        self.assertEqual(response.status_code, 404)
+
+    def test_modify_history_elements_no_selection_ko(self):
+        # an explicit selection is required
+        response = self.client.patch(flask.url_for('api.history-els'), json={'comment': 'whatever'})
+        self.assertEqual(response.status_code, 422)
+
+        response = self.client.delete(flask.url_for('api.history-els'))
+        self.assertEqual(response.status_code, 422)
+
+        self.assertEqual(HistoryElement.query.count(), self.num_elements)
+
+    def test_export_history_csv_ok(self):
+        self.elements[0].comment = 'with, "quotes"\nand newline'
+        self.elements[1].task_id = None
+        self.db_session.add_all(self.elements[:2])
+        self.db_session.commit()
+
+        # small chunks
+        HistoryExportView.CHUNK_SIZE, chunk_size = 3, HistoryExportView.CHUNK_SIZE
+
+        try:
+            response = self.client.get(flask.url_for('api.history-export'))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.mimetype, 'text/csv')
+
+            rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        finally:
+            HistoryExportView.CHUNK_SIZE = chunk_size
+
+        self.assertEqual(len(rows), self.num_elements)
+
+        for row, element in zip(rows, sorted(self.elements, key=lambda e: e.start)):
+            self.assertEqual(int(row['id']), element.id)
+            self.assertEqual(row['start'], element.start.isoformat())
+            self.assertEqual(row['end'], element.end.isoformat())
+            self.assertEqual(row['comment'], element.comment or '')
+            self.assertEqual(int(row['timeflip_device']), element.timeflip_device_id)
+
+            if element.task_id is not None:
+                self.assertEqual(int(row['task']), element.task_id)
+                self.assertEqual(row['task_name'], self.task.name)
+                self.assertEqual(int(row['category']), self.category.id)
+                self.assertEqual(row['category_name'], self.category.name)
+            else:
+                self.assertEqual(row['task'], '')
+                self.assertEqual(row['category'], '')
+
+    def test_export_history_ndjson_ok(self):
+        elements = self.elements[3:6]
+
+        response = self.client.get(flask.url_for('api.history-export') + '?format=ndjson&start={}&end={}'.format(
+            elements[0].start.isoformat(), elements[-1].end.isoformat()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        rows = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [element.id for element in elements])
+        self.assertEqual(rows[0]['task_name'], self.task.name)
+
+        # filters
+        response = self.client.get(flask.url_for('api.history-export') + '?format=ndjson&task={}'.format(
+            self.other_task.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True), '')
+
+    def test_export_history_wrong_format_ko(self):
+        response = self.client.get(flask.url_for('api.history-export') + '?format=xml')
+        self.assertEqual(response.status_code, 422)
+
+    def test_import_history_csv_ok(self):
+        exported = self.client.get(flask.url_for('api.history-export')).get_data(as_text=True)
+
+        # importing the export again changes nothing
+        response = self.client.post(
+            flask.url_for('api.history-import'), data=exported, content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'imported': 0, 'skipped': self.num_elements})
+        self.assertEqual(HistoryElement.query.count(), self.num_elements)
+
+        # into an empty history
+        rollups = self.db_session.query(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration).order_by(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id).all()
+
+        self.elements[1].task_id = None
+        self.db_session.add(self.elements[1])
+        self.db_session.commit()
+
+        exported = self.client.get(flask.url_for('api.history-export')).get_data(as_text=True)
+
+        # (ids are not reused, so the deleted elements cannot be reloaded afterwards)
+        originals = [
+            (e.start, e.end, e.original_facet, e.timeflip_device_id, e.task_id)
+            for e in sorted(self.elements, key=lambda e: e.start)
+        ]
+
+        response = self.client.delete(flask.url_for('api.history-els') + '?start=1970-01-01T00:00:00')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(HistoryElement.query.count(), 0)
+
+        response = self.client.post(
+            flask.url_for('api.history-import'), data=exported, content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'imported': self.num_elements, 'skipped': 0})
+
+        imported = HistoryElement.query.order_by(HistoryElement.start).all()
+        self.assertEqual(len(imported), self.num_elements)
+
+        self.assertEqual(
+            [(e.start, e.end, e.original_facet, e.timeflip_device_id, e.task_id) for e in imported], originals)
+
+        # rollups are up to date
+        self.assertNotEqual(rollups, self.db_session.query(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration).order_by(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id).all())
+
+        rollups = self.db_session.query(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration).order_by(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id).all()
+
+        HistoryRollup.rebuild(self.db_session.connection())
+        self.assertEqual(rollups, self.db_session.query(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration).order_by(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id).all())
+
+    def test_import_history_ndjson_ok(self):
+        start = datetime(2020, 1, 1, 10)
+        rows = [
+            # by address and task name
+            dict(start=start, end=start + timedelta(minutes=1), original_facet=1, timeflip_device=self.device.address,
+                 task_name=self.other_task.name, category_name=self.category.name, comment='a'),
+            # by id
+            dict(start=start + timedelta(minutes=1), end=start + timedelta(minutes=2), original_facet=2,
+                 timeflip_device=self.device.id, task=self.task.id),
+            # repeated
+            dict(start=start + timedelta(minutes=1), end=start + timedelta(minutes=2), original_facet=2,
+                 timeflip_device=self.device.id, task=self.task.id),
+        ]
+
+        # small batches
+        HistoryImporter.BATCH_SIZE, batch_size = 2, HistoryImporter.BATCH_SIZE
+
+        try:
+            response = self.client.post(
+                flask.url_for('api.history-import') + '?format=ndjson',
+                data='\n'.join(json.dumps(row, default=datetime.isoformat) for row in rows) + '\n\n')
+        finally:
+            HistoryImporter.BATCH_SIZE = batch_size
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'imported': 2, 'skipped': 1})
+
+        elements = HistoryElement.query.filter(HistoryElement.start >= start).filter(
+            HistoryElement.end <= start + timedelta(minutes=2)).order_by(HistoryElement.start).all()
+        self.assertEqual([e.task_id for e in elements], [self.other_task.id, self.task.id])
+        self.assertEqual(elements[0].comment, 'a')
+
+    def test_import_history_task_name_ok(self):
+        start = datetime(2020, 1, 1, 10)
+        row = dict(
+            start=start, end=start + timedelta(minutes=1), original_facet=1, timeflip_device=self.device.id,
+            task_name=self.task.name)
+
+        def post(row: dict):
+            return self.client.post(
+                flask.url_for('api.history-import'), data=json.dumps(row, default=datetime.isoformat),
+                content_type='application/x-ndjson')
+
+        # the name is enough, if it is not ambiguous
+        response = post(row)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(HistoryElement.query.filter(HistoryElement.start == start).one().task_id, self.task.id)
+
+        # ... including for a task without category
+        task = Task.create('no category', self.category, '#000000')
+        task.category_id = None
+        self.db_session.add(task)
+        self.db_session.commit()
+
+        response = post(dict(row, start=start - timedelta(minutes=1), end=start, task_name=task.name))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(HistoryElement.query.filter(HistoryElement.end == start).one().task_id, task.id)
+
+        # ... otherwise, the category is needed
+        other_category = Category.create('other')
+        self.db_session.add(other_category)
+        self.db_session.commit()
+
+        self.db_session.add(Task.create(self.task.name, other_category, '#000000'))
+        self.db_session.commit()
+
+        response = post(dict(row, start=start + timedelta(minutes=1), end=start + timedelta(minutes=2)))
+        self.assertEqual(response.status_code, 422)
+
+        response = post(dict(
+            row, start=start + timedelta(minutes=1), end=start + timedelta(minutes=2),
+            category_name=self.category.name))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'imported': 1, 'skipped': 0})
+
+    def test_import_history_aware_dates_ok(self):
+        rows = [
+            dict(start='2021-02-01T00:00:00+00:00', end='2021-02-01T00:10:00+00:00', original_facet=1),
+            dict(start='2021-02-01T01:10:00+01:00', end='2021-02-01T02:00:00+01:00', original_facet=2),  # 00:10 UTC
+        ]
+
+        def post() -> flask.Response:
+            return self.client.post(
+                flask.url_for('api.history-import'),
+                data='\n'.join(
+                    json.dumps(dict(row, timeflip_device=self.device.id, task=self.task.id)) for row in rows),
+                content_type='application/x-ndjson')
+
+        response = post()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['imported'], 2)
+
+        # the same elements, then
+        response = post()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'imported': 0, 'skipped': 2})
+
+        self.assertEqual(self.db_session.query(db.func.sum(HistoryRollup.duration)).filter(
+            HistoryRollup.resolution == 86400, HistoryRollup.bucket == datetime(2021, 2, 1)).scalar(), 3600 * 1000000)
+
+        imported = HistoryElement.query\
+            .filter(HistoryElement.start.between(datetime(2021, 2, 1), datetime(2021, 2, 2)))\
+            .order_by(HistoryElement.start).all()
+
+        self.assertEqual([(e.start, e.end) for e in imported], [
+            (datetime(2021, 2, 1), datetime(2021, 2, 1, 0, 10)),
+            (datetime(2021, 2, 1, 0, 10), datetime(2021, 2, 1, 1))
+        ])
+
+    def test_import_history_invalid_ko(self):
+        start = datetime(2020, 1, 1, 10)
+        valid = dict(
+            start=start, end=start + timedelta(minutes=1), original_facet=1, timeflip_device=self.device.id)
+
+        for invalid in [
+            dict(valid, start='whatever'),
+            dict(valid, end=start - timedelta(minutes=1)),
+            dict(valid, timeflip_device='unknown'),
+            dict(valid, task=-1),
+            dict(valid, task_name='unknown'),
+            {'original_facet': 2},
+        ]:
+            response = self.client.post(
+                flask.url_for('api.history-import'),
+                data='\n'.join(json.dumps(row, default=datetime.isoformat) for row in [valid, invalid]),
+                content_type='application/x-ndjson')
+
+            self.assertEqual(response.status_code, 422)
+            self.assertIn('2', response.json['errors'])
+            self.assertNotIn('1', response.json['errors'])
+
+            # nothing was imported
+            self.assertEqual(HistoryElement.query.count(), self.num_elements)
+
+        # unknown format
+        response = self.client.post(flask.url_for('api.history-import'), data='x', content_type='application/xml')
+        self.assertEqual(response.status_code, 400)
+
+    def test_compact_history_ok(self):
+        other_device = TimeFlipDevice.create('00:00:00:00:00:01', '000000')
+        self.db_session.add(other_device)
+        self.db_session.commit()
+
+        start = datetime(2020, 1, 1, 10)
+        minute = timedelta(minutes=1)
+
+        # (facet, task, gap before, comment)
+        history = [
+            (1, self.task, 0, 'a'),
+            (1, self.task, 0, None),
+            (1, self.task, 0, 'b'),  # <- 3 elements in the first run
+            (1, self.task, 1, 'a'),  # gap
+            (1, self.task, 0, 'a'),  # <- 2 elements in the second run
+            (2, self.task, 0, None),  # other facet
+            (2, self.other_task, 0, None),  # other task
+            (2, None, 0, None),
+            (2, None, 0, None),  # <- 2 elements in the third run
+        ]
+
+        elements = []
+        for facet, task, gap, comment in history:
+            start += gap * minute
+            for device in (self.device, other_device):
+                element = HistoryElement.create(start, start + minute, facet, device, task, comment)
+                self.db_session.add(element)
+                elements.append(element)
+            start += minute
+
+        self.db_session.commit()
+        elements = [(e.id, e.start, e.end) for e in elements]
+
+        rollups = self.db_session.query(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration).order_by(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id).all()
+
+        # small pages
+        HistoryCompactor.BATCH_SIZE, batch_size = 2, HistoryCompactor.BATCH_SIZE
+
+        try:
+            response = self.client.post(flask.url_for('api.history-compact') + '?timeflip={}'.format(other_device.id))
+        finally:
+            HistoryCompactor.BATCH_SIZE = batch_size
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['merged'], 3)
+        self.assertEqual(response.json['removed'], 4)
+
+        compacted = HistoryElement.query.filter(HistoryElement.timeflip_device_id == other_device.id).order_by(
+            HistoryElement.start).all()
+        self.assertEqual(len(compacted), len(history) - 4)
+        self.assertEqual(
+            [(e.start, e.end, e.comment) for e in compacted[:2]],
+            [(elements[1][1], elements[5][2], 'a\nb'), (elements[7][1], elements[9][2], 'a')])
+        self.assertEqual(compacted[-1].start, elements[-3][1])
+        self.assertEqual(compacted[-1].end, elements[-1][2])
+
+        # the other device is untouched
+        self.assertEqual(
+            HistoryElement.query.filter(HistoryElement.timeflip_device_id == self.device.id).count(),
+            self.num_elements + len(history))
+
+        # durations, hence rollups, are the same
+        self.assertEqual(rollups, self.db_session.query(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration).order_by(
+            HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id).all())
+
+        # indexes follow
+        self.assertEqual(
+            set(self.db_session.execute(HistoryElement.matching_ids('b')).scalars()), {elements[4][0], compacted[0].id})
+
+        window, _ = HistoryElementMixin.query_elements(
+            start=elements[5][2] - timedelta(seconds=1), end=elements[5][2], timeflip=[other_device.id])
+        self.assertEqual([e.id for e in window], [compacted[0].id])
+
+        # nothing to do, the second time
+        response = self.client.post(flask.url_for('api.history-compact'))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response.json['removed'], 4)  # (... but the first device, and maybe its other elements)
+
+        response = self.client.post(flask.url_for('api.history-compact'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['removed'], 0)
+
+    def test_compact_history_rollups_ok(self):
+        other_device = TimeFlipDevice.create('00:00:00:00:00:01', '000000')
+        self.db_session.add(other_device)
+        self.db_session.commit()
+
+        # two parts of less than a second, which account for 0 second each, but 1 second once merged
+        start = datetime(2020, 1, 1, 10, 0, 0, 500000)
+        middle = datetime(2020, 1, 1, 10, 0, 1, 200000)
+        end = datetime(2020, 1, 1, 10, 0, 2)
+
+        for element_start, element_end in ((start, middle), (middle, end)):
+            self.db_session.add(HistoryElement.create(element_start, element_end, 1, other_device, self.task))
+
+        self.db_session.commit()
+
+        def rollups() -> list:
+            return self.db_session.query(
+                HistoryRollup.resolution, HistoryRollup.bucket, HistoryRollup.task_id, HistoryRollup.duration
+            ).filter(HistoryRollup.timeflip_device_id == other_device.id).order_by(
+                HistoryRollup.resolution, HistoryRollup.bucket).all()
+
+        self.assertEqual(rollups(), [])
+
+        response = self.client.post(flask.url_for('api.history-compact') + '?timeflip={}'.format(other_device.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['removed'], 1)
+
+        compacted = rollups()
+        self.assertEqual(compacted, [
+            (3600, datetime(2020, 1, 1, 10), self.task.id, 1000000),
+            (86400, datetime(2020, 1, 1), self.task.id, 1000000)
+        ])
+
+        # same as from scratch
+        HistoryRollup.rebuild(self.db_session.connection())
+        self.db_session.commit()
+        self.assertEqual(rollups(), compacted)
+
+        response = self.client.get(flask.url_for('api.statistics-cumulative-timeflips') + '?start={}&end={}'.format(
+            datetime(2020, 1, 1).isoformat(), datetime(2020, 1, 2).isoformat()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['cumulative_time'], 1)
+
     def test_delete_task_does_not_delete_history_ok(self):
         self.assertEqual(self.num_elements, HistoryElement.query.count())
 
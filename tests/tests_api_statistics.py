@@ -1,5 +1,8 @@
 import random
 import math
+import json
+import threading
+import time
 from datetime import datetime, timedelta
 from tests import FlaskTestCase
 
@@ -7,7 +10,11 @@ from typing import List, Tuple, Any
 
 import flask
 
-from timefliptt.blueprints.base_models import HistoryElement, TimeFlipDevice, Category, Task
+from timefliptt.app import db, create_app
+from timefliptt.config import Config
+from timefliptt.blueprints.base_models import HistoryElement, HistoryRollup, TimeFlipDevice, Category, Task
+from timefliptt.blueprints.api.views.views_statistics import PeriodicBuckets, BasePeriodicView, PeriodicTaskView
+from timefliptt.blueprints.api.cache import ResponseCache
 
 
 class CumulativeTestCase(FlaskTestCase):
@@ -84,6 +91,107 @@ class CumulativeTestCase(FlaskTestCase):
 
         return data
 
+    def test_cumulative_tasks_time_frame_ok(self):
+        start = self.elements[3].start + timedelta(seconds=12, microseconds=345678)
+        end = self.elements[-3].end - timedelta(seconds=7, microseconds=654321)
+
+        data = self.cumulative_tasks_ok([('start', start.isoformat()), ('end', end.isoformat())])
+
+        # cumulative times match the ones computed element by element
+        expected_task_time = {}
+        for element in self.elements:
+            duration = element.duration(start, end)
+            if duration > 0:
+                expected_task_time[element.task_id] = expected_task_time.get(element.task_id, 0) + duration
+
+        self.assertEqual(expected_task_time, dict((t['id'], t['cumulative_time']) for t in data['tasks']))
+        self.assertEqual(sum(expected_task_time.values()), data['cumulative_time'])
+
+    def test_cumulative_etag_ok(self):
+        url = flask.url_for('api.statistics-cumulative-tasks')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        # same request, nothing changed in between
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # normalized arguments give the same response
+        response = self.client.get(url + '?task=2&task=1')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url + '?task=1&task=2', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # add an element
+        start = datetime.now()
+        element = HistoryElement.create(start, start + timedelta(minutes=1), 0, self.device, self.tasks[0])
+        self.db_session.add(element)
+        self.db_session.commit()
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(etag, response.headers['ETag'])
+        self.assertEqual(sum(self.cumulative_time_task) + 60, response.get_json()['cumulative_time'])
+
+    def test_cumulative_etag_other_process_ok(self):
+        url = flask.url_for('api.statistics-cumulative-tasks')
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+
+        # add an element from another app (e.g., the command line), which has its own caches
+        device_id, task_id = self.device.id, self.tasks[0].id
+
+        def add_element():
+            config = Config()
+            config.DB_FILE = self.db_file
+            other_app = create_app(config)
+
+            with other_app.app_context():
+                start = datetime.now()
+                db.session.add(HistoryElement.create(start, start + timedelta(minutes=1), 0, device_id, task_id))
+                db.session.commit()
+
+        thread = threading.Thread(target=add_element)
+        thread.start()
+        thread.join()
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(self.cumulative_time_task) + 60, response.get_json()['cumulative_time'])
+
+    def test_response_cache_coalesce_ok(self):
+        cache = ResponseCache()
+        calls = []
+        started = threading.Event()
+
+        def compute():
+            started.set()
+            calls.append(1)
+            time.sleep(.1)
+            return flask.Response(str(len(calls)))
+
+        def get():
+            results.append(cache.get_or_compute('key', compute))
+
+        results = []
+        threads = [threading.Thread(target=get)]
+        threads[0].start()
+        started.wait()
+
+        threads.extend(threading.Thread(target=get) for _ in range(4))
+        for thread in threads[1:]:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(etag for _, etag in results)), 1)
+
     def test_cumulative_category_ok(self):
         response = self.client.get(flask.url_for('api.statistics-cumulative-categories'))
         self.assertEqual(response.status_code, 200)
@@ -96,6 +204,23 @@ class CumulativeTestCase(FlaskTestCase):
         # total cumulative time matches
         self.assertEqual(sum(self.cumulative_time_category), data['cumulative_time'])
 
+    def test_cumulative_category_query_count_ok(self):
+        def num_queries() -> int:
+            response = self.client.get(flask.url_for('api.statistics-cumulative-categories'))
+            self.assertEqual(response.status_code, 200)
+            return int(response.headers['X-Query-Count'])
+
+        n = num_queries()
+
+        # one category per task does not result in more queries
+        for i, task in enumerate(self.tasks):
+            task.category = Category.create('other{}'.format(i))
+            self.db_session.add(task)
+
+        self.db_session.commit()
+
+        self.assertEqual(num_queries(), n)
+
     def test_cumulative_timeflip_ok(self):
         response = self.client.get(flask.url_for('api.statistics-cumulative-timeflips'))
         self.assertEqual(response.status_code, 200)
@@ -184,3 +309,347 @@ class PeriodicTestCase(FlaskTestCase):
             for i in reference_task_time:
                 self.assertIn(i, actual_task_time)  # the task is there...
                 self.assertEqual(reference_task_time[i], actual_task_time[i])  # ... with the same cumulative time!
+
+    def test_periodic_tasks_stream(self):
+        period = 60
+        query = '?start={}&end={}'.format(self.start.isoformat(), self.end.isoformat())
+
+        # too many periods for the regular view ...
+        response = self.client.get(flask.url_for('api.statistics-periodic-tasks', period=period) + query)
+        self.assertEqual(response.status_code, 403)
+
+        # ... but not for the streaming one
+        response = self.client.get(flask.url_for('api.statistics-periodic-tasks-stream', period=period) + query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        periods = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+        buckets = PeriodicBuckets(self.start, self.end, period)
+        self.assertEqual(len(periods), buckets.num_periods)
+
+        for element in self.elements:
+            buckets.add(element.task_id, element.start, element.end)
+
+        for i, durations in enumerate(buckets.durations()):
+            period_start, period_end = buckets.period_bounds(i)
+            self.assertEqual(period_start.isoformat(), periods[i]['start'])
+            self.assertEqual(period_end.isoformat(), periods[i]['end'])
+            self.assertEqual(durations, dict((t['id'], t['cumulative_time']) for t in periods[i]['tasks']))
+            self.assertEqual(sum(durations.values()), periods[i]['cumulative_time'])
+
+    def test_periodic_tasks_stream_unbounded_ko(self):
+        response = self.client.get(
+            flask.url_for('api.statistics-periodic-tasks-stream', period=60) + '?start={}'.format(
+                self.start.isoformat()))
+        self.assertEqual(response.status_code, 403)
+
+    def test_periodic_buckets(self):
+        """Check the bucketing engine against `duration()`, with more periods than the views allow
+        """
+
+        period = 7
+        buckets = PeriodicBuckets(self.start, self.end, period)
+        self.assertEqual(buckets.num_periods, int(math.ceil((self.end - self.start).total_seconds() / period)))
+        self.assertGreater(buckets.num_periods, BasePeriodicView.MAX_PERIODS)
+
+        for element in self.elements:
+            buckets.add(element.task_id, element.start, element.end)
+
+        for i, durations in enumerate(buckets.durations()):
+            period_start, period_end = buckets.period_bounds(i)
+
+            expected_durations = {}
+            for element in self.elements:
+                if element.start <= period_end and element.end >= period_start:
+                    expected_durations[element.task_id] = \
+                        expected_durations.get(element.task_id, 0) + element.duration(period_start, period_end)
+
+            self.assertEqual(
+                dict((k, v) for k, v in expected_durations.items() if v > 0),
+                dict((k, v) for k, v in durations.items() if v > 0))
+
+
+class RollupTestCase(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.device = TimeFlipDevice.create('00:00:00:00:00:00', '000000')
+        self.db_session.add(self.device)
+
+        self.category = Category.create('cat')
+        self.db_session.add(self.category)
+
+        self.db_session.commit()
+
+        self.tasks = []
+        for i in range(3):
+            task = Task.create('x{}'.format(i), self.category, '#000000')
+            self.db_session.add(task)
+            self.tasks.append(task)
+
+        self.db_session.commit()
+
+        self.start = datetime(2021, 9, 26)
+        self.elements = []
+        start = self.start + timedelta(minutes=17)
+        for i in range(20):
+            end = start + timedelta(minutes=random.randrange(1, 200))
+            element = HistoryElement.create(start, end, 0, self.device, self.tasks[i % len(self.tasks)])
+            self.db_session.add(element)
+            self.elements.append(element)
+            start = end
+
+        self.db_session.commit()
+
+    def rollups(self) -> List[Tuple[Any, ...]]:
+        return sorted(
+            (r.resolution, r.bucket, r.task_id, r.timeflip_device_id, r.duration, r.carried)
+            for r in HistoryRollup.query.all())
+
+    def test_rollups_follow_history_ok(self):
+        # modify, delete, and remove task
+        response = self.client.patch(flask.url_for('api.history-el', id=self.elements[0].id), json={
+            'start': (self.start - timedelta(hours=5)).isoformat(),
+            'task': self.tasks[1].id
+        })
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.delete(flask.url_for('api.history-el', id=self.elements[1].id))
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.delete(flask.url_for('api.task', id=self.tasks[2].id))
+        self.assertEqual(response.status_code, 200)
+
+        # incremental rollups match the ones computed from scratch
+        rollups = self.rollups()
+        self.assertNotEqual(len(rollups), 0)
+
+        HistoryRollup.rebuild(db.session.connection())
+        self.db_session.commit()
+
+        self.assertEqual(rollups, self.rollups())
+
+    def test_rollups_truncated_per_element_ok(self):
+        # elements of 1.6 seconds (the last one over two hours), which account for 1 second each
+        start = datetime(2021, 9, 25, 10, 59, 55)
+        for i in range(4):
+            end = start + timedelta(seconds=1, microseconds=600000)
+            self.db_session.add(HistoryElement.create(start, end, 0, self.device, self.tasks[0]))
+            start = end
+
+        self.db_session.commit()
+
+        def cumulative(start: str, end: str) -> int:
+            response = self.client.get(
+                flask.url_for('api.statistics-cumulative-tasks') + '?start={}&end={}'.format(start, end))
+            self.assertEqual(response.status_code, 200)
+            return response.get_json()['cumulative_time']
+
+        # from the rollups and from the elements
+        self.assertEqual(cumulative('2021-09-25T00:00:00', '2021-09-26T00:00:00'), 4)
+        self.assertEqual(cumulative('2021-09-25T00:00:01', '2021-09-25T23:00:00'), 4)
+
+        self.assertEqual(cumulative('2021-09-25T10:00:00', '2021-09-25T11:00:00'), 3)
+        self.assertEqual(cumulative('2021-09-25T10:00:01', '2021-09-25T11:00:00'), 3)
+
+        response = self.client.get(flask.url_for(
+            'api.statistics-periodic-tasks', period=3600) + '?start=2021-09-25T00:00:00&end=2021-09-26T00:00:00')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['cumulative_time'], 4)
+
+    def test_rollups_sub_second_bounds_ok(self):
+        view = PeriodicTaskView()
+        start = datetime(2021, 9, 24)
+        end = start + timedelta(hours=4)
+
+        def both_paths(element_start: datetime, element_end: datetime) -> Tuple[list, list, Any]:
+            for element in HistoryElement.query.filter(HistoryElement.start < end).all():
+                self.db_session.delete(element)
+
+            self.db_session.add(HistoryElement.create(element_start, element_end, 0, self.device, self.tasks[0]))
+            self.db_session.commit()
+
+            elements, _ = view.query_elements(start=start, end=end)
+
+            return (
+                [d.get(self.tasks[0].id, 0) for d in view.rollup_durations(PeriodicBuckets(start, end, 3600), 3600)],
+                [d.get(self.tasks[0].id, 0) for d in view.element_durations(
+                    PeriodicBuckets(start, end, 3600), elements)],
+                view.rollup_resolution((start, end), 3600)
+            )
+
+        def periodic(period: int) -> List[int]:
+            response = self.client.get(
+                flask.url_for('api.statistics-periodic-tasks', period=period) + '?start={}&end={}'.format(
+                    start.isoformat(), end.isoformat()))
+            self.assertEqual(response.status_code, 200)
+            return [p['cumulative_time'] for p in response.get_json()['periods']]
+
+        def cumulative(frame_start: datetime) -> int:
+            response = self.client.get(flask.url_for('api.statistics-cumulative-tasks') + '?start={}&end={}'.format(
+                frame_start.isoformat(), end.isoformat()))
+            self.assertEqual(response.status_code, 200)
+            return response.get_json()['cumulative_time']
+
+        # starting at a whole second, both paths agree
+        rollups, elements, resolution = both_paths(
+            start + timedelta(minutes=59, seconds=59), start + timedelta(hours=2, microseconds=700000))
+        self.assertEqual(rollups, [1, 3600, 0, 0])
+        self.assertEqual(elements, rollups)
+        self.assertEqual(resolution, 3600)
+
+        # ... but not at a fraction of second, where the rollups are then not used
+        rollups, elements, resolution = both_paths(
+            start + timedelta(minutes=59, seconds=59, microseconds=500000),
+            start + timedelta(hours=2, microseconds=700000))
+        self.assertEqual(rollups, [0, 3600, 1, 0])
+        self.assertEqual(elements, [0, 3600, 0, 0])
+        self.assertIsNone(resolution)
+
+        self.assertEqual(periodic(3600), [0, 3600, 0, 0])
+        self.assertEqual(periodic(7200), [3600, 0])  # (the element does not cross the start of a period)
+        self.assertEqual(cumulative(start), 3601)
+        self.assertEqual(cumulative(start + timedelta(hours=1)), 3600)
+
+    def test_statistics_from_rollups_ok(self):
+        end = self.start + timedelta(days=2)
+        period = 3 * 3600
+
+        response = self.client.get(
+            flask.url_for('api.statistics-periodic-tasks', period=period) + '?start={}&end={}'.format(
+                self.start.isoformat(), end.isoformat()))
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+
+        for period in data['periods']:
+            period_start, period_end = datetime.fromisoformat(period['start']), datetime.fromisoformat(period['end'])
+
+            expected_task_time = {}
+            for element in self.elements:
+                duration = element.duration(period_start, period_end)
+                if duration > 0:
+                    expected_task_time[element.task_id] = expected_task_time.get(element.task_id, 0) + duration
+
+            self.assertEqual(expected_task_time, dict((t['id'], t['cumulative_time']) for t in period['tasks']))
+
+    def test_statistics_search_comments_ok(self):
+        for element in self.elements[::3]:
+            element.comment = 'focus'
+            self.db_session.add(element)
+
+        self.db_session.commit()
+
+        # (rollups do not know about comments)
+        response = self.client.get(
+            flask.url_for('api.statistics-periodic-tasks', period=3600) + '?start={}&end={}&q=focus'.format(
+                self.start.isoformat(), (self.start + timedelta(days=2)).isoformat()))
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+
+        for period in data['periods']:
+            period_start, period_end = datetime.fromisoformat(period['start']), datetime.fromisoformat(period['end'])
+
+            expected_task_time = {}
+            for element in self.elements[::3]:
+                duration = element.duration(period_start, period_end)
+                if duration > 0:
+                    expected_task_time[element.task_id] = expected_task_time.get(element.task_id, 0) + duration
+
+            self.assertEqual(expected_task_time, dict(
+                (t['id'], t['cumulative_time']) for t in period['tasks'] if t['cumulative_time'] > 0))
+
+
+class PivotTestCase(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.devices = []
+        for i in range(2):
+            device = TimeFlipDevice.create('00:00:00:00:00:0{}'.format(i), '000000')
+            self.db_session.add(device)
+            self.devices.append(device)
+
+        self.categories = []
+        for i in range(2):
+            category = Category.create('cat{}'.format(i))
+            self.db_session.add(category)
+            self.categories.append(category)
+
+        self.db_session.commit()
+
+        self.tasks = []
+        for i in range(5):
+            task = Task.create('x{}'.format(i), self.categories[i % 2], '#000000')
+            self.db_session.add(task)
+            self.tasks.append(task)
+
+        self.db_session.commit()
+
+        self.end = datetime.now()
+        self.start = self.end - timedelta(hours=5)
+        start = self.start
+        while start < self.end:
+            end = min(self.end, start + timedelta(seconds=random.randrange(60, 1200)))
+            element = HistoryElement.create(
+                start, end, 0, random.choice(self.devices), random.choice(self.tasks + [None]))
+            self.db_session.add(element)
+            start = end
+
+        self.db_session.commit()
+
+    def pivot(self, args: List[Tuple[str, Any]]) -> dict:
+        args = args + [('start', self.start.isoformat()), ('end', self.end.isoformat())]
+        response = self.client.get(
+            flask.url_for('api.statistics-pivot') + '?' + '&'.join('{}={}'.format(a, b) for a, b in args))
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_pivot_task_timeflip_ok(self):
+        data = self.pivot([('dimension', 'task'), ('dimension', 'timeflip')])
+
+        self.assertEqual(data['dimensions'], ['task', 'timeflip'])
+        self.assertEqual(
+            set(c['task'] for c in data['cells']), set(t['id'] for t in data['tasks']))
+        self.assertEqual(
+            set(c['timeflip'] for c in data['cells']), set(t['id'] for t in data['timeflip_devices']))
+
+        # each slice matches the cumulative view
+        for device in self.devices:
+            response = self.client.get(flask.url_for('api.statistics-cumulative-tasks') + '?{}'.format(
+                '&'.join(['timeflip={}'.format(device.id), 'start=' + self.start.isoformat(),
+                          'end=' + self.end.isoformat()])))
+            reference = dict((t['id'], t['cumulative_time']) for t in response.get_json()['tasks'])
+
+            self.assertEqual(
+                reference, dict((c['task'], c['cumulative_time']) for c in data['cells'] if c['timeflip'] == device.id))
+
+    def test_pivot_category_period_ok(self):
+        period = 1800
+        data = self.pivot([('dimension', 'category'), ('dimension', 'period'), ('period', period)])
+
+        response = self.client.get(
+            flask.url_for('api.statistics-periodic-categories', period=period) + '?start={}&end={}'.format(
+                self.start.isoformat(), self.end.isoformat()))
+        reference = response.get_json()
+
+        self.assertEqual(len(data['periods']), len(reference['periods']))
+        self.assertEqual(reference['cumulative_time'], data['cumulative_time'])
+
+        for i, period in enumerate(reference['periods']):
+            self.assertEqual(period['start'], data['periods'][i]['start'])
+            self.assertEqual(
+                dict((c['id'], c['cumulative_time']) for c in period['categories']),
+                dict((c['category'], c['cumulative_time']) for c in data['cells'] if c['period'] == i))
+
+    def test_pivot_no_dimension_ok(self):
+        data = self.pivot([])
+
+        response = self.client.get(flask.url_for('api.statistics-cumulative-tasks') + '?start={}&end={}'.format(
+            self.start.isoformat(), self.end.isoformat()))
+        self.assertEqual(response.get_json()['cumulative_time'], data['cumulative_time'])
+        self.assertEqual(len(data['cells']), 1)
+
+    def test_pivot_period_without_period_ko(self):
+        response = self.client.get(flask.url_for('api.statistics-pivot') + '?dimension=period')
+        self.assertEqual(response.status_code, 422)
@@ -34,6 +34,24 @@ class CategoriesTestCase(FlaskTestCase):
         self.assertIn('categories', data)
         self.assertEqual(len(data['categories']), self.num_category)
 
+    def test_view_categories_query_count_ok(self):
+        def num_queries() -> int:
+            response = self.client.get(flask.url_for('api.categories'))
+            self.assertEqual(response.status_code, 200)
+            return int(response.headers['X-Query-Count'])
+
+        n = num_queries()
+
+        # more categories (with tasks) does not result in more queries
+        for i in range(5):
+            category = Category.create('other{}'.format(i))
+            self.db_session.add(category)
+            self.db_session.add(Task.create('other{}'.format(i), category, '#ffffff'))
+
+        self.db_session.commit()
+
+        self.assertEqual(num_queries(), n)
+
     def test_create_category_ok(self):
         self.assertEqual(self.num_category, Category.query.count())
 
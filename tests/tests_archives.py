@@ -0,0 +1,227 @@
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest.mock
+from datetime import datetime, timedelta
+
+import flask
+
+from tests import FlaskTestCase
+
+from timefliptt.blueprints.base_models import HistoryElement, HistoryArchive, Category, Task
+from timefliptt.blueprints.history_archive import HistoryArchiver
+from timefliptt.blueprints.api.cache import mark_data_changed
+
+
+class ArchivesTestCase(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.archive_dir = tempfile.mkdtemp()
+        self.app.config['ARCHIVE_DIR'] = self.archive_dir
+
+        self.category = Category.create('x')
+        self.db_session.add(self.category)
+        self.db_session.commit()
+
+        self.tasks = []
+        for i in range(3):
+            task = Task.create('x{}'.format(i), self.category, '#000000')
+            self.db_session.add(task)
+            self.tasks.append(task)
+
+        self.db_session.commit()
+
+        # from mid-2019 to mid-2021, with elements over the new years
+        start = datetime(2019, 6, 1, 10)
+        while start < datetime(2021, 6, 1):
+            end = start + timedelta(hours=random.randrange(1, 120))
+            self.db_session.add(HistoryElement.create(
+                start,
+                end,
+                random.randrange(0, 63),
+                self.admin,
+                random.choice(self.tasks + [None]),
+                random.choice([None, 'meeting', 'code review'])
+            ))
+            start = end + timedelta(minutes=random.randrange(0, 60))
+
+        self.db_session.commit()
+
+        self.num_elements = HistoryElement.query.count()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+        super().tearDown()
+
+    def get(self, endpoint: str, args: str = '', **kwargs) -> flask.Response:
+        response = self.client.get(flask.url_for(endpoint, **kwargs) + args)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def responses(self) -> list:
+        around_new_year = '?start=2019-12-30T17:22:00&end=2020-01-02T12:00:00'
+
+        return [
+            self.get('api.history-els', '?page_size=1000').json,
+            self.get('api.history-els', '?page_size=10&page=3').json,
+            self.get('api.history-els', around_new_year).json,
+            self.get('api.history-els', '?q=meet&page_size=1000').json,
+            self.get('api.history-export').get_data(as_text=True),
+            self.get('api.statistics-cumulative-tasks').json,
+            self.get('api.statistics-cumulative-tasks', around_new_year).json,
+            self.get('api.statistics-cumulative-tasks', '?q=review').json,
+            self.get(  # from the rollups
+                'api.statistics-periodic-categories', '?start=2019-06-01T00:00:00&end=2021-06-01T00:00:00',
+                period=14 * 86400).json,
+            self.get(  # from the elements
+                'api.statistics-periodic-categories', '?start=2019-06-01T10:07:00&end=2021-06-01T10:07:00',
+                period=14 * 86400).json,
+            self.get('api.statistics-pivot', '?dimension=task&dimension=timeflip').json,
+        ]
+
+    def test_archive_ok(self):
+        responses = self.responses()
+
+        archiver = HistoryArchiver(self.db_session.connection(), self.archive_dir)
+        archiver.run(datetime(2021, 1, 1))
+        mark_data_changed()
+        self.db_session.commit()
+
+        # elements are moved to yearly archives
+        self.assertGreater(archiver.archived, 0)
+        self.assertEqual(HistoryElement.query.count(), self.num_elements - archiver.archived)
+        self.assertEqual(HistoryElement.query.filter(HistoryElement.end <= datetime(2021, 1, 1)).count(), 0)
+
+        archives = HistoryArchive.query.order_by(HistoryArchive.year).all()
+        self.assertEqual([a.year for a in archives], [2019, 2020])
+        self.assertEqual(sum(a.num_elements for a in archives), archiver.archived)
+        self.assertTrue(all(os.path.exists(os.path.join(self.archive_dir, a.file_name)) for a in archives))
+
+        # ... but results are the same
+        self.assertEqual(responses, self.responses())
+
+        # archives are only attached if needed
+        self.assertEqual(HistoryArchive.reaching(datetime(2021, 2, 1), datetime(2021, 3, 1)), [])
+        self.assertEqual(HistoryArchive.reaching(datetime(2020, 2, 1), datetime(2021, 3, 1)), archives[1:])
+
+        # archiving again has no effect, and works with the attached archives
+        self.assertEqual(HistoryArchiver(self.db_session.connection(), self.archive_dir).run(datetime(2021, 1, 1)), 0)
+
+        # archived elements are read-only
+        response = self.client.delete(flask.url_for('api.history-els') + '?end=2020-12-01T00:00:00')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(responses[:1], self.responses()[:1])
+
+    def archive(self, before: datetime = datetime(2021, 1, 1)) -> HistoryArchiver:
+        archiver = HistoryArchiver(self.db_session.connection(), self.archive_dir)
+        archiver.run(before)
+        mark_data_changed()
+        self.db_session.commit()
+
+        return archiver
+
+    def test_import_archived_ok(self):
+        exported = self.get('api.history-export').get_data(as_text=True)
+
+        archiver = self.archive()
+
+        # importing the export again changes nothing, archived elements included
+        response = self.client.post(flask.url_for('api.history-import'), data=exported, content_type='text/csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'imported': 0, 'skipped': self.num_elements})
+
+        self.assertEqual(HistoryElement.query.count(), self.num_elements - archiver.archived)
+
+    def test_ids_not_reused_ok(self):
+        self.archive()
+
+        # remove what remains in the main database, so that SQLite would otherwise reuse the archived ids
+        self.client.delete(flask.url_for('api.history-els') + '?start=2021-01-01T00:00:00')
+        self.assertEqual(HistoryElement.query.count(), 0)
+
+        for i in range(5):
+            self.db_session.add(HistoryElement.create(
+                datetime(2021, 7, 1, i), datetime(2021, 7, 1, i, 30), 1, self.admin, self.tasks[0]))
+
+        self.db_session.commit()
+
+        data = self.get('api.history-els', '?page_size=1000').json
+        ids = [e['id'] for e in data['history']]
+
+        self.assertEqual(len(ids), data['total_elements'])
+        self.assertEqual(len(set(ids)), len(ids))
+
+        # ... as well as with cursors
+        cursor_ids = []
+        page = self.get('api.history-els', '?page_size=100').json
+        while True:
+            cursor_ids.extend(e['id'] for e in page['history'])
+            if page['next_page'] is None:
+                break
+            page = self.client.get(page['next_page']).json
+
+        self.assertEqual(sorted(cursor_ids), sorted(ids))
+
+    def test_delete_task_ok(self):
+        self.archive()
+
+        task_id = self.tasks[0].id
+
+        def tasks_time(args: str = '') -> dict:
+            data = self.get('api.statistics-cumulative-tasks', args).json
+            return dict((t.get('id'), t['cumulative_time']) for t in data['tasks'])
+
+        self.assertIn(task_id, tasks_time())
+
+        response = self.client.delete(flask.url_for('api.task', id=task_id))
+        self.assertEqual(response.status_code, 200)
+
+        # the deleted task is forgotten, in the rollups (whole hours) and in the elements (otherwise)
+        self.assertNotIn(task_id, tasks_time())
+        self.assertNotIn(task_id, tasks_time('?start=2019-06-01T10:07:00&end=2021-06-01T10:07:00'))
+
+        # ... as well as in the archives
+        for archive in HistoryArchive.query.all():
+            with sqlite3.connect(os.path.join(self.archive_dir, archive.file_name)) as connection:
+                self.assertEqual(connection.execute(
+                    'SELECT COUNT(*) FROM history_element WHERE task_id = ?', (task_id, )).fetchone(), (0, ))
+
+        self.assertEqual(self.get('api.history-els').json['total_elements'], self.num_elements)
+
+    def test_many_archives_ok(self):
+        # one element per year, from 2005
+        for year in range(2005, 2019):
+            self.db_session.add(HistoryElement.create(
+                datetime(year, 3, 1, 10), datetime(year, 3, 1, 11), 1, self.admin, self.tasks[0]))
+
+        self.db_session.commit()
+        responses = self.responses()
+
+        # at most `MAX_ATTACHED` years per transaction
+        archiver = self.archive()
+        self.assertEqual(archiver.remaining, 16 - HistoryArchive.MAX_ATTACHED)
+        self.assertEqual(self.archive().remaining, 0)
+
+        self.assertGreater(HistoryArchive.query.count(), HistoryArchive.MAX_ATTACHED)
+
+        # more archives than can be attached are still queried (the oldest ones from their files) ...
+        self.assertEqual(responses, self.responses())
+        self.assertEqual(self.get('api.history-els').json['total_elements'], self.num_elements + 14)
+
+        # statistics that the rollups answer do not query the elements (thus the archives)
+        with unittest.mock.patch.object(HistoryArchive, 'reaching') as reaching:
+            self.get('api.statistics-cumulative-tasks', '?start=2005-01-01T00:00:00')
+            self.get(
+                'api.statistics-periodic-tasks',
+                '?start=2005-01-01T00:00:00&end=2021-01-01T00:00:00',
+                period=365 * 86400)
+            reaching.assert_not_called()
+
+        # ... as well as successive ones
+        for year in range(2005, 2021):
+            data = self.get(
+                'api.history-els', '?start={}-01-01T00:00:00&end={}-12-31T00:00:00'.format(year, year)).json
+            self.assertGreater(data['total_elements'], 0)
@@ -0,0 +1,150 @@
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+from tests import FlaskTestCase
+from tests.tests_timeflip_daemon import FakeClient
+
+from timefliptt import timeflip
+from timefliptt.app import db
+from timefliptt.blueprints.base_models import Category, Task, FacetToTask, HistoryElement, HistoryRollup
+from timefliptt.blueprints.history_sync import HistoryWriter, timed_history, split_history
+
+
+class HistorySyncTestCase(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.category = Category.create('x')
+        self.db_session.add(self.category)
+        self.db_session.commit()
+
+        self.task = Task.create('x', self.category, '#000000')
+        self.db_session.add(self.task)
+        self.db_session.add(FacetToTask.create(self.admin, 1, self.task))
+
+        self.admin.calibration = FakeClient.calibration
+        self.db_session.add(self.admin)
+        self.db_session.commit()
+
+        self.writer = HistoryWriter(self.app, batch_size=3)
+
+    def test_timed_history_ok(self):
+        end_date = datetime(2021, 10, 1, 12, 30, 15, 500)
+
+        self.assertEqual(list(timed_history(FakeClient.history_elements, end_date)), [
+            (datetime(2021, 10, 1, 12, 27, 15), datetime(2021, 10, 1, 12, 28, 15), 1),
+            (datetime(2021, 10, 1, 12, 28, 15), datetime(2021, 10, 1, 12, 30, 15), 2)
+        ])
+
+    def test_split_history_ok(self):
+        end_date = datetime(2021, 10, 1, 12, 30, 15, 500)
+        history = [(i % 3, 60 * (i + 1), bytearray()) for i in range(7)]
+
+        parts = list(split_history(history, end_date, 3))
+        self.assertEqual([len(p) for p, _ in parts], [3, 3, 1])
+        self.assertEqual(parts[-1][1], end_date)
+
+        # the dates are the same as without splitting
+        self.assertEqual(
+            [e for part, part_end_date in parts for e in timed_history(part, part_end_date)],
+            list(timed_history(history, end_date)))
+
+    def test_transactions_ok(self):
+        written = []
+
+        def write(batches):
+            written.append(sum(len(b[1]) for b in batches))
+
+        history = [(1, 60, bytearray())] * 5
+        with mock.patch.object(self.writer, 'write', write):
+            self.writer.put(self.admin.address, history, datetime(2021, 10, 1, 12, 30))
+            self.writer.put(self.admin.address, history[:2], datetime(2021, 10, 1, 13, 30))
+            self.writer.start()
+            self.writer.stop()
+
+        # at most `batch_size` elements per transaction
+        self.assertEqual(written, [3, 2, 2])
+
+    def test_retry_ok(self):
+        self.writer.retry_delay = .01
+        write = self.writer.write
+        failures = [RuntimeError('oops'), RuntimeError('oops')]
+
+        def failing_write(batches):
+            if len(failures) > 0:
+                raise failures.pop()
+            write(batches)
+
+        with mock.patch.object(self.writer, 'write', failing_write):
+            self.writer.put(self.admin.address, FakeClient.history_elements, datetime(2021, 10, 1, 12, 30))
+            self.writer.start()
+            self.writer.stop()
+
+        self.assertEqual(self.writer.written, 2)
+
+        # ... but not forever, and the thread survives (the second history is another transaction)
+        failures.extend([RuntimeError('oops')] * (self.writer.retries + 1))
+
+        with mock.patch.object(self.writer, 'write', failing_write):
+            self.writer.start()
+            self.writer.put(self.admin.address, FakeClient.history_elements, datetime(2021, 10, 1, 13, 30))
+            self.writer.put(self.admin.address, FakeClient.history_elements, datetime(2021, 10, 1, 14, 30))
+            self.writer.stop()
+
+        self.assertEqual(self.writer.written, 4)
+        self.assertEqual(HistoryElement.query.count(), 4)
+
+    def test_write_ok(self):
+        end_date = datetime(2021, 10, 1, 12, 30)
+
+        self.writer.write([
+            (self.admin.address, FakeClient.history_elements, end_date),
+            (self.admin.address, FakeClient.history_elements, end_date + timedelta(minutes=5)),
+            ('unknown', FakeClient.history_elements, end_date)
+        ])
+
+        self.assertEqual(self.writer.written, 4)
+
+        elements = HistoryElement.query.order_by(HistoryElement.start).all()
+        self.assertEqual(len(elements), 4)
+        self.assertEqual([e.task_id for e in elements], [self.task.id, None] * 2)
+        self.assertTrue(all(e.timeflip_device_id == self.admin.id for e in elements))
+
+        # rollups are updated (for the elements that have a task)
+        self.assertEqual(
+            self.db_session.query(db.func.sum(HistoryRollup.duration))
+            .filter(HistoryRollup.resolution == HistoryRollup.RESOLUTIONS[0]).scalar(),
+            2 * 60 * 1000000)
+
+    def test_sync_ok(self):
+        with mock.patch('timefliptt.timeflip.AsyncClient', FakeClient):
+            timeflip.daemon_start()
+            self.writer.start()
+
+            try:
+                # not synchronized without calibration
+                timeflip.hard_connect(self.admin.address, self.admin.password).result(5)
+                timeflip.sync_start(.05, self.writer.put)
+
+                time.sleep(.2)
+                self.assertEqual(self.writer.written, 0)
+
+                timeflip.soft_connect(self.admin.address, self.admin.password, self.admin.calibration)
+
+                for i in range(50):
+                    if self.writer.written > 0:
+                        break
+                    time.sleep(.1)
+
+                self.assertEqual(timeflip.run_coro(self.admin.address, self.get_deleted), True)
+            finally:
+                timeflip.daemon_stop()
+                self.writer.stop()
+
+        self.assertGreaterEqual(self.writer.written, 2)
+        self.assertEqual(HistoryElement.query.count(), self.writer.written)
+
+    @staticmethod
+    async def get_deleted(client: FakeClient) -> bool:
+        return client.history_deleted
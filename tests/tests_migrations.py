@@ -0,0 +1,225 @@
+import os
+import shutil
+import tempfile
+import unittest.mock
+from datetime import datetime, timedelta
+
+from tests import FlaskTestCase
+
+from timefliptt.app import db, init_app
+from timefliptt.migrations import get_version, set_version, latest_version, upgrade, MIGRATIONS, \
+    _store_history_dates_as_epochs
+from timefliptt.blueprints.base_models import HistoryElement, HistoryRollup, HistoryArchive, Category, Task
+from timefliptt.blueprints.history_archive import HistoryArchiver
+
+# `history_element`, as it was when dates were stored as text
+TEXT_HISTORY_ELEMENT = \
+    'CREATE TABLE {}.history_element (id INTEGER NOT NULL, date_created DATETIME, date_modified DATETIME, ' \
+    'start DATETIME NOT NULL, "end" DATETIME NOT NULL, original_facet INTEGER NOT NULL, comment TEXT, ' \
+    'timeflip_device_id INTEGER, task_id INTEGER, PRIMARY KEY (id), ' \
+    'FOREIGN KEY(timeflip_device_id) REFERENCES timeflip_device (id) ON DELETE SET NULL, ' \
+    'FOREIGN KEY(task_id) REFERENCES task (id) ON DELETE SET NULL)'
+
+EPOCH_TO_TEXT = "strftime('%Y-%m-%d %H:%M:%S', {0} / 1000000, 'unixepoch') || printf('.%06d', {0} % 1000000)"
+
+
+class MigrationsTestCase(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.archive_dir = tempfile.mkdtemp()
+        self.app.config['ARCHIVE_DIR'] = self.archive_dir
+
+        self.category = Category.create('x')
+        self.db_session.add(self.category)
+        self.db_session.commit()
+
+        self.task = Task.create('x', self.category, '#000000')
+        self.db_session.add(self.task)
+        self.db_session.commit()
+
+        start = datetime(2021, 10, 1, 12, 30)
+        for i in range(10):
+            self.db_session.add(HistoryElement.create(start, start + timedelta(minutes=45), 0, self.admin, self.task))
+            start += timedelta(hours=1)
+
+        element = HistoryElement.create(start, start + timedelta(minutes=45), 0, self.admin, self.task, 'a comment')
+        self.db_session.add(element)
+        self.db_session.commit()
+
+        self.element_id = element.id
+
+        self.num_elements = HistoryElement.query.count()
+        self.rollups = self.get_rollups()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+        super().tearDown()
+
+    def get_rollups(self) -> list:
+        return self.db_session.query(
+            HistoryRollup.resolution,
+            HistoryRollup.bucket,
+            HistoryRollup.task_id,
+            HistoryRollup.timeflip_device_id,
+            HistoryRollup.duration
+        ).order_by(HistoryRollup.resolution, HistoryRollup.bucket).all()
+
+    def get_indexes(self, table: str) -> set:
+        return set(index['name'] for index in db.inspect(db.engine).get_indexes(table))
+
+    def get_elements(self) -> list:
+        return self.db_session.query(
+            HistoryElement.id,
+            HistoryElement.start,
+            HistoryElement.end,
+            HistoryElement.length,
+            HistoryElement.comment
+        ).order_by(HistoryElement.id).all()
+
+    @staticmethod
+    def store_dates_as_text(connection, schema: str = 'main'):
+        """Go back to dates stored as text (without the R*Tree, full-text index and other indexes)
+        """
+
+        connection.exec_driver_sql('ALTER TABLE {}.history_element RENAME TO history_element_epoch'.format(schema))
+        connection.exec_driver_sql(TEXT_HISTORY_ELEMENT.format(schema))
+        connection.exec_driver_sql(
+            'INSERT INTO {0}.history_element SELECT id, date_created, date_modified, {1}, {2}, original_facet, '
+            'comment, timeflip_device_id, task_id FROM {0}.history_element_epoch'.format(
+                schema, EPOCH_TO_TEXT.format('start'), EPOCH_TO_TEXT.format('"end"')))
+        connection.exec_driver_sql('DROP TABLE {}.history_element_epoch'.format(schema))
+
+    def test_init_fresh_ok(self):
+        db.drop_all()
+        set_version(self.db_session.connection(), 0)
+        self.db_session.commit()
+
+        init_app()
+
+        self.assertEqual(get_version(self.db_session.connection()), latest_version())
+        self.assertIn('ix_history_element_end_start', self.get_indexes('history_element'))
+
+        # nothing to do
+        self.assertEqual(upgrade(self.db_session.connection()), [])
+
+    def test_upgrade_ok(self):
+        elements = self.get_elements()
+
+        # go back to the first version of the schema
+        connection = self.db_session.connection()
+        HistoryRollup.__table__.drop(connection)
+        for virtual_table in ('history_element_rtree', 'history_element_fts'):
+            connection.exec_driver_sql('DROP TABLE {}'.format(virtual_table))
+            for trigger in ('insert', 'update', 'delete'):
+                connection.exec_driver_sql('DROP TRIGGER {}_{}'.format(virtual_table, trigger))
+        for index in Task.__table__.indexes:
+            index.drop(connection)
+
+        self.store_dates_as_text(connection)
+        self.assertEqual(
+            connection.exec_driver_sql('SELECT typeof(start) FROM history_element LIMIT 1').scalar(), 'text')
+
+        set_version(connection, 0)
+        self.db_session.commit()
+
+        self.assertEqual(self.get_indexes('history_element'), set())
+        self.assertFalse(db.inspect(db.engine).has_table('history_rollup'))
+        self.assertFalse(db.inspect(db.engine).has_table('history_element_rtree'))
+        self.assertFalse(db.inspect(db.engine).has_table('history_element_fts'))
+
+        # upgrade
+        init_app()
+
+        self.assertEqual(get_version(self.db_session.connection()), latest_version())
+        self.assertEqual(
+            self.get_indexes('history_element'),
+            {
+                'ix_history_element_end_start',
+                'ix_history_element_task_end',
+                'ix_history_element_device_end',
+                'ix_history_element_device_start'
+            })
+        self.assertEqual(self.get_indexes('task'), {'ix_task_category_id'})
+
+        # data are kept (dates are epochs, with the duration), and rollups are computed
+        self.assertEqual(HistoryElement.query.count(), self.num_elements)
+        self.assertEqual(
+            self.db_session.execute(db.text('SELECT typeof(start) FROM history_element LIMIT 1')).scalar(), 'integer')
+        self.assertEqual(self.get_elements(), elements)
+        self.assertTrue(all(e.length == 45 * 60 * 1000000 for e in elements))
+
+        self.assertEqual(self.get_rollups(), self.rollups)
+        self.assertEqual(
+            self.db_session.execute(db.text('SELECT count(*) FROM history_element_rtree')).scalar(), self.num_elements)
+        self.assertEqual(
+            self.db_session.execute(HistoryElement.matching_ids('comment')).scalars().all(), [self.element_id])
+
+    def test_upgrade_archives_ok(self):
+        elements = self.get_elements()
+
+        connection = self.db_session.connection()
+        HistoryArchiver(connection, self.archive_dir).run(datetime(2021, 10, 1, 16, 15))
+
+        # go back to the previous version, with dates stored as text (in the archive as well)
+        for virtual_table in ('history_element_rtree', 'history_element_fts'):
+            connection.exec_driver_sql('DROP TABLE {}'.format(virtual_table))
+            for trigger in ('insert', 'update', 'delete'):
+                connection.exec_driver_sql('DROP TRIGGER {}_{}'.format(virtual_table, trigger))
+
+        schema = HistoryArchive.schema_of(2021)
+        connection.exec_driver_sql('DROP TABLE {}.history_element_fts'.format(schema))
+
+        self.store_dates_as_text(connection)
+        self.store_dates_as_text(connection, schema)
+
+        version = [migration for _, migration in MIGRATIONS].index(_store_history_dates_as_epochs)
+        set_version(connection, version)
+        self.db_session.commit()
+
+        # upgrade
+        self.assertEqual(len(upgrade(self.db_session.connection())), latest_version() - version)
+        self.db_session.commit()
+
+        self.assertEqual(HistoryElement.query.count(), self.num_elements - 4)
+        self.assertEqual(self.get_rollups(), self.rollups)
+
+        # archived elements are converted as well
+        HistoryArchive.attach(
+            self.db_session.connection(), 2021, os.path.join(self.archive_dir, HistoryArchive.query.one().file_name))
+        archived = self.db_session.query(HistoryArchive.table_of(2021)).order_by('id').all()
+        self.assertEqual(
+            [(e.id, e.start, e.end, e.length, e.comment) for e in archived], elements[:4])
+
+    def test_upgrade_rollups_carried_ok(self):
+        # an element that starts at a fraction of second, over two hours
+        start = datetime(2021, 10, 2, 12, 59, 59, 500000)
+        self.db_session.add(HistoryElement.create(start, start + timedelta(hours=1), 0, self.admin, self.task))
+        self.db_session.commit()
+
+        rollups = self.db_session.query(HistoryRollup.bucket, HistoryRollup.duration, HistoryRollup.carried)\
+            .filter(HistoryRollup.resolution == 3600).order_by(HistoryRollup.bucket).all()
+        self.assertEqual(rollups[-1], (datetime(2021, 10, 2, 13), 3600 * 1000000, 1))
+
+        # go back to the rollups without `carried`
+        connection = self.db_session.connection()
+        connection.exec_driver_sql('ALTER TABLE history_rollup DROP COLUMN carried')
+        set_version(connection, latest_version() - 1)
+        self.db_session.commit()
+
+        self.assertEqual(len(upgrade(self.db_session.connection())), 1)
+        self.db_session.commit()
+
+        self.assertEqual(self.db_session.query(HistoryRollup.bucket, HistoryRollup.duration, HistoryRollup.carried)
+                         .filter(HistoryRollup.resolution == 3600).order_by(HistoryRollup.bucket).all(), rollups)
+
+    def test_upgrade_newer_ko(self):
+        set_version(self.db_session.connection(), latest_version() + 1)
+
+        with self.assertRaises(RuntimeError):
+            upgrade(self.db_session.connection())
+
+    def test_upgrade_old_sqlite_ko(self):
+        with unittest.mock.patch('timefliptt.migrations.MIN_SQLITE_VERSION', (99, 0, 0)):
+            with self.assertRaises(RuntimeError):
+                upgrade(self.db_session.connection())
@@ -0,0 +1,147 @@
+import contextlib
+import io
+import random
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import flask
+
+from tests import FlaskTestCase
+
+from timefliptt.app import snapshot_history
+from timefliptt.blueprints.base_models import HistoryElement, Category, Task
+from timefliptt.snapshot import HistorySnapshot, write_snapshot, NO_ID
+
+
+class SnapshotTestCase(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.directory = tempfile.mkdtemp()
+
+        self.categories = [Category.create('x'), Category.create('y')]
+        self.db_session.add_all(self.categories)
+        self.db_session.commit()
+
+        self.tasks = []
+        for i in range(4):
+            task = Task.create('t{}'.format(i), self.categories[i % 2], '#000000')
+            self.db_session.add(task)
+            self.tasks.append(task)
+
+        self.db_session.commit()
+
+        start = datetime(2021, 3, 1, 9, 13)
+        while start < datetime(2021, 6, 1):
+            end = start + timedelta(minutes=random.randrange(1, 3000), seconds=random.randrange(0, 60))
+            self.db_session.add(HistoryElement.create(
+                start, end, random.randrange(0, 63), self.admin, random.choice(self.tasks + [None])))
+            start = end + timedelta(minutes=random.randrange(0, 60))
+
+        self.db_session.commit()
+
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self) -> HistorySnapshot:
+        with contextlib.redirect_stdout(io.StringIO()):
+            snapshot_history(self.directory)
+
+        return HistorySnapshot(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def get(self, endpoint: str, args: str = '', **kwargs) -> dict:
+        response = self.client.get(flask.url_for(endpoint, **kwargs) + args)
+        self.assertEqual(response.status_code, 200)
+        return response.json
+
+    def test_snapshot_ok(self):
+        elements = HistoryElement.query.order_by(HistoryElement.start).all()
+        self.assertEqual(len(self.snapshot), len(elements))
+
+        for i in (0, len(elements) // 2, len(elements) - 1):
+            self.assertEqual(self.snapshot.to_dict(i), {
+                'id': elements[i].id,
+                'start': elements[i].start,
+                'end': elements[i].end,
+                'original_facet': elements[i].original_facet,
+                'task_id': elements[i].task_id,
+                'timeflip_device_id': elements[i].timeflip_device_id
+            })
+
+    def test_cumulative_ok(self):
+        for args, kwargs in [
+            ('', {}),
+            ('?start=2021-04-01T10:07:13&end=2021-04-20T18:00:00',
+             dict(start=datetime(2021, 4, 1, 10, 7, 13), end=datetime(2021, 4, 20, 18))),
+            ('?task={}'.format(self.tasks[1].id), dict(task=[self.tasks[1].id])),
+        ]:
+            for by, endpoint, key in [
+                ('task', 'api.statistics-cumulative-tasks', 'tasks'),
+                ('category', 'api.statistics-cumulative-categories', 'categories'),
+            ]:
+                expected = dict(
+                    (o['id'], o['cumulative_time']) for o in self.get(endpoint, args)[key])
+                cumulative = self.snapshot.cumulative(by, **kwargs)
+
+                self.assertEqual(cumulative, expected)
+
+        # filter on category
+        cumulative = self.snapshot.cumulative('task', category=[self.categories[0].id])
+        self.assertEqual(set(cumulative), set(t.id for t in self.tasks[::2]) & set(self.snapshot.task_id))
+
+    def test_cumulative_sub_second_ok(self):
+        response = self.client.delete(flask.url_for('api.history-els') + '?start=2021-01-01T00:00:00')
+        self.assertEqual(response.status_code, 200)
+
+        # 1.6 seconds each, which account for 1 second each
+        start = datetime(2021, 3, 1, 9, 13, 0, 300000)
+        for i in range(4):
+            end = start + timedelta(seconds=1, microseconds=600000)
+            self.db_session.add(HistoryElement.create(start, end, 0, self.admin, self.tasks[0]))
+            start = end
+
+        self.db_session.commit()
+
+        cumulative = self.take_snapshot().cumulative()
+        self.assertEqual(cumulative, {self.tasks[0].id: 4})
+        self.assertEqual(cumulative, dict(
+            (t['id'], t['cumulative_time']) for t in self.get('api.statistics-cumulative-tasks')['tasks']))
+
+    def test_unknown_task_ok(self):
+        # a task which is not in `meta.json`
+        write_snapshot(self.directory, [
+            (1, datetime(2021, 3, 1, 9), datetime(2021, 3, 1, 10), 0, self.tasks[0].id, self.admin.id),
+            (2, datetime(2021, 3, 1, 10), datetime(2021, 3, 1, 11), 0, 42, self.admin.id),
+        ], 2, {self.tasks[0].id: self.categories[0].id})
+
+        snapshot = HistorySnapshot(self.directory)
+
+        self.assertEqual(snapshot.cumulative('category'), {self.categories[0].id: 3600, NO_ID: 3600})
+        self.assertEqual(snapshot.cumulative('task', category=[self.categories[0].id]), {self.tasks[0].id: 3600})
+
+    def test_periodic_ok(self):
+        start, end = datetime(2021, 3, 3, 10, 7, 13), datetime(2021, 5, 25, 18, 3)  # not aligned: from the elements
+
+        response = self.get(
+            'api.statistics-periodic-tasks', '?start={}&end={}'.format(start.isoformat(), end.isoformat()),
+            period=86400 * 3)
+
+        periodic = self.snapshot.periodic(86400 * 3, start, end)
+        self.assertEqual(len(periodic), len(response['periods']))
+
+        for durations, period in zip(periodic, response['periods']):
+            self.assertEqual(durations, dict((t['id'], t['cumulative_time']) for t in period['tasks']))
+
+    def test_empty_snapshot_ok(self):
+        HistoryElement.query.delete()
+        self.db_session.commit()
+
+        snapshot = self.take_snapshot()
+
+        self.assertEqual(len(snapshot), 0)
+        self.assertEqual(snapshot.cumulative(), {})
+        self.assertEqual(snapshot.periodic(3600, datetime(2021, 3, 1), datetime(2021, 3, 2)), [{}] * 24)
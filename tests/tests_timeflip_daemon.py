@@ -0,0 +1,482 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import flask
+
+from tests import FlaskTestCase
+
+from timefliptt import timeflip
+from timefliptt.blueprints.base_models import TimeFlipDevice, HistoryElement, Category, Task, FacetToTask
+
+
+class FakeClient:
+    """Stands for `AsyncClient`, without BLE
+    """
+
+    delay = 0  # seconds that reading the battery level takes
+    calibration = 0
+    history_elements = [(1, 60, bytearray()), (2, 120, bytearray())]
+
+    def __init__(self, address: str):
+        self.address = address
+        self.connected = False
+        self.password = None
+
+        self.current_facet_value = 1
+        self.paused = False
+        self.locked = False
+        self.history_deleted = False
+
+    async def battery_level(self) -> int:
+        await asyncio.sleep(self.delay)
+        return 100
+
+    async def calibration_version(self) -> int:
+        return self.calibration
+
+    async def device_name(self) -> str:
+        return 'TimeFlip'
+
+    async def set_calibration_version(self, calibration: int):
+        self.calibration = calibration
+
+    async def set_password(self, password: str):
+        self.password = password
+
+    async def set_name(self, name: str):
+        pass
+
+    async def history(self) -> list:
+        return list(self.history_elements)
+
+    async def history_delete(self):
+        self.history_deleted = True
+
+    async def connect(self):
+        self.connected = True
+
+    async def setup(self, password: str, facet_callback=None):
+        self.password = password
+        self.facet_callback = facet_callback
+
+    async def disconnect(self):
+        self.connected = False
+
+
+class FakeBLEDevice:
+    def __init__(self, address: str, name: str, is_timeflip: bool = True, delay: float = 0):
+        self.address = address
+        self.name = name
+        self.is_timeflip = is_timeflip
+        self.delay = delay
+
+
+class FakeScanner:
+    """Stands for `BleakScanner`
+    """
+
+    devices = []
+    scans = 0
+
+    @classmethod
+    async def discover(cls) -> list:
+        cls.scans += 1
+        return list(cls.devices)
+
+
+class FakeBleakClient:
+    """Stands for `BleakClient`, counting the probes (and the ones that are running)
+    """
+
+    probes = 0
+    running = 0
+    max_running = 0
+
+    def __init__(self, device: FakeBLEDevice):
+        self.device = device
+
+    async def __aenter__(self) -> 'FakeBleakClient':
+        FakeBleakClient.probes += 1
+        FakeBleakClient.running += 1
+        FakeBleakClient.max_running = max(FakeBleakClient.running, FakeBleakClient.max_running)
+        return self
+
+    async def __aexit__(self, *args):
+        FakeBleakClient.running -= 1
+
+    async def read_gatt_char(self, characteristic: str) -> bytearray:
+        await asyncio.sleep(self.device.delay)
+        if not self.device.is_timeflip:
+            raise timeflip.BleakError('not a TimeFlip')
+
+        return bytearray(1)
+
+
+class DaemonTestCase(FlaskTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.patcher = mock.patch('timefliptt.timeflip.AsyncClient', FakeClient)
+        self.patcher.start()
+
+        timeflip.daemon_start(max_connections=2)
+
+        self.devices = [self.admin]
+        for i in range(1, 3):
+            device = TimeFlipDevice.create(':'.join(['0{}'.format(i)] * 6), '000000', 'tf{}'.format(i))
+            self.db_session.add(device)
+            self.devices.append(device)
+
+        self.db_session.commit()
+
+    def tearDown(self):
+        timeflip.daemon_stop()
+        self.patcher.stop()
+        FakeClient.delay = 0
+        super().tearDown()
+
+    @staticmethod
+    def wait_operations():
+        for operation in list(timeflip._operations.values()):
+            operation.future.exception(5)
+
+    @staticmethod
+    async def get_client(client: FakeClient) -> FakeClient:
+        return client
+
+    def test_stop_while_busy_ok(self):
+        async def busy():
+            time.sleep(.2)  # (blocks the loop, while the daemon is being stopped)
+            return timeflip.daemon_status()
+
+        operation = timeflip._submit(None, 'busy', busy)
+        time.sleep(.05)
+
+        stopping = threading.Thread(target=timeflip.daemon_stop, daemon=True)
+        stopping.start()
+        stopping.join(5)
+
+        self.assertFalse(stopping.is_alive())
+        self.assertEqual(operation.future.result(1), {'daemon_status': 'stopped'})
+
+    def test_pool_ok(self):
+        clients = []
+        for device in self.devices[:2]:
+            self.assertTrue(timeflip.hard_connect(device.address, device.password).result())
+            clients.append(timeflip.run_coro(device.address, self.get_client))
+
+        # both are connected
+        self.assertEqual([c.address for c in clients], [d.address for d in self.devices[:2]])
+        self.assertTrue(all(c.connected for c in clients))
+        self.assertEqual(timeflip.daemon_status()['address'], self.devices[1].address)
+
+        # use the first one, so that the second one is the least recently used, and gets disconnected
+        timeflip.run_coro(self.devices[0].address, self.get_client)
+        timeflip.hard_connect(self.devices[2].address, self.devices[2].password)
+        self.wait_operations()
+
+        self.assertFalse(clients[1].connected)
+        self.assertTrue(clients[0].connected)
+        self.assertFalse(timeflip.connected_to(self.devices[1].address))
+
+        status = timeflip.daemon_status()
+        self.assertEqual(status['daemon_status'], 'connected')
+        self.assertEqual(
+            [c['address'] for c in status['connections']], [self.devices[0].address, self.devices[2].address])
+
+        # logout from a single device
+        for operation in timeflip.hard_logout(self.devices[0].address):
+            operation.result(5)
+
+        self.assertFalse(clients[0].connected)
+        self.assertEqual([c['address'] for c in timeflip.daemon_status()['connections']], [self.devices[2].address])
+
+    def test_concurrent_devices_ok(self):
+        for device in self.devices[:2]:
+            timeflip.hard_connect(device.address, device.password)
+
+        # the operation on the first device waits for the one on the second device (so they must run concurrently)
+        async def create_event() -> asyncio.Event:
+            return asyncio.Event()
+
+        event = asyncio.run_coroutine_threadsafe(create_event(), timeflip._loop).result()
+
+        async def wait(client: FakeClient):
+            await asyncio.wait_for(event.wait(), 5)
+
+        async def release(client: FakeClient):
+            event.set()
+
+        thread = threading.Thread(target=timeflip.run_coro, args=(self.devices[0].address, wait))
+        thread.start()
+
+        timeflip.run_coro(self.devices[1].address, release)
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(event.is_set())
+
+    def test_reconnect_ok(self):
+        timeflip.soft_connect(self.admin.address, self.admin.password)
+        self.assertEqual(timeflip.daemon_status()['connections'], [{'address': self.admin.address, 'connected': False}])
+
+        # connects at first request
+        client = timeflip.run_coro(self.admin.address, self.get_client)
+        self.assertTrue(client.connected)
+        self.assertEqual(client.password, self.admin.password)
+
+    def test_status_view_ok(self):
+        for device in self.devices[1:]:
+            timeflip.hard_connect(device.address, device.password)
+
+        response = self.client.get(flask.url_for('api.timeflips-daemon'))
+        self.assertEqual(response.status_code, 200)
+
+        data = response.get_json()
+        self.assertEqual(data['daemon_status'], 'connected')
+        self.assertEqual(data['timeflip_device']['id'], self.devices[2].id)
+        self.assertEqual([c['timeflip_device']['id'] for c in data['connections']], [d.id for d in self.devices[1:]])
+
+        # disconnect from one device, then from all of them
+        response = self.client.delete(flask.url_for('api.timeflips-daemon') + '?timeflip={}'.format(self.devices[1].id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(timeflip.daemon_status()['address'], self.devices[2].address)
+
+        response = self.client.delete(flask.url_for('api.timeflips-daemon'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(timeflip.daemon_status()['daemon_status'], 'disconnected')
+
+        response = self.client.delete(flask.url_for('api.timeflips-daemon') + '?timeflip=9999')
+        self.assertEqual(response.status_code, 404)
+
+    def test_add_view_keeps_connections_ok(self):
+        for device in self.devices[1:]:
+            timeflip.hard_connect(device.address, device.password)
+
+        self.wait_operations()
+
+        # the discovery runs on the daemon loop, along with the connections
+        response = self.client.get(flask.url_for('visitors.timeflip-add'))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(
+            [c['address'] for c in timeflip.daemon_status()['connections']], [d.address for d in self.devices[1:]])
+
+    def test_operation_ok(self):
+        timeflip.soft_connect(self.admin.address, self.admin.password)
+
+        async def create_event() -> asyncio.Event:
+            return asyncio.Event()
+
+        event = asyncio.run_coroutine_threadsafe(create_event(), timeflip._loop).result()
+
+        async def wait(client: FakeClient) -> str:
+            await asyncio.wait_for(event.wait(), 5)
+            return client.address
+
+        calls = []
+        operation = timeflip.submit(self.admin.address, wait, then=lambda r: calls.append(r) or len(calls))
+
+        # submitting does not wait
+        with self.assertRaises(timeflip.OperationPending):
+            operation.result(0)
+
+        self.assertEqual(operation.to_dict()['status'], 'pending')
+        self.assertEqual(timeflip.get_operation(operation.id), operation)
+
+        # once done, `then` is called only once
+        timeflip._loop.call_soon_threadsafe(event.set)
+
+        self.assertEqual(operation.result(5), 1)
+        self.assertEqual(operation.result(), 1)
+        self.assertEqual(calls, [self.admin.address])
+        self.assertEqual(operation.to_dict()['status'], 'done')
+
+        # an operation fails if the one it comes after does
+        async def fail(client: FakeClient):
+            raise timeflip.TimeFlipRuntimeError('failed')
+
+        failed = timeflip.submit(self.admin.address, fail)
+        operation = timeflip.submit(self.admin.address, wait, after=failed)
+
+        with self.assertRaises(timeflip.TimeFlipRuntimeError):
+            operation.result(5)
+
+        self.assertEqual(operation.to_dict()['status'], 'failed')
+
+        # the device must be connected
+        with self.assertRaises(timeflip.NotConnectedError):
+            timeflip.submit(self.devices[1].address, wait).result(5)
+
+    def test_handle_view_pending_ok(self):
+        self.app.config['OPERATION_DEADLINE'] = 0
+        FakeClient.delay = .2
+
+        # (a new device, which gets a name and a calibration)
+        device = TimeFlipDevice.create(':'.join(['0a'] * 6), '000000')
+        self.db_session.add(device)
+        self.db_session.commit()
+
+        response = self.client.post(flask.url_for('api.timeflip-handle', id=device.id))
+        self.assertEqual(response.status_code, 202)
+
+        data = response.get_json()
+        self.assertEqual(data['status'], 'pending')
+        self.assertEqual(data['operation']['name'], 'setup_and_get_info')
+        self.assertTrue(response.headers['Location'].endswith(data['url']))
+
+        # poll
+        response = self.client.get(data['url'] + '?wait=5')
+        self.assertEqual(response.status_code, 200)
+
+        data = response.get_json()
+        self.assertEqual(data['status'], 'ok')
+        self.assertEqual(data['address'], device.address)
+        self.assertEqual(data['name'], 'TimeFlip')
+        self.assertEqual(data['battery'], 100)
+        self.assertTrue(data['calibration_ok'])
+
+        response = self.client.get(flask.url_for('api.timeflips-operation', id='x'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_handle_not_polled_ok(self):
+        calibration = self.admin.calibration = 1
+        self.db_session.add(self.admin)
+        self.db_session.commit()
+
+        timeflip.hard_connect(self.admin.address, self.admin.password).result(5)
+        self.app.config['OPERATION_DEADLINE'] = 0
+
+        response = self.client.put(flask.url_for('api.timeflip-handle', id=self.admin.id), json={
+            'name': 'new', 'password': '123456', 'change_calibration': True})
+        self.assertEqual(response.status_code, 202)
+
+        # what was set on the device is saved by the operation, even if nobody fetches its outcome
+        timeflip.get_operation(response.get_json()['operation']['id']).future.result(5)
+
+        self.db_session.expire_all()
+        device = TimeFlipDevice.query.get(self.admin.id)
+        self.assertEqual(device.name, 'new')
+        self.assertEqual(device.password, '123456')
+        self.assertNotEqual(device.calibration, calibration)
+        self.assertEqual(timeflip.run_coro(device.address, self.get_client).calibration, device.calibration)
+
+    def test_history_view_ok(self):
+        self.admin.calibration = FakeClient.calibration
+        self.db_session.add(self.admin)
+        self.db_session.commit()
+
+        timeflip.hard_connect(self.admin.address, self.admin.password).result(5)
+
+        response = self.client.post(flask.url_for('api.timeflip-history', id=self.admin.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()['history_elements']), 2)
+
+        # polling a finished operation does not store the history twice
+        operation = list(timeflip._operations.values())[-1]
+        response = self.client.get(flask.url_for('api.timeflips-operation', id=operation.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(HistoryElement.query.count(), 2)
+
+        # wrong calibration
+        self.admin.calibration = 42
+        self.db_session.add(self.admin)
+        self.db_session.commit()
+
+        response = self.client.post(flask.url_for('api.timeflip-history', id=self.admin.id))
+        self.assertEqual(response.status_code, 409)
+
+    def test_history_view_not_polled_ok(self):
+        self.admin.calibration = FakeClient.calibration
+        self.db_session.add(self.admin)
+        self.db_session.commit()
+
+        timeflip.hard_connect(self.admin.address, self.admin.password).result(5)
+
+        self.app.config['OPERATION_DEADLINE'] = 0
+        response = self.client.post(flask.url_for('api.timeflip-history', id=self.admin.id))
+        self.assertEqual(response.status_code, 202)
+
+        # the history is stored by the operation, even if nobody fetches its outcome
+        operation = timeflip.get_operation(response.get_json()['operation']['id'])
+        operation.future.result(5)
+
+        self.assertEqual(HistoryElement.query.count(), 2)
+
+    def test_current_view_ok(self):
+        category = Category.create('x')
+        self.db_session.add(category)
+        self.db_session.commit()
+
+        task = Task.create('x', category, '#000000')
+        self.db_session.add(task)
+        self.db_session.add(FacetToTask.create(self.admin, 2, task))
+        self.db_session.commit()
+
+        response = self.client.get(flask.url_for('api.timeflip-current', id=self.admin.id))
+        self.assertEqual(response.status_code, 401)
+
+        client = timeflip.run_coro(
+            self.admin.address, self.get_client, after=timeflip.hard_connect(self.admin.address, self.admin.password))
+
+        # current facet, as given by the connection
+        data = self.client.get(flask.url_for('api.timeflip-current', id=self.admin.id)).get_json()
+        self.assertEqual(data['facet'], client.current_facet_value)
+        self.assertIsNone(data['task'])
+        self.assertEqual(data['segments'], [])
+
+        # notifications (on the loop of the daemon)
+        async def notify(facet: int):
+            client.facet_callback(client.address, facet)
+
+        for facet in (2, 2, 3):
+            asyncio.run_coroutine_threadsafe(notify(facet), timeflip._loop).result()
+
+        data = self.client.get(flask.url_for('api.timeflip-current', id=self.admin.id)).get_json()
+        self.assertEqual(data['facet'], 3)
+        self.assertEqual([s['facet'] for s in data['segments']], [client.current_facet_value, 2])
+        self.assertEqual(data['segments'][1]['task']['id'], task.id)
+        self.assertEqual(data['segments'][1]['end'], data['start'])
+        self.assertGreaterEqual(data['duration'], 0)
+
+    def test_discovery_ok(self):
+        FakeScanner.devices = [FakeBLEDevice(self.admin.address, 'TimeFlip'), FakeBLEDevice('0b:00', 'other', False)]
+        FakeScanner.devices.extend(FakeBLEDevice('0c:0{}'.format(i), 'TimeFlip', delay=.05) for i in range(6))
+        FakeScanner.devices.append(FakeBLEDevice('0d:00', 'slow', delay=5))
+
+        FakeScanner.scans = 0
+        FakeBleakClient.probes = FakeBleakClient.running = FakeBleakClient.max_running = 0
+
+        self.app.config['DISCOVERY_TTL'] = 20
+        self.app.config['DISCOVERY_CONCURRENCY'] = 3
+        self.app.config['DISCOVERY_TIMEOUT'] = .5
+
+        with mock.patch('timefliptt.timeflip.BleakScanner', FakeScanner), \
+                mock.patch('timefliptt.timeflip.BleakClient', FakeBleakClient):
+            response = self.client.get(flask.url_for('api.devices'))
+            self.assertEqual(response.status_code, 200)
+
+            discovered = response.get_json()['discovered']
+            self.assertEqual(
+                [d['address'] for d in discovered], [d.address for d in FakeScanner.devices if d.name == 'TimeFlip'])
+            self.assertEqual(discovered[0]['id'], self.admin.id)
+            self.assertTrue(all(d['id'] == -1 for d in discovered[1:]))
+
+            # probes are concurrent, but bounded
+            self.assertEqual(FakeBleakClient.probes, len(FakeScanner.devices))
+            self.assertEqual(FakeBleakClient.max_running, 3)
+
+            # cached
+            self.assertEqual(self.client.get(flask.url_for('api.devices')).get_json()['discovered'], discovered)
+            self.assertEqual(FakeScanner.scans, 1)
+
+            # once the discovery is expired, scan again (but the devices that were probed recently are not probed again)
+            timeflip._discovery_date -= 30
+            FakeScanner.devices.append(FakeBLEDevice('0e:00', 'TimeFlip'))
+
+            response = self.client.get(flask.url_for('api.devices'))
+            self.assertEqual(len(response.get_json()['discovered']), len(discovered) + 1)
+            self.assertEqual(FakeScanner.scans, 2)
+            self.assertEqual(FakeBleakClient.probes, len(FakeScanner.devices))
@@ -1,12 +1,14 @@
 import argparse
 import atexit
+from datetime import datetime, date, time, timedelta
 
 import flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import Engine
 
 import timefliptt
 from timefliptt.config import Config
-from timefliptt.timeflip import daemon_start, daemon_stop, soft_connect
+from timefliptt.timeflip import daemon_start, daemon_stop, soft_connect, sync_start
 
 
 db = SQLAlchemy()
@@ -19,6 +21,10 @@ def create_app(config: Config) -> flask.Flask:
     # modules
     db.init_app(app)
 
+    if app.config.get('COUNT_QUERIES', False):
+        app.before_request(_reset_query_count)
+        app.after_request(_report_query_count)
+
     # urls
     from timefliptt.blueprints.visitors.views import blueprint
     app.register_blueprint(blueprint)
@@ -29,6 +35,24 @@ def create_app(config: Config) -> flask.Flask:
     return app
 
 
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if flask.has_request_context() and 'query_count' in flask.g:
+        flask.g.query_count += 1
+
+
+def _reset_query_count():
+    flask.g.query_count = 0
+
+
+def _report_query_count(response: flask.Response) -> flask.Response:
+    """Report the number of SQL queries issued during the request in the `X-Query-Count` header
+    """
+
+    response.headers['X-Query-Count'] = flask.g.pop('query_count', 0)
+    return response
+
+
 def get_arguments_parser():
     parser = argparse.ArgumentParser(description=timefliptt.__doc__)
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + timefliptt.__version__)
@@ -36,20 +60,162 @@ def get_arguments_parser():
     parser.add_argument('-i', '--settings', help='Settings', type=argparse.FileType('r'))
 
     parser.add_argument('-I', '--init', action='store_true', help='Initialize the application')
+    parser.add_argument('-M', '--migrate', action='store_true', help='Upgrade the database of the application')
+    parser.add_argument(
+        '-X', '--import-history', metavar='FILE', help='Import history elements from a CSV or NDJSON (*.ndjson) file')
+    parser.add_argument(
+        '-A', '--archive-history', action='store_true', help='Move the old history elements to yearly archives')
+    parser.add_argument(
+        '-C', '--compact-history', action='store_true', help='Merge the history elements that touch end to end')
+    parser.add_argument(
+        '-S', '--snapshot', metavar='DIR', help='Write a columnar snapshot of the history, for analytics')
 
     return parser
 
 
 def init_app():
-    """Initialize the app
+    """Initialize the app: create the database, or upgrade it if it already exists
+    """
+
+    from timefliptt.migrations import stamp
+
+    if not db.inspect(db.engine).has_table('history_element'):
+        db.create_all()
+        stamp(db.session.connection())
+        db.session.commit()
+    else:
+        migrate_app()
+
+
+def migrate_app():
+    """Upgrade the database of the app
+    """
+
+    from timefliptt.migrations import upgrade
+
+    db.create_all()  # new tables
+
+    for description in upgrade(db.session.connection()):
+        print('migrated:', description)
+
+    db.session.commit()
+
+
+def import_history(path: str):
+    """Import history elements from a file (in the format of the export)
+    """
+
+    from timefliptt.blueprints.history_import import HistoryImporter, HistoryImportError
+    from timefliptt.blueprints.api.cache import mark_data_changed
+
+    format = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+    importer = HistoryImporter(db.session.connection())
+
+    try:
+        with open(path, encoding='utf-8', newline='') as f:
+            importer.run(HistoryImporter.read(f, format))
+    except HistoryImportError as e:
+        db.session.rollback()
+        for line, errors in e.errors.items():
+            print('error: row {}: {}'.format(line, errors))
+        raise SystemExit(1)
+
+    mark_data_changed()
+    db.session.commit()
+
+    print('imported: {} element(s), skipped: {}'.format(importer.imported, importer.skipped))
+
+
+def compact_history():
+    """Merge the history elements that touch end to end (and have the same facet and task)
+    """
+
+    from timefliptt.blueprints.history_compaction import HistoryCompactor
+    from timefliptt.blueprints.api.cache import mark_data_changed
+
+    compactor = HistoryCompactor(db.session.connection())
+    compactor.run()
+
+    mark_data_changed()
+    db.session.commit()
+
+    print('compacted: {} run(s), removed: {} element(s)'.format(compactor.merged, compactor.removed))
+
+
+def archive_history():
+    """Move the history elements that ended more than `ARCHIVE_AFTER` days ago to yearly archives
+    """
+
+    from timefliptt.blueprints.history_archive import HistoryArchiver
+    from timefliptt.blueprints.api.cache import mark_data_changed
+
+    cutoff = datetime.combine(date.today() - timedelta(days=flask.current_app.config['ARCHIVE_AFTER']), time())
+    archived = 0
+
+    while True:  # a limited number of years per transaction
+        archiver = HistoryArchiver(db.session.connection(), flask.current_app.config['ARCHIVE_DIR'])
+        archived += archiver.run(cutoff)
+
+        mark_data_changed()
+        db.session.commit()
+
+        if archiver.remaining == 0:
+            break
+
+    # give the space back
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql('VACUUM')
+
+    print('archived: {} element(s) that ended before {}'.format(archived, cutoff.isoformat()))
+
+
+def snapshot_history(directory: str):
+    """Write a columnar snapshot of the history (including the archives) in `directory`
+    """
+
+    from timefliptt.snapshot import write_snapshot
+    from timefliptt.blueprints.base_models import HistoryElement, Task
+    from timefliptt.blueprints.api.views.views_history import HistoryElementMixin
+
+    elements, _ = HistoryElementMixin.query_elements()
+    elements = elements.with_entities(
+        HistoryElement.id,
+        HistoryElement.start,
+        HistoryElement.end,
+        HistoryElement.original_facet,
+        HistoryElement.task_id,
+        HistoryElement.timeflip_device_id
+    )
+
+    tasks = dict(db.session.query(Task.id, Task.category_id))
+    num_elements = elements.count()
+
+    write_snapshot(
+        directory, elements.order_by(HistoryElement.start, HistoryElement.id).yield_per(5000), num_elements, tasks)
+
+    print('snapshot: {} element(s) written in {}'.format(num_elements, directory))
+
+
+def start_history_sync(app: flask.Flask):
+    """Periodically pull the history of the connected devices (every `HISTORY_SYNC_INTERVAL` seconds), and store it
     """
 
-    db.create_all()
+    from timefliptt.blueprints.history_sync import HistoryWriter
+
+    writer = HistoryWriter(app, app.config['HISTORY_SYNC_BATCH_SIZE'])
+    writer.start()
+
+    sync_start(app.config['HISTORY_SYNC_INTERVAL'], writer.put)
 
+    return writer
 
-def stop_app():
+
+def stop_app(writer=None):
     daemon_stop()
 
+    if writer is not None:
+        writer.stop()
+
 
 def main():
     # get args
@@ -65,17 +231,44 @@ def main():
 
     @app.before_first_request
     def setup_thread():
-        atexit.register(stop_app)
-        daemon_start()
+        from timefliptt.blueprints.base_models import TimeFlipDevice
+
+        daemon_start(app.config['MAX_CONNECTIONS'])
+
+        writer = None
+        if app.config['HISTORY_SYNC_INTERVAL'] > 0:
+            writer = start_history_sync(app)
+
+        atexit.register(stop_app, writer)
 
         if 'address' in flask.session:
-            soft_connect(flask.session['address'], flask.session.get('password', ''))
+            device = TimeFlipDevice.query.filter(TimeFlipDevice.address == flask.session['address']).first()
+            soft_connect(
+                flask.session['address'],
+                flask.session.get('password', ''),
+                device.calibration if device is not None else None
+            )
 
-    if not args.init:  # run webserver
-        app.run()
-    else:  # init app
+    if args.init:
         with app.app_context():
             init_app()
+    elif args.migrate:
+        with app.app_context():
+            migrate_app()
+    elif args.import_history:
+        with app.app_context():
+            import_history(args.import_history)
+    elif args.archive_history:
+        with app.app_context():
+            archive_history()
+    elif args.compact_history:
+        with app.app_context():
+            compact_history()
+    elif args.snapshot:
+        with app.app_context():
+            snapshot_history(args.snapshot)
+    else:  # run webserver
+        app.run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,267 @@
+import functools
+import hashlib
+import uuid
+from collections import OrderedDict
+from threading import Lock, Event
+
+from typing import Type, Iterable, Dict, Hashable, List, Any, Tuple, Callable
+
+import flask
+from flask import current_app, has_app_context, Response
+from marshmallow import Schema, fields
+from sqlalchemy.orm import Session, selectinload
+
+from timefliptt.app import db
+from timefliptt.blueprints.base_models import Category, Task, TimeFlipDevice, DataVersion
+
+CATALOG_MODELS = (Category, Task, TimeFlipDevice)
+
+
+class DumpCache:
+    """Cache the dumps of catalog objects (categories, tasks and TimeFlip devices),
+    keyed by schema, id and modification date.
+
+    Since a category dump contains its tasks, any write on the catalog invalidates the whole cache.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._dumps: Dict[Tuple[Any, ...], dict] = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._dumps = {}
+
+    def dump(self, schema: Type[Schema], obj: Any, exclude: Tuple[str, ...] = ()) -> dict:
+        """Get the dump of `obj` by `schema`. It is a (shallow) copy, which can thus be extended
+        """
+
+        key = (schema, exclude, obj.id, obj.date_modified)
+
+        with self._lock:
+            dumped = self._dumps.get(key, None)
+
+        if dumped is None:
+            dumped = schema(exclude=exclude).dump(obj)
+            with self._lock:
+                self._dumps[key] = dumped
+
+        return dict(dumped)
+
+    def dump_many(
+            self, schema: Type[Schema], ids: Iterable[Hashable], exclude: Tuple[str, ...] = ()) -> Dict[Hashable, dict]:
+        """Fetch the objects of the model of `schema` in one query, and get their dumps
+        """
+
+        model = schema.Meta.model
+        ids = set(ids)
+        ids.discard(None)
+
+        if len(ids) == 0:
+            return {}
+
+        # load the nested relationships (e.g., the tasks of the categories) in bulk as well
+        options = [
+            selectinload(getattr(model, field.attribute or name))
+            for name, field in schema._declared_fields.items()
+            if isinstance(field, fields.Nested) and name not in exclude
+        ]
+
+        objects = model.query.options(*options).filter(model.id.in_(ids)).all()
+        return dict((obj.id, self.dump(schema, obj, exclude)) for obj in objects)
+
+    def dump_related(
+            self,
+            schema: Type[Schema],
+            objects: List[Any],
+            related: Dict[str, Tuple[Type[Schema], str]],
+            exclude: Tuple[str, ...] = ()
+    ) -> List[dict]:
+        """Dump `objects` with `schema`, except the nested catalog objects listed in `related`
+        (which maps the name of the field to its schema and the attribute holding the foreign key),
+        which are taken from the cache.
+        """
+
+        dumps = schema(many=True, exclude=exclude + tuple(related)).dump(objects)
+
+        for name, (nested_schema, key) in related.items():
+            if name in exclude:
+                continue
+
+            nested = self.dump_many(nested_schema, (getattr(obj, key) for obj in objects))
+            for obj, dumped in zip(objects, dumps):
+                dumped[name] = nested.get(getattr(obj, key), None)
+
+        return dumps
+
+
+def dump_cache() -> DumpCache:
+    """Get the cache of the current app
+    """
+
+    return current_app.extensions.setdefault('timefliptt_dump_cache', DumpCache())
+
+
+class ResponseCache:
+    """Cache the responses of GET views, keyed by endpoint and (parsed) arguments.
+
+    Entries are valid for a given version of the data, which is bumped in the transaction of each write
+    (see `DataVersion`), so that the writes of other processes (e.g., the command line) are accounted for as well.
+    Responses carry an ETag derived from this version, so that clients can poll with `If-None-Match`.
+    Identical requests that arrive while a response is being computed wait for it instead of computing it again.
+    """
+
+    MAX_SIZE = 256
+    WAIT_TIMEOUT = 60
+
+    def __init__(self):
+        self._lock = Lock()
+        self._token = uuid.uuid4().hex[:8]  # so that ETags do not survive a restart
+        self._responses: Dict[Hashable, Tuple[int, Response]] = OrderedDict()
+        self._pending: Dict[Hashable, Event] = {}
+
+        self.version = 0  # the last one that was seen
+
+    def validate(self, version: int):
+        """Drop the cached responses if the data changed, `version` being the current one
+        """
+
+        with self._lock:
+            if version > self.version:
+                self.version = version
+                self._responses.clear()
+
+    def etag(self, key: Hashable, version: int) -> str:
+        return '{}-{}-{}'.format(self._token, version, hashlib.sha1(repr(key).encode()).hexdigest()[:16])
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Response]) -> Tuple[Response, str]:
+        """Get the cached response, or compute it.
+        Returns the response and its ETag (a streamed response is not cached, but still gets an ETag).
+        """
+
+        while True:
+            with self._lock:
+                version = self.version
+
+                if key in self._responses and self._responses[key][0] == version:
+                    self._responses.move_to_end(key)
+                    return self._responses[key][1], self.etag(key, version)
+
+                event = self._pending.get(key, None)
+                if event is None:
+                    event = self._pending[key] = Event()
+                    break
+
+            # someone else is computing the very same response
+            event.wait(self.WAIT_TIMEOUT)
+
+        try:
+            response = compute()
+
+            if response.status_code == 200 and not response.is_streamed:
+                with self._lock:
+                    self._responses[key] = (version, response)
+                    while len(self._responses) > self.MAX_SIZE:
+                        self._responses.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+        return response, self.etag(key, version)
+
+
+def response_cache() -> ResponseCache:
+    """Get the response cache of the current app
+    """
+
+    return current_app.extensions.setdefault('timefliptt_response_cache', ResponseCache())
+
+
+def _normalize(value: Any) -> Hashable:
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted(_normalize(v) for v in value))
+    elif isinstance(value, dict):
+        return tuple(sorted((k, _normalize(v)) for k, v in value.items()))
+    else:
+        return value
+
+
+def cached_response(view: Callable[..., Response]) -> Callable[..., Response]:
+    """Cache the response of a GET view for the current version of the data, and handle `If-None-Match`.
+    It should be applied after the arguments are parsed, so that they are normalized.
+    """
+
+    @functools.wraps(view)
+    def wrapper(self, *args, **kwargs) -> Response:
+        cache = response_cache()
+        cache.validate(DataVersion.get(db.session.connection()))
+
+        key = (flask.request.endpoint, _normalize(args), _normalize(kwargs))
+
+        etag = cache.etag(key, cache.version)
+        if etag in flask.request.if_none_match:
+            response = Response(status=304)
+        else:
+            response, etag = cache.get_or_compute(key, lambda: view(self, *args, **kwargs))
+
+            if not response.is_streamed:  # a (cached) response object is shared, so copy it
+                response = Response(response.get_data(), status=response.status_code, mimetype=response.mimetype)
+
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response.make_conditional(flask.request)
+
+    return wrapper
+
+
+@db.event.listens_for(Session, 'after_flush')
+def _data_flushed(session: Session, flush_context):
+    objects = (*session.new, *session.dirty, *session.deleted)
+
+    if len(objects) > 0:
+        session.info['data_changed'] = True
+
+    if any(isinstance(obj, CATALOG_MODELS) for obj in objects):
+        session.info['catalog_changed'] = True
+
+        if has_app_context():
+            dump_cache().invalidate()
+
+
+@db.event.listens_for(Session, 'after_bulk_update')
+@db.event.listens_for(Session, 'after_bulk_delete')
+def _data_bulk_changed(update_context):
+    update_context.session.info['data_changed'] = True
+
+
+def mark_data_changed(session: Session = None):
+    """Signal changes that do not go through the ORM (e.g., Core statements), so that cached responses are dropped
+    when they are committed
+    """
+
+    (session or db.session).info['data_changed'] = True
+
+
+@db.event.listens_for(Session, 'before_commit')
+def _data_committing(session: Session):
+    session.flush()  # (so that the changes are known)
+
+    if session.info.pop('data_changed', False):
+        DataVersion.bump(session.connection())
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _data_committed(session: Session):
+    if not has_app_context():
+        return
+
+    # invalidate again, in case a concurrent request cached objects between flush and commit
+    if session.info.pop('catalog_changed', False):
+        dump_cache().invalidate()
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _data_rolled_back(session: Session):
+    session.info.pop('catalog_changed', None)
+    session.info.pop('data_changed', None)
@@ -1,6 +1,6 @@
 import re
 
-from marshmallow import ValidationError, validate
+from marshmallow import ValidationError, validate, fields
 from marshmallow_sqlalchemy import SQLAlchemySchemaOpts, SQLAlchemySchema, auto_field
 from marshmallow_sqlalchemy.fields import Nested
 
@@ -8,7 +8,8 @@ from webargs.flaskparser import FlaskParser
 from marshmallow import EXCLUDE
 
 from timefliptt.app import db
-from timefliptt.blueprints.base_models import Category, Task, TimeFlipDevice, FacetToTask, HistoryElement
+from timefliptt.blueprints.base_models import Category, Task, TimeFlipDevice, FacetToTask, HistoryElement, \
+    EpochDateTime
 
 
 class Parser(FlaskParser):
@@ -26,6 +27,14 @@ class BaseSchema(SQLAlchemySchema):
     OPTIONS_CLASS = BaseOpts
 
 
+class NaiveDateTime(fields.DateTime):
+    """Datetime, an aware one being converted to a naive one in UTC (as the history is stored)
+    """
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        return EpochDateTime.naive(super()._deserialize(value, attr, data, **kwargs))
+
+
 HEX_COLOR = re.compile(r'^#[0-9a-fA-F]{6}$')
 
 
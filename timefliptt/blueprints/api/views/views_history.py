@@ -1,7 +1,12 @@
+import base64
+import csv
+import io
+import json
 import math
+import os
 from datetime import datetime
 
-from typing import List, Tuple
+from typing import List, Tuple, Any, Iterable, Iterator, Optional
 
 import flask
 from flask import jsonify, Response
@@ -9,12 +14,17 @@ from flask.views import MethodView
 import flask_sqlalchemy
 
 from webargs import fields
+from webargs.flaskparser import abort
 from marshmallow import Schema, validate, validates_schema, ValidationError, post_load
+from sqlalchemy.exc import OperationalError
 
 from timefliptt.app import db
 from timefliptt.blueprints.api.views import blueprint
-from timefliptt.blueprints.api.schemas import HistoryElementSchema, Parser
-from timefliptt.blueprints.base_models import HistoryElement, Task
+from timefliptt.blueprints.api.schemas import HistoryElementSchema, TaskSchema, Parser, NaiveDateTime
+from timefliptt.blueprints.api.cache import dump_cache, mark_data_changed
+from timefliptt.blueprints.base_models import HistoryElement, HistoryRollup, HistoryArchive, Task, Category
+from timefliptt.blueprints.history_compaction import HistoryCompactor
+from timefliptt.blueprints.history_import import HistoryImporter, HistoryImportError
 
 parser = Parser()
 
@@ -22,15 +32,19 @@ parser = Parser()
 class HistoryElementMixin:
 
     class FilterHistoryElementSchema(Schema):
-        start = fields.DateTime()
+        start = NaiveDateTime()
         start_date = fields.Date()
-        end = fields.DateTime()
+        end = NaiveDateTime()
         end_date = fields.Date()
 
         task = fields.List(fields.Integer(validate=validate.Range(min=0)))
         timeflip = fields.List(fields.Integer(validate=validate.Range(min=0)))
         category = fields.List(fields.Integer(validate=validate.Range(min=0)))
 
+        # (at least a word, since an empty full-text query is a syntax error)
+        q = fields.Str(validate=[
+            validate.Length(min=1, max=256), validate.Predicate('strip', error='Search for at least a word')])
+
         @validates_schema
         def exclusive_date(self, data, **kwargs):
             if 'start' in data and 'start_date' in data:
@@ -40,13 +54,10 @@ class HistoryElementMixin:
                 raise ValidationError('cannot define both end and end_date', 'end')
 
     @staticmethod
-    def query_elements(**kwargs) -> Tuple[flask_sqlalchemy.BaseQuery, Tuple[datetime, datetime]]:
-        """Get the history elements that fit into the filters.
-        Returns the list of elements that fulfill the filters and the time frame.
+    def time_frame(**kwargs) -> Tuple[datetime, datetime]:
+        """Get the time frame defined by the filters
         """
-        query = HistoryElement.query
 
-        # -- Time frame
         start = datetime.min
         end = datetime.max
 
@@ -63,120 +74,539 @@ class HistoryElementMixin:
         if end < start:
             start, end = end, start
 
-        query = query.filter(HistoryElement.end > start).filter(HistoryElement.start < end)
+        return start, end
+
+    @staticmethod
+    def filter_elements(query: flask_sqlalchemy.BaseQuery, model: Any, **kwargs) -> flask_sqlalchemy.BaseQuery:
+        """Apply the timeflip, task and category filters to a query on `model`, which should have a
+        `timeflip_device_id` and a `task_id` column (e.g., `HistoryElement`).
+        """
 
         # -- Timeflips
         if 'timeflip' in kwargs:
-            query = query.filter(HistoryElement.timeflip_device_id.in_(kwargs.get('timeflip')))
+            query = query.filter(model.timeflip_device_id.in_(kwargs.get('timeflip')))
 
         # -- Tasks
         if 'task' in kwargs:
-            query = query.filter(HistoryElement.task_id.in_(kwargs.get('task')))
+            query = query.filter(model.task_id.in_(kwargs.get('task')))
 
         # -- Category
         if 'category' in kwargs:
-            query = query.join(Task).filter(Task.category_id.in_(kwargs.get('category')))
+            query = query.filter(model.task_id.in_(
+                db.session.query(Task.id).filter(Task.category_id.in_(kwargs.get('category')))))
+
+        return query
+
+    @staticmethod
+    def frame_criteria(
+            table: Any,
+            time_frame: Tuple[datetime, datetime],
+            q: str = None,
+            archive: int = None,
+            rtree: bool = True
+    ) -> List[Any]:
+        """Get the criteria on the time frame and comments (`q`), for `table`, which is the one of `HistoryElement`
+        or the one of an attached archive (of year `archive`).
+        `rtree` is unset for the table of an archive that is read from its own file, which has no R*Tree.
+        """
+
+        start, end = time_frame
+        criteria = [table.c.end > start, table.c.start < end]
+
+        # narrow down to the elements that overlap the time frame with the R*Tree (archives are indexed on the dates)
+        if rtree and archive is None and start != datetime.min and end != datetime.max:
+            criteria.append(table.c.id.in_(HistoryElement.overlapping_ids(start, end)))
+
+        # search in comments with the full-text index
+        if q is not None:
+            criteria.append(table.c.id.in_(HistoryElement.matching_ids(q, archive)))
+
+        return criteria
+
+    @classmethod
+    def query_elements(
+            cls,
+            options: Iterable[Any] = (),
+            archives: bool = True,
+            **kwargs
+    ) -> Tuple[flask_sqlalchemy.BaseQuery, Tuple[datetime, datetime]]:
+        """Get the history elements that fit into the filters.
+        Returns the list of elements that fulfill the filters and the time frame.
+
+        `options` are the loading strategies of the relationships of the elements (e.g., `selectinload(...)`),
+        which are only relevant if the elements themselves are fetched.
+
+        The archives that the time frame reaches are attached, and their elements are included (the query is then
+        made on the union of the tables), unless `archives` is `False`.
+        Since SQLite limits the number of attached databases, the elements of the oldest archives beyond that limit
+        (or of the ones that cannot be attached, since the others are in use) are read from their files, and copied
+        into a temporary table (see `HistoryArchive.overflow()`), so the query should be run before the next one.
+        Archived elements are read-only.
+        """
+
+        start, end = cls.time_frame(**kwargs)
+        q = kwargs.get('q')
+
+        query = HistoryElement.query.options(*options)
+        reached = HistoryArchive.reaching(start, end) if archives else []
+
+        if len(reached) > 0:
+            connection = db.session.connection()
+            directory = os.path.abspath(flask.current_app.config['ARCHIVE_DIR'])
+
+            for archive in reached[-HistoryArchive.MAX_ATTACHED:]:
+                try:
+                    HistoryArchive.attach(connection, archive.year, os.path.join(directory, archive.file_name))
+                except OperationalError:  # the other archives are still in use, so it is read from its file
+                    pass
+
+            selects = [db.select(HistoryElement.__table__).where(
+                *cls.frame_criteria(HistoryElement.__table__, (start, end), q))]
+
+            attached = connection.info.get('timefliptt_archives', set())
+            overflow = []
+
+            for archive in reached:
+                if archive.year in attached:
+                    table = archive.table()
+                    selects.append(db.select(table).where(*cls.frame_criteria(table, (start, end), q, archive.year)))
+                else:
+                    overflow.extend(HistoryArchive.read(
+                        connection,
+                        archive.year,
+                        os.path.join(directory, archive.file_name),
+                        lambda table: db.select(table).where(*cls.frame_criteria(table, (start, end), q, rtree=False))
+                    ))
+
+            if len(overflow) > 0:
+                selects.append(db.select(HistoryArchive.overflow(connection, overflow)))
+
+            query = query.select_entity_from(db.union_all(*selects).subquery())
+        else:
+            query = query.filter(*cls.frame_criteria(HistoryElement.__table__, (start, end), q))
+
+        query = cls.filter_elements(query, HistoryElement, **kwargs)
 
         return query, (start, end)
 
 
+class Cursor(fields.Field):
+    """Opaque position in the list of history elements (which is sorted by id)
+    """
+
+    @staticmethod
+    def encode(element_id: int) -> str:
+        return base64.urlsafe_b64encode('h{}'.format(element_id).encode()).decode().rstrip('=')
+
+    def _deserialize(self, value: Any, attr, data, **kwargs) -> int:
+        try:
+            decoded = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode()
+            if decoded[:1] != 'h':
+                raise ValueError(decoded)
+
+            return int(decoded[1:])
+        except (TypeError, ValueError):
+            raise ValidationError('Invalid cursor')
+
+
 class HistoryElementsView(HistoryElementMixin, MethodView):
     PAGE_SIZE = 25
 
     class PaginateSchema(HistoryElementMixin.FilterHistoryElementSchema):
         page = fields.Integer(validate=validate.Range(min=0))
-        page_size = fields.Integer(validate=validate.Range(min=0))
+        page_size = fields.Integer(validate=validate.Range(min=1, max=1000))
+
+        after = Cursor()
+        before = Cursor()
+
+        count = fields.Boolean()
+
+        @validates_schema
+        def exclusive_position(self, data, **kwargs):
+            if len(set(data) & {'page', 'after', 'before'}) > 1:
+                raise ValidationError('cannot define more than one of page, after and before', 'page')
+
+    @staticmethod
+    def page_url(**kwargs) -> str:
+        """Get the URL of another page, with the same filters
+        """
+
+        args = flask.request.args.to_dict(flat=False)
+        for arg in ('page', 'after', 'before'):
+            args.pop(arg, None)
+
+        args.update(**kwargs)
+        return flask.url_for('api.history-els', **args)
 
     @parser.use_kwargs(PaginateSchema, location='query')
     def get(self, **kwargs) -> Response:
-        """Get the list of history elements
+        """Get the list of history elements, from the latest to the oldest.
+
+        Pages are either given by their number (`page`), or by a cursor: `after` (resp. `before`)
+        gives the elements following (resp. preceding) the one it refers to.
+        Since the cost of a page given by its number grows with the number, cursors should be preferred
+        (the `next_page` and `previous_page` links use them). The total count can be skipped with `count=false`.
         """
 
-        page = kwargs.get('page', 0)
         page_size = kwargs.get('page_size', self.PAGE_SIZE)
 
-        query, (start, end) = self.query_elements(desc=True, **kwargs)
+        # no loading strategy: tasks are fetched in bulk (if not cached) by `dump_related()`
+        query, (start, end) = self.query_elements(**kwargs)
 
-        num_results = query.count()
-        if page < 0 or page * page_size > num_results:
-            flask.abort(404)
-
-        results = query.order_by(HistoryElement.id.desc()).slice(page * page_size, (page + 1) * page_size).all()
+        num_results = None
+        if kwargs.get('count', True):
+            num_results = query.count()
 
-        FORMAT = '{}?page={}&page_size={}'
+        if 'after' in kwargs or 'before' in kwargs:
+            data = self.cursor_page(query, page_size, kwargs.get('after'), kwargs.get('before'))
+        else:
+            data = self.numbered_page(query, page_size, num_results, kwargs.get('page', 0))
 
-        previous_page = None
-        if page > 0:
-            previous_page = FORMAT.format(flask.url_for('api.history-els'), page - 1, page_size)
-        next_page = None
-        if num_results > 0 and (page + 1) * page_size < num_results:
-            next_page = FORMAT.format(flask.url_for('api.history-els'), page + 1, page_size)
+        results = data.pop('results')
 
         return jsonify(
             total_elements=num_results,
-            total_pages=int(math.ceil(num_results / page_size)),
-            current_page=page,
             page_size=page_size,
-            previous_page=previous_page,
-            next_page=next_page,
-            history=HistoryElementSchema(many=True).dump(results)
+            history=dump_cache().dump_related(HistoryElementSchema, results, {'task': (TaskSchema, 'task_id')}),
+            **data
         )
 
-    class SimpleHistoryElementsSchema(Schema):
+    def numbered_page(
+            self, query: flask_sqlalchemy.BaseQuery, page_size: int, num_results: Optional[int], page: int) -> dict:
+
+        if num_results is not None and page * page_size > num_results:
+            flask.abort(404)
+
+        # one more, to know if there is a next page
+        results = query.order_by(HistoryElement.id.desc()).slice(page * page_size, (page + 1) * page_size + 1).all()
+
+        if num_results is None and page > 0 and len(results) == 0:
+            flask.abort(404)
+
+        return dict(
+            total_pages=int(math.ceil(num_results / page_size)) if num_results is not None else None,
+            current_page=page,
+            **self.links(results[:page_size], page_size, has_previous=page > 0, has_next=len(results) > page_size)
+        )
+
+    def cursor_page(
+            self,
+            query: flask_sqlalchemy.BaseQuery,
+            page_size: int,
+            after: Optional[int],
+            before: Optional[int]
+    ) -> dict:
+
+        # one more, to know if there are more elements in that direction
+        if after is not None:
+            results = query.filter(HistoryElement.id < after).order_by(
+                HistoryElement.id.desc()).limit(page_size + 1).all()
+            has_next, has_previous = len(results) > page_size, None
+            results = results[:page_size]
+        else:
+            results = query.filter(HistoryElement.id > before).order_by(
+                HistoryElement.id.asc()).limit(page_size + 1).all()
+            has_next, has_previous = None, len(results) > page_size
+            results = results[:page_size][::-1]
+
+        if len(results) > 0:
+            if has_previous is None:
+                has_previous = query.filter(HistoryElement.id > results[0].id).with_entities(
+                    HistoryElement.id).first() is not None
+            if has_next is None:
+                has_next = query.filter(HistoryElement.id < results[-1].id).with_entities(
+                    HistoryElement.id).first() is not None
+
+        return self.links(results, page_size, has_previous, has_next)
+
+    def links(self, results: List[HistoryElement], page_size: int, has_previous: bool, has_next: bool) -> dict:
+        """Get the links to the previous and next pages, as cursors
+        """
+
+        previous_page = next_page = None
+
+        if len(results) > 0:
+            if has_previous:
+                previous_page = self.page_url(before=Cursor.encode(results[0].id), page_size=page_size)
+            if has_next:
+                next_page = self.page_url(after=Cursor.encode(results[-1].id), page_size=page_size)
+
+        return dict(previous_page=previous_page, next_page=next_page, results=results)
+
+    CHUNK_SIZE = 500
+
+    class SelectHistoryElementsSchema(HistoryElementMixin.FilterHistoryElementSchema):
         id = fields.List(fields.Integer(validate=validate.Range(min=0)))
 
-        @post_load
-        def make_objects(self, data, **kwargs):
-            return HistoryElement.query.filter(HistoryElement.id.in_(data['id'])).all()
+        @validates_schema
+        def any_selection(self, data, **kwargs):
+            if len(data) == 0:
+                raise ValidationError('select elements by id or with a filter', 'id')
+
+    def selected_elements(self, **kwargs) -> List[Tuple[int, datetime, datetime, int, int]]:
+        """Get the elements that are selected by their ids and/or the filters,
+        as `(id, start, end, task_id, timeflip_device_id)`
+        """
+
+        query, _ = self.query_elements(archives=False, **kwargs)
+        query = query.with_entities(
+            HistoryElement.id,
+            HistoryElement.start,
+            HistoryElement.end,
+            HistoryElement.task_id,
+            HistoryElement.timeflip_device_id
+        )
+
+        if 'id' not in kwargs:
+            return query.all()
+
+        ids = kwargs.get('id')
+        elements = []
+        for i in range(0, len(ids), self.CHUNK_SIZE):
+            elements.extend(query.filter(HistoryElement.id.in_(ids[i:i + self.CHUNK_SIZE])).all())
+
+        return elements
+
+    def chunks(self, elements: List[Tuple[int, datetime, datetime, int, int]]) -> Iterable[List[int]]:
+        for i in range(0, len(elements), self.CHUNK_SIZE):
+            yield [element[0] for element in elements[i:i + self.CHUNK_SIZE]]
 
     class ModifyHistorySchema(Schema):
         task = fields.Integer()
         comment = fields.Str()
 
-    @parser.use_args(SimpleHistoryElementsSchema, location='query')
-    @parser.use_kwargs(ModifyHistorySchema, location='json')
-    def patch(self, elements: List[HistoryElement], **kwargs) -> Response:
-        if len(elements) > 0:
-            if 'task' in kwargs:
-                task_id = kwargs.get('task')
-                if task_id >= 0:
-                    task = Task.query.get(task_id)
-                    if task is None:
-                        flask.abort(404, description='Unknown task with id={}'.format(kwargs.get('task')))
+    @parser.use_kwargs(SelectHistoryElementsSchema, location='query')
+    @parser.use_args(ModifyHistorySchema, location='json')
+    def patch(self, modifications: dict, **kwargs) -> Response:
+        """Modify the elements that are selected by their ids and/or the filters.
+        Returns the number of elements.
+        """
 
-                    for element in elements:
-                        element.task_id = task.id
-                        db.session.add(element)
-                else:
-                    for element in elements:
-                        element.task_id = None
-                        db.session.add(element)
+        elements = self.selected_elements(**kwargs)
+        if len(elements) == 0:
+            flask.abort(404, description='Unknown elements')
 
-            if 'comment' in kwargs:
-                for element in elements:
-                    element.comment = kwargs.get('comment')
-                    db.session.add(element)
+        values = {}
 
-            db.session.commit()
-            return jsonify(HistoryElementSchema(many=True).dump(elements))
-        else:
-            flask.abort(404, description='Unknown elements')
+        if 'task' in modifications:
+            task_id = modifications.get('task')
+            if task_id >= 0:
+                if Task.query.get(task_id) is None:
+                    flask.abort(404, description='Unknown task with id={}'.format(task_id))
 
-    @parser.use_args(SimpleHistoryElementsSchema, location='query')
-    def delete(self, elements: List[HistoryElement], **kwargs) -> Response:
-        if len(elements) > 0:
-            for e in elements:
-                db.session.delete(e)
+                values['task_id'] = task_id
+            else:
+                values['task_id'] = None
 
+        if 'comment' in modifications:
+            values['comment'] = modifications.get('comment')
+
+        if len(values) > 0:
+            # bulk updates do not go through the mapper events, so rollups are updated here
+            deltas = {}
+            if 'task_id' in values:
+                for _, start, end, task_id, timeflip_device_id in elements:
+                    HistoryRollup.deltas(start, end, task_id, timeflip_device_id, sign=-1, deltas=deltas)
+                    HistoryRollup.deltas(start, end, values['task_id'], timeflip_device_id, deltas=deltas)
+
+            for ids in self.chunks(elements):
+                HistoryElement.query.filter(HistoryElement.id.in_(ids)).update(values)
+
+            HistoryRollup.apply(db.session.connection(), deltas)
             db.session.commit()
-            return jsonify(status='ok')
-        else:
+
+        return jsonify(count=len(elements))
+
+    @parser.use_kwargs(SelectHistoryElementsSchema, location='query')
+    def delete(self, **kwargs) -> Response:
+        """Delete the elements that are selected by their ids and/or the filters.
+        Returns the number of elements.
+        """
+
+        elements = self.selected_elements(**kwargs)
+        if len(elements) == 0:
             flask.abort(404, description='Unknown elements')
 
+        # bulk deletes do not go through the mapper events, so rollups are updated here
+        deltas = {}
+        for _, start, end, task_id, timeflip_device_id in elements:
+            HistoryRollup.deltas(start, end, task_id, timeflip_device_id, sign=-1, deltas=deltas)
+
+        for ids in self.chunks(elements):
+            HistoryElement.query.filter(HistoryElement.id.in_(ids)).delete()
+
+        HistoryRollup.apply(db.session.connection(), deltas)
+        db.session.commit()
+
+        return jsonify(status='ok', count=len(elements))
+
 
 blueprint.add_url_rule('/api/history/', view_func=HistoryElementsView.as_view('history-els'))
 
 
+class HistoryExportView(HistoryElementMixin, MethodView):
+    CHUNK_SIZE = 1000
+
+    FORMATS = {
+        'csv': 'text/csv',
+        'ndjson': 'application/x-ndjson'
+    }
+
+    COLUMNS = (
+        'id',
+        'start',
+        'end',
+        'original_facet',
+        'comment',
+        'timeflip_device',
+        'task',
+        'task_name',
+        'category',
+        'category_name'
+    )
+
+    class ExportSchema(HistoryElementMixin.FilterHistoryElementSchema):
+        format = fields.Str(validate=validate.OneOf(['csv', 'ndjson']))
+
+    def rows(self, query: flask_sqlalchemy.BaseQuery) -> Iterator[tuple]:
+        """Yield the rows, fetched by chunks
+        """
+
+        query = query.outerjoin(Task, Task.id == HistoryElement.task_id).outerjoin(
+            Category, Category.id == Task.category_id).with_entities(
+            HistoryElement.id,
+            HistoryElement.start,
+            HistoryElement.end,
+            HistoryElement.original_facet,
+            HistoryElement.comment,
+            HistoryElement.timeflip_device_id,
+            HistoryElement.task_id,
+            Task.name,
+            Category.id,
+            Category.name
+        )
+
+        for row in query.order_by(HistoryElement.start).yield_per(self.CHUNK_SIZE):
+            yield tuple(value.isoformat() if isinstance(value, datetime) else value for value in row)
+
+    def csv_lines(self, query: flask_sqlalchemy.BaseQuery) -> Iterator[str]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def flush() -> str:
+            value = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return value
+
+        writer.writerow(self.COLUMNS)
+        yield flush()  # send the header right away
+
+        for i, row in enumerate(self.rows(query), start=1):
+            writer.writerow(row)
+            if i % self.CHUNK_SIZE == 0:
+                yield flush()
+
+        yield flush()
+
+    def ndjson_lines(self, query: flask_sqlalchemy.BaseQuery) -> Iterator[str]:
+        lines = []
+
+        for row in self.rows(query):
+            lines.append(json.dumps(dict(zip(self.COLUMNS, row))) + '\n')  # (values are already serializable)
+            if len(lines) == self.CHUNK_SIZE:
+                yield ''.join(lines)
+                lines = []
+
+        yield ''.join(lines)
+
+    @parser.use_kwargs(ExportSchema, location='query')
+    def get(self, format: str = 'csv', **kwargs) -> Response:
+        """Export the history elements that fit into the filters, sorted by start, as CSV or NDJSON.
+        Rows are streamed, so that the export starts immediately and uses a constant amount of memory.
+        """
+
+        query, _ = self.query_elements(**kwargs)
+        lines = self.csv_lines(query) if format == 'csv' else self.ndjson_lines(query)
+
+        response = Response(flask.stream_with_context(lines), mimetype=self.FORMATS[format])
+        response.headers['Content-Disposition'] = 'attachment; filename=history.{}'.format(format)
+
+        return response
+
+
+blueprint.add_url_rule('/api/history/export', view_func=HistoryExportView.as_view('history-export'))
+
+
+class HistoryImportView(MethodView):
+
+    MIMETYPES = dict((mimetype, format) for format, mimetype in HistoryExportView.FORMATS.items())
+
+    class ImportSchema(Schema):
+        format = fields.Str(validate=validate.OneOf(HistoryImporter.FORMATS))
+
+    @parser.use_kwargs(ImportSchema, location='query')
+    def post(self, format: str = None) -> Response:
+        """Import history elements from the body, in the format of the export (CSV or NDJSON, given by `format` or by
+        the content type).
+        Elements that already exist (same device, start and facet) are skipped.
+        Nothing is imported if a row is invalid.
+        """
+
+        if format is None:
+            format = self.MIMETYPES.get(flask.request.mimetype, None)
+            if format is None:
+                abort(400, messages={'format': ['Unknown format, expected one of {}'.format(
+                    ', '.join(HistoryImporter.FORMATS))]})
+
+        importer = HistoryImporter(db.session.connection())
+
+        try:
+            body = io.TextIOWrapper(flask.request.stream, encoding='utf-8', newline='')
+            importer.run(HistoryImporter.read(body, format))
+        except HistoryImportError as e:
+            db.session.rollback()
+            abort(422, messages=e.errors)
+        except (UnicodeDecodeError, csv.Error) as e:
+            db.session.rollback()
+            abort(400, messages={'body': [str(e)]})
+
+        mark_data_changed()
+        db.session.commit()
+
+        return jsonify(imported=importer.imported, skipped=importer.skipped)
+
+
+blueprint.add_url_rule('/api/history/import', view_func=HistoryImportView.as_view('history-import'))
+
+
+class HistoryCompactView(MethodView):
+
+    class CompactSchema(Schema):
+        timeflip = fields.List(fields.Integer(validate=validate.Range(min=0)))
+        since = NaiveDateTime()
+
+    @parser.use_kwargs(CompactSchema, location='query')
+    def post(self, timeflip: List[int] = None, since: datetime = None) -> Response:
+        """Merge the history elements that touch end to end and have the same facet and task,
+        for the given devices (all of them by default).
+        Returns the number of elements that were removed.
+        """
+
+        compactor = HistoryCompactor(db.session.connection())
+        compactor.run(timeflip, since)
+
+        if compactor.removed > 0:
+            mark_data_changed()
+
+        db.session.commit()
+
+        return jsonify(status='ok', merged=compactor.merged, removed=compactor.removed)
+
+
+blueprint.add_url_rule('/api/history/compact', view_func=HistoryCompactView.as_view('history-compact'))
+
+
 class HistoryElementView(MethodView):
 
     class SimpleHistoryElementSchema(Schema):
@@ -196,8 +626,8 @@ class HistoryElementView(MethodView):
     class ModifyHistorySchema(Schema):
         task = fields.Integer()
         comment = fields.Str()
-        start = fields.DateTime()
-        end = fields.DateTime()
+        start = NaiveDateTime()
+        end = NaiveDateTime()
 
     @parser.use_args(SimpleHistoryElementSchema, location='view_args')
     @parser.use_kwargs(ModifyHistorySchema, location='json')
@@ -1,59 +1,284 @@
-from datetime import timedelta
-import math
+from datetime import datetime, timedelta
 
-from typing import Tuple, ClassVar, Any, Hashable
+from typing import Tuple, ClassVar, Any, Hashable, Type, Iterable, Dict, List, Iterator, Optional
 
 import flask
 from flask import jsonify, Response
 from flask.views import MethodView
+import flask_sqlalchemy
 
 from webargs import fields
-from marshmallow import Schema, validate
+from marshmallow import Schema, validate, validates_schema, ValidationError
 
+from timefliptt.app import db
 from timefliptt.blueprints.api.views import blueprint
+from timefliptt.blueprints.api.cache import dump_cache, cached_response
 from timefliptt.blueprints.api.schemas import Parser, TaskSchema, CategorySchema, TimeFlipDeviceSchema
-from timefliptt.blueprints.base_models import HistoryElement
+from timefliptt.blueprints.base_models import HistoryElement, HistoryRollup, Task, EpochDateTime
 from timefliptt.blueprints.api.views.views_history import HistoryElementMixin
 
 
 parser = Parser()
 
 
-class BaseCumulativeView(HistoryElementMixin, MethodView):
+def to_microseconds(delta: timedelta) -> int:
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
 
-    object_schema: ClassVar[Schema]
-    objects_name = 'tasks'
 
-    def discriminate(self, x: HistoryElement) -> Tuple[Hashable, Any]:
+class PeriodicBuckets:
+    """Spread the duration of history elements among consecutive periods of `period` seconds covering `[start, end]`.
+
+    Elements are converted into integer offsets (in microseconds) from `start`, which is direct for epochs (as stored
+in the database, see `HistoryElement.epochs()`).
+    The periods that an element fully covers are accounted for with a difference array, so that only the (at most)
+    two edge periods are actually clipped: adding N elements and reading P periods costs O(N + P) per discriminant,
+    instead of O(N × P).
+    """
+
+    def __init__(self, start: datetime, end: datetime, period: int):
+        self.start = start
+        self.end = end
+        self.period = period
+
+        self.span = to_microseconds(end - start)
+        self.epoch = EpochDateTime.to_epoch(start)
+        self.size = period * 1000000
+        self.num_periods = -(-self.span // self.size)
+
+        self._full: Dict[Hashable, List[int]] = {}  # difference array of full periods
+        self._partial: Dict[Hashable, List[int]] = {}  # duration in edge periods
+        self._touched: Dict[Hashable, List[int]] = {}  # difference array of the number of elements
+
+    def period_bounds(self, i: int) -> Tuple[datetime, datetime]:
+        end_period = self.start + (i + 1) * timedelta(seconds=self.period)
+        return self.start + i * timedelta(seconds=self.period), end_period if end_period < self.end else self.end
+
+    def _setup(self, discriminant: Hashable):
+        if discriminant not in self._full:
+            self._full[discriminant] = [0] * (self.num_periods + 1)
+            self._partial[discriminant] = [0] * self.num_periods
+            self._touched[discriminant] = [0] * (self.num_periods + 1)
+
+    def add(self, discriminant: Hashable, start: datetime, end: datetime):
+        """Add an element that overlaps `[start, end]`
+        """
+
+        self.add_epochs(discriminant, EpochDateTime.to_epoch(start), EpochDateTime.to_epoch(end))
+
+    def add_epochs(self, discriminant: Hashable, start: int, end: int):
+        """Same as `add()`, with epochs (in microseconds)
+        """
+
+        self._setup(discriminant)
+
+        s = start - self.epoch
+        e = end - self.epoch
+
+        first_period = max(0, s // self.size)
+        last_period = min(self.num_periods - 1, e // self.size)
+
+        s = max(0, s)
+        e = min(self.span, e)
+
+        partial = self._partial[discriminant]
+        if first_period == last_period:
+            partial[first_period] += (e - s) // 1000000
+        else:
+            partial[first_period] += ((first_period + 1) * self.size - s) // 1000000
+            partial[last_period] += (e - last_period * self.size) // 1000000
+
+            if last_period - first_period > 1:
+                full = self._full[discriminant]
+                full[first_period + 1] += self.period
+                full[last_period] -= self.period
+
+        touched = self._touched[discriminant]
+        touched[first_period] += 1
+        touched[last_period + 1] -= 1
+
+    def durations(self) -> Iterator[Dict[Hashable, int]]:
+        """Yield, for each period, the duration of each discriminant that has at least one element in it
+        """
+
+        full = dict((d, 0) for d in self._full)
+        touched = dict((d, 0) for d in self._full)
+
+        for i in range(self.num_periods):
+            durations = {}
+
+            for d in self._full:
+                full[d] += self._full[d][i]
+                touched[d] += self._touched[d][i]
+
+                if touched[d] > 0:
+                    durations[d] = full[d] + self._partial[d][i]
+
+            yield durations
+
+    def sweep(self, elements: Iterable[Tuple[Hashable, int, int]]) -> Iterator[Dict[Hashable, int]]:
+        """Same as adding `elements` (with `add_epochs()`) then calling `durations()`, but `elements` must be sorted
+        by start.
+        Periods are then computed one after the other, so that the memory usage only depends on the number of
+        elements that span over the current period, not on the number of periods.
+        """
+
+        elements = iter(elements)
+        pending = next(elements, None)
+        active = []
+
+        for i in range(self.num_periods):
+            period_start = i * self.size
+            period_end = min(self.span, (i + 1) * self.size)
+
+            # elements that start in this period
+            while pending is not None:
+                d, start, end = pending
+                s = start - self.epoch
+                if s >= (i + 1) * self.size:
+                    break
+
+                e = end - self.epoch
+                active.append((d, s, e, min(self.num_periods - 1, e // self.size)))
+                pending = next(elements, None)
+
+            durations = {}
+            for d, s, e, last_period in active:
+                durations[d] = durations.get(d, 0) + (min(e, period_end) - max(s, period_start)) // 1000000
+
+            yield durations
+
+            # elements that end in this period
+            active = [a for a in active if a[3] > i]
+
+
+class StatisticsMixin(HistoryElementMixin):
+
+    object_schema: ClassVar[Type[Schema]]
+    objects_name: ClassVar[str]
+
+    ROLLUP_FILTERS = ('start', 'start_date', 'end', 'end_date', 'task', 'timeflip', 'category')
+
+    def discriminant(self, query: flask_sqlalchemy.BaseQuery, model: Any) -> Tuple[flask_sqlalchemy.BaseQuery, Any]:
+        """Get the column that discriminates the rows of `model` (`HistoryElement` or `HistoryRollup`),
+        and the query adapted to reach it
+        """
         raise NotImplementedError()
 
+    @classmethod
+    def rollup_resolution(cls, time_frame: Tuple[datetime, datetime], period: int = None, **kwargs) -> Optional[int]:
+        """Get the coarsest resolution of the rollups that lines up with the time frame (and the period, if any),
+        or `None` if the statistics cannot be computed from the rollups.
+        """
+
+        start, end = time_frame
+
+        if any(key not in cls.ROLLUP_FILTERS for key in kwargs):
+            return None
+
+        for resolution in sorted(HistoryRollup.RESOLUTIONS, reverse=True):
+            if period is not None and period % resolution != 0:
+                continue
+
+            if HistoryRollup.floor(start, resolution) != start:
+                continue
+
+            if end != datetime.max and HistoryRollup.floor(end, resolution) != end:
+                continue
+
+            # (a finer resolution would not do better)
+            if cls.carried_over_boundary(resolution, time_frame, period, **kwargs):
+                return None
+
+            return resolution
+
+    @classmethod
+    def carried_over_boundary(
+            cls, resolution: int, time_frame: Tuple[datetime, datetime], period: int = None, **kwargs) -> bool:
+        """Check whether an element that starts at a fraction of second is carried over the start of the time frame
+        or of a period (see `HistoryRollup.carried`), in which case the rollups would not give the truncated
+        durations of the elements within it
+        """
+
+        start, _ = time_frame
+
+        if period is None and start == datetime.min:
+            return False
+
+        query = cls.query_rollups(resolution, time_frame, **kwargs)\
+            .filter(HistoryRollup.carried > 0)\
+            .with_entities(HistoryRollup.bucket)\
+            .distinct()
+
+        if period is None:
+            return query.filter(HistoryRollup.bucket == start).first() is not None
+
+        return any(to_microseconds(bucket - start) % (period * 1000000) == 0 for bucket, in query)
+
+    @classmethod
+    def query_rollups(
+            cls, resolution: int, time_frame: Tuple[datetime, datetime], **kwargs) -> flask_sqlalchemy.BaseQuery:
+        """Get the rollups within the time frame that fit into the filters
+        """
+
+        start, end = time_frame
+
+        query = HistoryRollup.query\
+            .filter(HistoryRollup.resolution == resolution)\
+            .filter(HistoryRollup.bucket >= start)\
+            .filter(HistoryRollup.bucket < end)
+
+        return cls.filter_elements(query, HistoryRollup, **kwargs)
+
+    def dump_objects(self, ids: Iterable[Hashable]) -> Dict[Hashable, dict]:
+        """Dump the objects corresponding to the discriminants
+        """
+
+        return dump_cache().dump_many(self.object_schema, ids)
+
+
+class BaseCumulativeView(StatisticsMixin, MethodView):
+
+    objects_name = 'tasks'
+
     @parser.use_kwargs(HistoryElementMixin.FilterHistoryElementSchema, location='query')
+    @cached_response
     def get(self, **kwargs) -> Response:
         """Get cumulative time for each task in a given time frame
         """
 
-        elements, (start, end) = self.query_elements(**kwargs)
-        schemas = {}
-        cumulative_time = 0
+        start, end = self.time_frame(**kwargs)
+        resolution = self.rollup_resolution((start, end), **kwargs)
 
-        for element in elements.all():
-            try:
-                discriminant, obj = self.discriminate(element)
-            except ValueError:
-                continue
+        if resolution is not None:
+            query, discriminant = self.discriminant(
+                self.query_rollups(resolution, (start, end), **kwargs), HistoryRollup)
+            duration = db.func.sum(HistoryRollup.duration) / 1000000
+            first_seen = db.func.min(HistoryRollup.bucket)
+        else:
+            elements, _ = self.query_elements(**kwargs)
+
+            # only elements with a task are accounted for
+            query, discriminant = self.discriminant(
+                elements.filter(HistoryElement.task_id.isnot(None)), HistoryElement)
+            duration = db.func.sum(HistoryElement.duration_expr(start, end))
+            first_seen = db.func.min(HistoryElement.id)
+
+        results = query.with_entities(discriminant, duration).group_by(discriminant).order_by(first_seen).all()
 
-            if discriminant not in schemas:
-                schemas[discriminant] = self.object_schema().dump(obj)
-                schemas[discriminant]['cumulative_time'] = 0
+        objects = self.dump_objects(d for d, _ in results)
+        schemas = []
+        cumulative_time = 0
 
-            duration = element.duration(start, end)
-            schemas[discriminant]['cumulative_time'] += duration
+        for discriminant, duration in results:
+            schema = objects.get(discriminant, {})
+            schema['cumulative_time'] = duration
+            schemas.append(schema)
             cumulative_time += duration
 
         return jsonify(**{
             'start': start.isoformat(),
             'end': end.isoformat(),
-            self.objects_name: list(schemas.values()),
+            self.objects_name: schemas,
             'cumulative_time': cumulative_time
         })
 
@@ -63,11 +288,8 @@ class CumulativeTaskView(BaseCumulativeView):
     objects_name = 'tasks'
     object_schema = TaskSchema
 
-    def discriminate(self, x: HistoryElement) -> Tuple[Hashable, Any]:
-        if x.task_id is not None:
-            return x.task_id, x.task
-        else:
-            raise ValueError('x.task_id')
+    def discriminant(self, query: flask_sqlalchemy.BaseQuery, model: Any) -> Tuple[flask_sqlalchemy.BaseQuery, Any]:
+        return query, model.task_id
 
 
 blueprint.add_url_rule(
@@ -81,11 +303,8 @@ class CumulativeCategoriesView(BaseCumulativeView):
     objects_name = 'categories'
     object_schema = CategorySchema
 
-    def discriminate(self, x: HistoryElement) -> Tuple[Hashable, Any]:
-        if x.task_id is not None:
-            return x.task.category_id, x.task.category
-        else:
-            raise ValueError('x.task_id')
+    def discriminant(self, query: flask_sqlalchemy.BaseQuery, model: Any) -> Tuple[flask_sqlalchemy.BaseQuery, Any]:
+        return query.join(Task, model.task_id == Task.id), Task.category_id
 
 
 blueprint.add_url_rule(
@@ -99,14 +318,11 @@ class CumulativeTimeflipsView(BaseCumulativeView):
     objects_name = 'timeflip_devices'
     object_schema = TimeFlipDeviceSchema
 
-    def discriminate(self, x: HistoryElement) -> Tuple[Hashable, Any]:
+    def discriminant(self, query: flask_sqlalchemy.BaseQuery, model: Any) -> Tuple[flask_sqlalchemy.BaseQuery, Any]:
         """Even though elements are defined without task, only count the ones with one
         """
 
-        if x.task_id is not None:
-            return x.timeflip_device_id, x.timeflip_device
-        else:
-            raise ValueError('x.task_id')
+        return query, model.timeflip_device_id
 
 
 blueprint.add_url_rule(
@@ -115,83 +331,141 @@ blueprint.add_url_rule(
 )
 
 
-class BasePeriodicView(HistoryElementMixin, MethodView):
-
-    object_schema: ClassVar[Schema]
-    objects_name: str
+class BasePeriodicView(StatisticsMixin, MethodView):
 
     MAX_PERIODS = 100
+    CHUNK_SIZE = 1000
 
-    def discriminate(self, x: HistoryElement) -> Tuple[Hashable, Any]:
-        raise NotImplementedError()
+    def __init__(self, stream: bool = False):
+        """If `stream` is set, periods are yielded one after the other, as NDJSON
+        """
+
+        self.stream = stream
 
     class PeriodicSchema(Schema):
-        period = fields.Integer(validate=validate.Range(min=0), required=True)
+        period = fields.Integer(validate=validate.Range(min=1), required=True)
+
+    def element_durations(
+            self, buckets: PeriodicBuckets, elements: flask_sqlalchemy.BaseQuery) -> Iterator[Dict[Hashable, int]]:
+        """Yield, for each period, the duration of each discriminant, from the history elements
+        """
+
+        # only elements with a task are accounted for
+        query, discriminant = self.discriminant(elements.filter(HistoryElement.task_id.isnot(None)), HistoryElement)
+        query = query.with_entities(discriminant, *HistoryElement.epochs())
+
+        if self.stream:
+            return buckets.sweep(query.order_by(HistoryElement.start).yield_per(self.CHUNK_SIZE))
+        else:
+            for d, element_start, element_end in query.order_by(HistoryElement.id):
+                buckets.add_epochs(d, element_start, element_end)
+
+            return buckets.durations()
+
+    def rollup_durations(self, buckets: PeriodicBuckets, resolution: int, **kwargs) -> Iterator[Dict[Hashable, int]]:
+        """Yield, for each period, the duration of each discriminant, from the rollups
+        """
+
+        query, discriminant = self.discriminant(
+            self.query_rollups(resolution, (buckets.start, buckets.end), **kwargs), HistoryRollup)
+
+        current_period = 0
+        durations = {}
+
+        for d, bucket, duration in query\
+                .with_entities(discriminant, HistoryRollup.bucket, db.func.sum(HistoryRollup.duration))\
+                .group_by(HistoryRollup.bucket, discriminant)\
+                .order_by(HistoryRollup.bucket)\
+                .yield_per(self.CHUNK_SIZE):
+
+            i = to_microseconds(bucket - buckets.start) // buckets.size
+            while current_period < i:
+                yield dict((k, v // 1000000) for k, v in durations.items())
+                durations = {}
+                current_period += 1
+
+            durations[d] = durations.get(d, 0) + duration
+
+        while current_period < buckets.num_periods:
+            yield dict((k, v // 1000000) for k, v in durations.items())
+            durations = {}
+            current_period += 1
+
+    def period_schema(
+            self, buckets: PeriodicBuckets, i: int, durations: Dict[Hashable, int], objects: Dict[Hashable, dict]
+    ) -> dict:
+        period_start, period_end = buckets.period_bounds(i)
+
+        schemas = []
+        for d, duration in durations.items():
+            schema = dict(objects.get(d, {}))
+            schema['cumulative_time'] = duration
+            schemas.append(schema)
+
+        return {
+            'start': period_start.isoformat(),
+            'end': period_end.isoformat(),
+            self.objects_name: schemas,
+            'cumulative_time': sum(durations.values())
+        }
+
+    def stream_periods(self, buckets: PeriodicBuckets, durations: Iterator[Dict[Hashable, int]]) -> Iterator[str]:
+        """Yield each period as a line of JSON. Objects are dumped the first time they appear
+        """
+
+        objects = {}
+
+        for i, period_durations in enumerate(durations):
+            for d in period_durations:
+                if d not in objects:
+                    objects[d] = self.dump_objects([d]).get(d, {})
+
+            yield flask.json.dumps(self.period_schema(buckets, i, period_durations, objects)) + '\n'
 
     @parser.use_kwargs(PeriodicSchema, location='view_args')
     @parser.use_kwargs(HistoryElementMixin.FilterHistoryElementSchema, location='query')
+    @cached_response
     def get(self, period: int, **kwargs) -> Response:
         """Get cumulative time for each task in a given period
         """
 
-        elements, (start, end) = self.query_elements(**kwargs)
+        start, end = self.time_frame(**kwargs)
 
-        num_periods = int(math.ceil((end - start).total_seconds() / period))
+        buckets = PeriodicBuckets(start, end, period)
 
-        if num_periods > self.MAX_PERIODS:
+        if self.stream:
+            if start == datetime.min or end == datetime.max:
+                flask.abort(403, description='Streaming requires a time frame with both a start and an end')
+        elif buckets.num_periods > self.MAX_PERIODS:
             flask.abort(
                 403,
-                description='This request would results in {} periods, which is larger than the limit ({})'.format(
-                    num_periods, self.MAX_PERIODS)
+                description='This request would results in {} periods, which is larger than the limit ({}). '
+                            'Use the streaming variant instead.'.format(buckets.num_periods, self.MAX_PERIODS)
             )
 
-        periodic_schemas = []
-        accumulator = []
-        for i in range(num_periods):
-            end_period = start + (i + 1) * timedelta(seconds=period)
+        resolution = self.rollup_resolution((start, end), period, **kwargs)
 
-            periodic_schemas.append({
-                'start': start + i * timedelta(seconds=period),
-                'end': end_period if end_period < end else end,
-                self.objects_name: {},
-                'cumulative_time': 0
-            })
-
-            accumulator.append({})
-
-        cumulative_time = 0
-        for element in elements.all():
-            try:
-                discriminant, obj = self.discriminate(element)
-            except ValueError:
-                continue
-
-            period_start = max(0, int(math.floor((element.start - start).total_seconds() / period)))
-            period_end = min(num_periods - 1, int(math.floor((element.end - start).total_seconds() / period)))
-
-            for current_period in range(period_start, period_end + 1):
-                if discriminant not in accumulator[current_period]:
-                    accumulator[current_period][discriminant] = self.object_schema().dump(obj)
-                    accumulator[current_period][discriminant]['cumulative_time'] = 0
+        if resolution is not None:
+            durations = self.rollup_durations(buckets, resolution, **kwargs)
+        else:
+            durations = self.element_durations(buckets, self.query_elements(**kwargs)[0])
 
-                duration = element.duration(
-                    periodic_schemas[current_period]['start'], periodic_schemas[current_period]['end'])
-                accumulator[current_period][discriminant]['cumulative_time'] += duration
-                periodic_schemas[current_period]['cumulative_time'] += duration
-                cumulative_time += duration
+        if self.stream:
+            return Response(
+                flask.stream_with_context(self.stream_periods(buckets, durations)), mimetype='application/x-ndjson')
 
-        for i in range(num_periods):
-            periodic_schemas[i][self.objects_name] = list(accumulator[i].values())
+        durations = list(durations)
+        objects = self.dump_objects(set(d for period_durations in durations for d in period_durations))
 
-            # convert date to isoformat
-            periodic_schemas[i]['start'] = periodic_schemas[i]['start'].isoformat()
-            periodic_schemas[i]['end'] = periodic_schemas[i]['end'].isoformat()
+        periodic_schemas = [
+            self.period_schema(buckets, i, period_durations, objects) for i, period_durations in enumerate(durations)
+        ]
 
         return jsonify(**{
             'start': start.isoformat(),
             'end': end.isoformat(),
             'periods': periodic_schemas,
-            'cumulative_time': cumulative_time
+            'cumulative_time': sum(p['cumulative_time'] for p in periodic_schemas)
         })
 
 
@@ -200,11 +474,8 @@ class PeriodicTaskView(BasePeriodicView):
     objects_name = 'tasks'
     object_schema = TaskSchema
 
-    def discriminate(self, x: HistoryElement) -> Tuple[Hashable, Any]:
-        if x.task_id is not None:
-            return x.task_id, x.task
-        else:
-            raise ValueError('x.task_id')
+    def discriminant(self, query: flask_sqlalchemy.BaseQuery, model: Any) -> Tuple[flask_sqlalchemy.BaseQuery, Any]:
+        return query, model.task_id
 
 
 blueprint.add_url_rule(
@@ -212,17 +483,19 @@ blueprint.add_url_rule(
     view_func=PeriodicTaskView.as_view('statistics-periodic-tasks')
 )
 
+blueprint.add_url_rule(
+    '/api/statistics/periodic/<int:period>/tasks/stream',
+    view_func=PeriodicTaskView.as_view('statistics-periodic-tasks-stream', stream=True)
+)
+
 
 class PeriodicCategoriesView(BasePeriodicView):
 
     objects_name = 'categories'
     object_schema = CategorySchema
 
-    def discriminate(self, x: HistoryElement) -> Tuple[Hashable, Any]:
-        if x.task_id is not None:
-            return x.task.category_id, x.task.category
-        else:
-            raise ValueError('x.task_id')
+    def discriminant(self, query: flask_sqlalchemy.BaseQuery, model: Any) -> Tuple[flask_sqlalchemy.BaseQuery, Any]:
+        return query.join(Task, model.task_id == Task.id), Task.category_id
 
 
 blueprint.add_url_rule(
@@ -230,23 +503,117 @@ blueprint.add_url_rule(
     view_func=PeriodicCategoriesView.as_view('statistics-periodic-categories')
 )
 
+blueprint.add_url_rule(
+    '/api/statistics/periodic/<int:period>/categories/stream',
+    view_func=PeriodicCategoriesView.as_view('statistics-periodic-categories-stream', stream=True)
+)
+
 
 class PeriodicTimeflipsView(BasePeriodicView):
 
     objects_name = 'timeflip_devices'
     object_schema = TimeFlipDeviceSchema
 
-    def discriminate(self, x: HistoryElement) -> Tuple[Hashable, Any]:
+    def discriminant(self, query: flask_sqlalchemy.BaseQuery, model: Any) -> Tuple[flask_sqlalchemy.BaseQuery, Any]:
         """Even though elements are defined without task, only count the ones with one
         """
 
-        if x.task_id is not None:
-            return x.timeflip_device_id, x.timeflip_device
-        else:
-            raise ValueError('x.task_id')
+        return query, model.timeflip_device_id
 
 
 blueprint.add_url_rule(
     '/api/statistics/periodic/<int:period>/timeflips/',
     view_func=PeriodicTimeflipsView.as_view('statistics-periodic-timeflips')
 )
+
+blueprint.add_url_rule(
+    '/api/statistics/periodic/<int:period>/timeflips/stream',
+    view_func=PeriodicTimeflipsView.as_view('statistics-periodic-timeflips-stream', stream=True)
+)
+
+
+class PivotView(HistoryElementMixin, MethodView):
+    """Aggregate the history along any combination of dimensions, with a single query
+    """
+
+    # dimension: (name of the objects, schema, column)
+    DIMENSIONS = {
+        'task': ('tasks', TaskSchema, HistoryElement.task_id),
+        'category': ('categories', CategorySchema, Task.category_id),
+        'timeflip': ('timeflip_devices', TimeFlipDeviceSchema, HistoryElement.timeflip_device_id),
+    }
+
+    class PivotSchema(HistoryElementMixin.FilterHistoryElementSchema):
+        dimension = fields.List(fields.String(validate=validate.OneOf(['task', 'category', 'timeflip', 'period'])))
+        period = fields.Integer(validate=validate.Range(min=1))
+
+        @validates_schema
+        def period_dimension(self, data, **kwargs):
+            if 'period' in data.get('dimension', []) and 'period' not in data:
+                raise ValidationError('the period dimension requires a period', 'period')
+
+    @parser.use_kwargs(PivotSchema, location='query')
+    @cached_response
+    def get(self, dimension: List[str] = None, period: int = None, **kwargs) -> Response:
+        """Get the cumulative time for each cell of the cube defined by the dimensions
+        """
+
+        dimensions = list(dict.fromkeys(dimension or []))  # remove duplicates
+        names = [d for d in dimensions if d != 'period']
+        columns = [self.DIMENSIONS[d][2] for d in names]
+
+        elements, (start, end) = self.query_elements(**kwargs)
+
+        # only elements with a task are accounted for
+        query = elements.filter(HistoryElement.task_id.isnot(None))
+        if 'category' in names:
+            query = query.join(Task, HistoryElement.task_id == Task.id)
+
+        cells = []
+        data = {}
+
+        if 'period' in dimensions:
+            buckets = PeriodicBuckets(start, end, period)
+
+            if buckets.num_periods > BasePeriodicView.MAX_PERIODS:
+                flask.abort(
+                    403,
+                    description='This request would results in {} periods, which is larger than the limit ({})'.format(
+                        buckets.num_periods, BasePeriodicView.MAX_PERIODS)
+                )
+
+            for row in query\
+                    .with_entities(*columns, *HistoryElement.epochs())\
+                    .order_by(HistoryElement.id):
+                buckets.add_epochs(tuple(row[:-2]), row[-2], row[-1])
+
+            data['periods'] = []
+            for i, durations in enumerate(buckets.durations()):
+                period_start, period_end = buckets.period_bounds(i)
+                data['periods'].append({'start': period_start.isoformat(), 'end': period_end.isoformat()})
+
+                for key, duration in durations.items():
+                    cells.append(dict(zip(names, key), period=i, cumulative_time=duration))
+        else:
+            for row in query\
+                    .with_entities(*columns, db.func.sum(HistoryElement.duration_expr(start, end)))\
+                    .group_by(*columns)\
+                    .order_by(db.func.min(HistoryElement.id)):
+                if row[-1] is not None:
+                    cells.append(dict(zip(names, row[:-1]), cumulative_time=row[-1]))
+
+        for name in names:
+            objects_name, schema, _ = self.DIMENSIONS[name]
+            data[objects_name] = list(dump_cache().dump_many(schema, (cell[name] for cell in cells)).values())
+
+        return jsonify(
+            start=start.isoformat(),
+            end=end.isoformat(),
+            dimensions=dimensions,
+            cells=cells,
+            cumulative_time=sum(cell['cumulative_time'] for cell in cells),
+            **data
+        )
+
+
+blueprint.add_url_rule('/api/statistics/pivot/', view_func=PivotView.as_view('statistics-pivot'))
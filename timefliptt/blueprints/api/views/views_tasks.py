@@ -4,6 +4,7 @@ from flask.views import MethodView
 
 from webargs import fields
 from marshmallow import Schema, post_load, validate
+from sqlalchemy.orm import selectinload
 
 from timefliptt.app import db
 from timefliptt.blueprints.api.views import blueprint
@@ -19,7 +20,8 @@ class CategoriesView(MethodView):
         """Get the list of categories
         """
 
-        return jsonify(categories=CategorySchema(many=True).dump(Category.query.all()))
+        categories = Category.query.options(selectinload(Category.tasks)).all()
+        return jsonify(categories=CategorySchema(many=True).dump(categories))
 
     @parser.use_kwargs(CategorySchema(exclude=('id', )), location='json')
     def post(self, name: str) -> Response:
@@ -1,8 +1,9 @@
 import asyncio
+import functools
 import random
-from datetime import datetime, timedelta
+from datetime import datetime
 
-from typing import List, Tuple
+from typing import List, Tuple, Optional, Callable
 
 from webargs import fields, validate
 from marshmallow import Schema, post_load
@@ -11,60 +12,67 @@ import flask
 from flask import Response, jsonify
 from flask.views import MethodView
 
-from pytimefliplib.async_client import AsyncClient, TimeFlipRuntimeError, CHARACTERISTICS
-from bleak import BleakScanner, BleakClient, BleakError
-from asyncio import TimeoutError
+from pytimefliplib.async_client import AsyncClient, TimeFlipRuntimeError, NotConnectedError
+from bleak import BleakError
 
 from timefliptt.app import db
 from timefliptt.blueprints.api.views import blueprint
-from timefliptt.timeflip import run_coro, connected_to, hard_connect, hard_logout, soft_connect, daemon_status
+from timefliptt.timeflip import submit, connected_to, hard_connect, hard_logout, soft_connect, daemon_status, \
+    get_operation, discover, stored_history, current_session, History, Operation, OperationPending, DaemonStopped
 from timefliptt.blueprints.base_models import TimeFlipDevice, FacetToTask, Task, HistoryElement
-from timefliptt.blueprints.api.schemas import TimeFlipDeviceSchema, Parser, FacetToTaskSchema, HistoryElementSchema
+from timefliptt.blueprints.history_sync import HistoryWriter, timed_history
+from timefliptt.blueprints.api.schemas import TimeFlipDeviceSchema, Parser, FacetToTaskSchema, HistoryElementSchema, \
+    TaskSchema
+from timefliptt.blueprints.api.cache import dump_cache
 
 
 parser = Parser()
 
 
+def operation_response(operation: Operation, timeout: float = None) -> Response:
+    """Wait for the outcome of `operation` until the deadline (`OPERATION_DEADLINE`, if `timeout` is not given).
+    If it is still pending, answer with 202 and where to poll it (see `OperationView`).
+    """
+
+    if timeout is None:
+        timeout = flask.current_app.config['OPERATION_DEADLINE']
+
+    try:
+        return jsonify(operation.result(timeout))
+    except OperationPending:
+        url = flask.url_for('api.timeflips-operation', id=operation.id)
+        return jsonify(status='pending', operation=operation.to_dict(), url=url), 202, {'Location': url}
+    except (TimeFlipRuntimeError, BleakError, NotConnectedError) as e:
+        return jsonify(status='ko', error=str(e))
+
+
 class AvailableDevicesView(MethodView):
-    """List the available TimeFlip devices
+    """List the available TimeFlip devices (see `timeflip.discover()`)
 
     Inspired by
     https://github.com/pierre-24/pytimefliplib/blob/b4ceda/pytimefliplib/scripts/discover.py#L11
     """
-    async def get_devices(self) -> List[dict]:
-        avail_timeflip = []
-        other_devices = []
 
-        devices = await BleakScanner.discover()
-        for d in devices:
-            try:
-                async with BleakClient(d) as client:
-                    _ = await client.read_gatt_char(CHARACTERISTICS['facet'])
-                    avail_timeflip.append(d)
-            except (BleakError, TimeoutError):
-                other_devices.append(d)
-
-        users: List[TimeFlipDevice] = TimeFlipDevice.query.all()
-
-        def get_id(address: str):
-            pk = -1
-            for u in users:
-                if u.address == address:
-                    return u.id
-            return pk
-
-        return [{
-            'address': d.address,
-            'name': d.name,
-            'id': get_id(d.address)
-        } for d in avail_timeflip]
+    @staticmethod
+    def devices_of(discovered: List[Tuple[str, str]]) -> dict:
+        ids = dict(db.session.query(TimeFlipDevice.address, TimeFlipDevice.id).filter(
+            TimeFlipDevice.address.in_([address for address, _ in discovered])))
+
+        return {'discovered': [{
+            'address': address,
+            'name': name,
+            'id': ids.get(address, -1)
+        } for address, name in discovered]}
 
     def get(self) -> Response:
-        loop = asyncio.new_event_loop()
-        t = loop.create_task(self.get_devices())
-        available_devices = loop.run_until_complete(t)
-        loop.close()
-        return jsonify(discovered=available_devices)
+        config = flask.current_app.config
+
+        try:
+            return operation_response(discover(
+                config['DISCOVERY_TTL'], config['DISCOVERY_CONCURRENCY'], config['DISCOVERY_TIMEOUT'],
+                then=self.devices_of))
+        except DaemonStopped as e:
+            return jsonify(status='ko', error=str(e))
 
 
 blueprint.add_url_rule('/api/devices/', view_func=AvailableDevicesView.as_view('devices'))
@@ -97,29 +105,59 @@ blueprint.add_url_rule('/api/timeflips/', view_func=TimeFlipsView.as_view('timef
 
 class TimeFlipConnectionView(MethodView):
     def get(self) -> Response:
-        """See the status of the daemon
+        """See the status of the daemon, and of each of its connections (the most recently used last).
+        `timeflip_device` is the most recently used device.
         """
 
         status = daemon_status()
-        if 'address' in status:
-            device = TimeFlipDevice.query.filter(TimeFlipDevice.address.is_(status['address'])).first()
-            if device is not None:
-                del status['address']
-                status['timeflip_device'] = TimeFlipDeviceSchema().dump(device)
+
+        devices = dict(
+            (d.address, TimeFlipDeviceSchema().dump(d)) for d in TimeFlipDevice.query.filter(
+                TimeFlipDevice.address.in_([c['address'] for c in status.get('connections', [])])))
+
+        for connection in [status] + status.get('connections', []):
+            if connection.get('address', None) in devices:
+                connection['timeflip_device'] = devices[connection.pop('address')]
 
         return jsonify(status='ok', **status)
 
-    def delete(self) -> Response:
-        """Disconnect from any device
+    @parser.use_kwargs({'timeflip': fields.Integer(validate=validate.Range(min=0))}, location='query')
+    def delete(self, timeflip: int = None) -> Response:
+        """Disconnect from a device (`timeflip`), or from all of them
         """
 
-        hard_logout()
+        if timeflip is not None:
+            device = TimeFlipDevice.query.get(timeflip)
+            if device is None:
+                flask.abort(404, description='Unknown TimeFlip with id={}'.format(timeflip))
+
+            hard_logout(device.address)
+        else:
+            hard_logout()
+
         return jsonify(status='ok')
 
 
 blueprint.add_url_rule('/api/timeflips/daemon', view_func=TimeFlipConnectionView.as_view('timeflips-daemon'))
 
 
+class OperationView(MethodView):
+    @parser.use_kwargs({'wait': fields.Float(validate=validate.Range(min=0, max=30))}, location='query')
+    def get(self, id: str, wait: float = 0) -> Response:
+        """Poll an operation (waiting at most `wait` seconds). Once it is done, gives the response of the request
+        that submitted it, otherwise the same 202 response.
+        """
+
+        operation = get_operation(id)
+        if operation is None:
+            flask.abort(404, description='Unknown operation with id={}'.format(id))
+
+        return operation_response(operation, wait)
+
+
+blueprint.add_url_rule('/api/timeflips/ops/<id>', view_func=OperationView.as_view('timeflips-operation'))
+
+
 class TimeFlipView(MethodView):
 
     class TimeFlipDeviceSimpleSchema(Schema):
@@ -161,20 +199,30 @@ class TimeFlipHandleView(MethodView):
     """
 
     @staticmethod
-    async def get_info(client: AsyncClient, device: TimeFlipDevice) -> dict:
-        calibration = await client.calibration_version()
+    async def get_info(client: AsyncClient) -> dict:
         return {
-            'status': 'ok',
             'address': client.address,
-            'password': device.password,
-            'name': device.name,  # note: use device.name, since name is not updated on device while connected
             'facet': client.current_facet_value,
             'battery': await client.battery_level(),
             'paused': client.paused,
             'locked': client.locked,
-            'device_calibration': '0x{:02x}'.format(calibration),
+            'device_calibration': await client.calibration_version()
+        }
+
+    @staticmethod
+    def info_of(device: TimeFlipDevice, info: dict) -> dict:
+        return {
+            'status': 'ok',
+            'address': info['address'],
+            'password': device.password,
+            'name': device.name,  # note: use device.name, since name is not updated on device while connected
+            'facet': info['facet'],
+            'battery': info['battery'],
+            'paused': info['paused'],
+            'locked': info['locked'],
+            'device_calibration': '0x{:02x}'.format(info['device_calibration']),
             'calibration': '0x{:02x}'.format(device.calibration),
-            'calibration_ok': calibration == device.calibration
+            'calibration_ok': info['device_calibration'] == device.calibration
         }
 
     @parser.use_args(TimeFlipView.TimeFlipDeviceSimpleSchema, location='view_args')
@@ -186,10 +234,13 @@ class TimeFlipHandleView(MethodView):
             if not connected_to(device.address):
                 flask.abort(401, description='Not connected to TimeFlip with id={}'.format(device.id))
 
-            try:
-                return jsonify(run_coro(self.get_info, device=device))
-            except (TimeFlipRuntimeError, BleakError) as e:
-                return jsonify(status='ko', error=str(e))
+            device_id = device.id
+
+            return operation_response(submit(
+                device.address,
+                self.get_info,
+                then=lambda info: self.info_of(TimeFlipDevice.query.get(device_id), info)
+            ))
         else:
             flask.abort(404, description='Unknown TimeFlip with id={}'.format(id))
 
@@ -203,25 +254,60 @@ class TimeFlipHandleView(MethodView):
 
         return name, calibration
 
+    @staticmethod
+    def save_device(app: flask.Flask, device_id: int, **values):
+        """Save the values that were set on the device (as part of the operation, so that they are not lost
+        even if the result of the operation is never fetched), and use them for the next connections
+        """
+
+        with app.app_context():
+            device = TimeFlipDevice.query.get(device_id)
+            if device is None:  # removed in the meantime
+                return
+
+            for name, value in values.items():
+                setattr(device, name, value)
+
+            soft_connect(device.address, device.password, device.calibration)
+
+            db.session.add(device)
+            db.session.commit()
+
+    @staticmethod
+    async def setup_and_get_info(client: AsyncClient, setup: bool, save: Callable[..., None]) -> dict:
+        if setup:
+            name, calibration = await TimeFlipHandleView.setup_new_timeflip(client)
+            await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(save, name=name, calibration=calibration))
+
+        return await TimeFlipHandleView.get_info(client)
+
+    def device_saver(self, device: TimeFlipDevice) -> Callable[..., None]:
+        return functools.partial(self.save_device, flask.current_app._get_current_object(), device.id)
+
+    @staticmethod
+    def fresh_info_of(device_id: int, info: dict) -> dict:
+        # (the device may have been saved by the operation, in another session)
+        return TimeFlipHandleView.info_of(TimeFlipDevice.query.populate_existing().get(device_id), info)
+
     @parser.use_args(TimeFlipView.TimeFlipDeviceSimpleSchema, location='view_args')
     def post(self, device: TimeFlipDevice, id: int) -> Response:
         """Connect to the device. If it is the first time, fetch its name and set a calibration
         """
 
         if device is not None:
-            try:
-                hard_connect(device.address, device.password)
-
-                if device.name is None:
-                    name, calibration = run_coro(self.setup_new_timeflip)
-                    device.name = name
-                    device.calibration = calibration
+            device_id = device.id
 
-                    db.session.add(device)
-                    db.session.commit()
-
-                return jsonify(run_coro(self.get_info, device=device))
-            except (TimeFlipRuntimeError, BleakError) as e:
+            try:
+                return operation_response(submit(
+                    device.address,
+                    self.setup_and_get_info,
+                    after=hard_connect(device.address, device.password, device.calibration),
+                    then=lambda info: self.fresh_info_of(device_id, info),
+                    setup=device.name is None,
+                    save=self.device_saver(device)
+                ))
+            except DaemonStopped as e:
                 return jsonify(status='ko', error=str(e))
         else:
             flask.abort(404, description='Unknown TimeFlip with id={}'.format(id))
@@ -246,6 +332,34 @@ class TimeFlipHandleView(MethodView):
 
         return calibration
 
+    @staticmethod
+    async def modify(
+            client: AsyncClient,
+            save: Callable[..., None],
+            name: str = None,
+            password: str = None,
+            prev_calibration: int = None
+    ) -> dict:
+        """Set what is not `None` and `save()` what was set (even if something fails afterwards), then get info"""
+
+        changed = {}
+
+        try:
+            if name is not None:
+                await TimeFlipHandleView.set_new_name(client, name)
+                changed['name'] = name
+
+            if password is not None:
+                await TimeFlipHandleView.set_new_password(client, password)
+                changed['password'] = password
+
+            if prev_calibration is not None:
+                changed['calibration'] = await TimeFlipHandleView.set_new_calibration(client, prev_calibration)
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, functools.partial(save, **changed))
+
+        return await TimeFlipHandleView.get_info(client)
+
     @parser.use_args(TimeFlipView.TimeFlipDeviceSimpleSchema, location='view_args')
     @parser.use_kwargs(
         {
@@ -261,31 +375,69 @@ class TimeFlipHandleView(MethodView):
             if not connected_to(device.address):
                 flask.abort(401, description='Not connected to TimeFlip with id={}'.format(device.id))
 
-            try:
-                if 'name' in kwargs:
-                    device.name = kwargs['name']
-                    run_coro(self.set_new_name, name=device.name)
+            device_id = device.id
+
+            return operation_response(submit(
+                device.address,
+                self.modify,
+                then=lambda info: self.fresh_info_of(device_id, info),
+                save=self.device_saver(device),
+                name=kwargs.get('name', None),
+                password=kwargs.get('password', None),
+                prev_calibration=device.calibration if 'change_calibration' in kwargs else None
+            ))
+        else:
+            flask.abort(404, description='Unknown TimeFlip with id={}'.format(id))
 
-                if 'password' in kwargs:
-                    device.password = kwargs['password']
-                    run_coro(self.set_new_password, password=device.password)
-                    soft_connect(device.address, kwargs['password'])
 
-                if 'change_calibration' in kwargs:
-                    new_calibration = run_coro(self.set_new_calibration, prev_calibration=device.calibration)
-                    device.calibration = new_calibration
+blueprint.add_url_rule('/api/timeflips/<int:id>/handle', view_func=TimeFlipHandleView.as_view('timeflip-handle'))
 
-                db.session.add(device)
-                db.session.commit()
 
-                return jsonify(run_coro(self.get_info, device=device))
-            except (BleakError, TimeFlipRuntimeError) as e:
-                return jsonify(status='ko', error=str(e))
+class TimeFlipCurrentView(MethodView):
+
+    @parser.use_args(TimeFlipView.TimeFlipDeviceSimpleSchema, location='view_args')
+    def get(self, device: TimeFlipDevice, id: int) -> Response:
+        """Get the current facet (and task) of the device and since when, as well as the last completed segments,
+        as they were notified by the device (so without communicating with it)
+        """
+
+        if device is not None:
+            if not connected_to(device.address):
+                flask.abort(401, description='Not connected to TimeFlip with id={}'.format(device.id))
+
+            facet, start, segments = current_session(device.address)
+
+            facet_to_task = dict(db.session.query(FacetToTask.facet, FacetToTask.task_id).filter(
+                FacetToTask.timeflip_device_id == device.id))
+            tasks = dump_cache().dump_many(TaskSchema, facet_to_task.values())
+
+            def task_of(facet: Optional[int]) -> Optional[dict]:
+                return tasks.get(facet_to_task.get(facet, None), None)
+
+            return jsonify(
+                status='ok',
+                facet=facet,
+                task=task_of(facet),
+                start=start.isoformat() if start is not None else None,
+                duration=(datetime.now() - start).total_seconds() if start is not None else None,
+                segments=[{
+                    'facet': segment_facet,
+                    'task': task_of(segment_facet),
+                    'start': segment_start.isoformat(),
+                    'end': segment_end.isoformat()
+                } for segment_facet, segment_start, segment_end in segments]
+            )
         else:
             flask.abort(404, description='Unknown TimeFlip with id={}'.format(id))
 
 
-blueprint.add_url_rule('/api/timeflips/<int:id>/handle', view_func=TimeFlipHandleView.as_view('timeflip-handle'))
+blueprint.add_url_rule('/api/timeflips/<int:id>/current', view_func=TimeFlipCurrentView.as_view('timeflip-current'))
+
+
+FACET_TO_TASK_RELATED = {
+    'task': (TaskSchema, 'task_id'),
+    'timeflip_device': (TimeFlipDeviceSchema, 'timeflip_device_id')
+}
 
 
 class FacetsView(MethodView):
@@ -297,12 +449,15 @@ class FacetsView(MethodView):
 
         if device is not None:
             return jsonify(
-                facet_to_task=FacetToTaskSchema(many=True, exclude=('timeflip_device', 'id')).dump(
+                facet_to_task=dump_cache().dump_related(
+                    FacetToTaskSchema,
                     FacetToTask
                     .query
                     .filter(FacetToTask.timeflip_device_id.is_(device.id))
                     .order_by(FacetToTask.facet)
-                    .all()
+                    .all(),
+                    FACET_TO_TASK_RELATED,
+                    exclude=('timeflip_device', 'id')
                 ))
         else:
             flask.abort(404, description='Unknown TimeFlip with id={}'.format(id))
@@ -352,7 +507,8 @@ class FacetView(MethodView):
         """
 
         if ftt is not None:
-            return jsonify(FacetToTaskSchema(exclude=('id', )).dump(ftt))
+            return jsonify(
+                dump_cache().dump_related(FacetToTaskSchema, [ftt], FACET_TO_TASK_RELATED, exclude=('id', ))[0])
         else:
             flask.abort(404, description='Not task associated with facet={}'.format(facet))
 
@@ -376,7 +532,8 @@ class FacetView(MethodView):
             db.session.add(ftt)
             db.session.commit()
 
-            return jsonify(FacetToTaskSchema(exclude=('timeflip_device', 'id')).dump(ftt))
+            return jsonify(dump_cache().dump_related(
+                FacetToTaskSchema, [ftt], FACET_TO_TASK_RELATED, exclude=('timeflip_device', 'id'))[0])
         else:
             flask.abort(404, description='Unknown TimeFlip with id={}'.format(id))
 
@@ -400,76 +557,61 @@ blueprint.add_url_rule('/api/timeflips/<int:id>/facets/<int:facet>/', view_func=
 class TimeFlipHistoryView(MethodView):
 
     @staticmethod
-    async def get_calibration(client: AsyncClient) -> int:
-        return await client.calibration_version()
+    def store_history(app: flask.Flask, address: str, history: History, end_date: datetime) -> datetime:
+        """Store the history (as part of the operation, see `stored_history()`), and give the date since which
+        the elements of the device were stored (or merged)
+        """
+
+        with app.app_context():
+            HistoryWriter(app).write([(address, history, end_date)])
+
+        return next(timed_history(history, end_date))[0] if len(history) > 0 else end_date
 
     @staticmethod
-    async def get_history(client: AsyncClient, delete: bool = True) -> List[Tuple[int, int, bytearray]]:
-        history = await client.history()
-        if delete:
-            await client.history_delete()
+    def history_response(device_id: int, result: Tuple[int, Optional[datetime]]) -> dict:
+        calibration, since = result
+        device = TimeFlipDevice.query.get(device_id)
+
+        if since is None:
+            flask.abort(
+                409,
+                description='Calibration of the device (0x{:02x}) does not match the one registered (0x{:02x}).'
+                .format(calibration, device.calibration)
+            )
+
+        history_elements = HistoryElement.query\
+            .filter(HistoryElement.timeflip_device_id == device_id)\
+            .filter(HistoryElement.end > since)\
+            .order_by(HistoryElement.start)\
+            .all()
 
-        return history
+        return {
+            'history_elements': HistoryElementSchema(
+                many=True,
+                exclude=('timeflip_device', )
+            ).dump(history_elements)
+        }
 
     @parser.use_args(TimeFlipView.TimeFlipDeviceSimpleSchema, location='view_args')
     def post(self, device: TimeFlipDevice, id: int) -> Response:
-        """Get history. Note that it is deleted by default on the host device.
+        """Get history, if the calibration of the device matches. Note that it is deleted by default on the host device.
+        The history is stored by the operation itself, whether its outcome is fetched or not.
         """
 
         if device is not None:
             if not connected_to(device.address):
                 flask.abort(401, description='Not connected to TimeFlip with id={}'.format(device.id))
 
-            # check calibration
-            try:
-                calibration = run_coro(self.get_calibration)
-            except (BleakError, TimeFlipRuntimeError) as e:
-                return jsonify(status='ko', error=str(e))
-
-            if calibration != device.calibration:
-                flask.abort(
-                    409,
-                    description='Calibration of the device (0x{:02x}) does not match the one registered (0x{:02x}).'
-                    .format(calibration, device.calibration)
-                )
-
-            # get corresponding task
-            ftts = FacetToTask.query.filter(FacetToTask.timeflip_device_id.is_(device.id)).all()
-            facet_to_task = {}
-            for ftt in ftts:
-                facet_to_task[ftt.facet] = ftt.task
-
-            # get history
-            try:
-                history = run_coro(self.get_history)
-            except (BleakError, TimeFlipRuntimeError) as e:
-                return jsonify(status='ko', error=str(e))
-
-            history_elements = []
-            start_tm = sum(h[1] for h in history)
-            start = datetime.now() - timedelta(seconds=start_tm)
-            start -= timedelta(microseconds=start.microsecond)  # set microsecond to zero
-
-            for facet, duration, _ in history:
-                end = start + timedelta(seconds=duration)
+            device_id = device.id
 
-                task = None
-                if facet in facet_to_task:
-                    task = facet_to_task[facet]
-
-                history_element = HistoryElement.create(start, end, facet, device, task)
-                db.session.add(history_element)
-                history_elements.append(history_element)
-                start = end
-
-            db.session.commit()
-
-            return jsonify(
-                history_elements=HistoryElementSchema(
-                    many=True,
-                    exclude=('timeflip_device', )
-                ).dump(history_elements)
-            )
+            return operation_response(submit(
+                device.address,
+                stored_history,
+                then=lambda result: self.history_response(device_id, result),
+                calibration=device.calibration,
+                store=functools.partial(
+                    self.store_history, flask.current_app._get_current_object(), device.address)
+            ))
         else:
             flask.abort(404, description='Unknown TimeFlip with id={}'.format(id))
 
@@ -1,5 +1,13 @@
-from typing import Union
-from datetime import datetime
+import calendar
+import os
+from typing import Union, Dict, Tuple, Iterator, List, Any, Callable
+from datetime import datetime, timedelta, timezone
+
+import flask
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.pool import NullPool
 
 from timefliptt.app import db
 
@@ -53,7 +61,7 @@ class Task(BaseModel):
     name = db.Column(db.VARCHAR(length=150), nullable=False)
     color = db.Column(db.VARCHAR(length=7), nullable=False)
 
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), index=True)
     category = db.relationship('Category', uselist=False, back_populates='tasks')
 
     # just for cascading
@@ -90,18 +98,85 @@ class FacetToTask(BaseModel):
         return o
 
 
+class EpochDateTime(db.TypeDecorator):
+    """Naive datetime, stored as an integer epoch (in microseconds, the naive datetime being taken as UTC).
+    Aware datetimes are converted to UTC first.
+    Comparisons, sorting and differences are then made on integers, in SQL.
+    """
+
+    impl = db.Integer
+    cache_ok = True
+
+    EPOCH = datetime(1970, 1, 1)
+    MICROSECOND = timedelta(microseconds=1)
+
+    @property
+    def python_type(self):
+        return datetime
+
+    @staticmethod
+    def naive(value: datetime) -> datetime:
+        """Convert an aware datetime to a naive one, in UTC
+        """
+
+        return value if value.tzinfo is None else value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    @classmethod
+    def to_epoch(cls, value: datetime) -> int:
+        return (cls.naive(value) - cls.EPOCH) // cls.MICROSECOND
+
+    @classmethod
+    def from_epoch(cls, value: int) -> datetime:
+        return cls.EPOCH + value * cls.MICROSECOND
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else self.to_epoch(value)
+
+    def process_literal_param(self, value, dialect):
+        return str(self.process_bind_param(value, dialect))
+
+    def result_processor(self, dialect, coltype):
+        # (called for each value of each row, so kept as small as possible)
+        epoch, microsecond = self.EPOCH, self.MICROSECOND
+
+        def process(value):
+            if type(value) is int:
+                return epoch + value * microsecond
+            elif isinstance(value, str):  # still stored as text (the database is being migrated)
+                return datetime.fromisoformat(value)
+            else:
+                return value
+
+        return process
+
+
 class HistoryElement(BaseModel):
-    start = db.Column(db.DateTime, nullable=False)
-    end = db.Column(db.DateTime, nullable=False)
+    # (previous values are needed to maintain rollups, hence `active_history`)
+    start = db.column_property(db.Column(EpochDateTime, nullable=False), active_history=True)
+    end = db.column_property(db.Column(EpochDateTime, nullable=False), active_history=True)
+    # duration, in microseconds (generated columns need SQLite >= 3.31, see `timefliptt.migrations`)
+    length = db.Column(db.Integer, db.Computed('"end" - start', persisted=True))
     original_facet = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.Text)
 
-    timeflip_device_id = db.Column(db.Integer, db.ForeignKey('timeflip_device.id', ondelete='SET NULL'))
+    timeflip_device_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('timeflip_device.id', ondelete='SET NULL')), active_history=True)
     timeflip_device = db.relationship('TimeFlipDevice', uselist=False, back_populates='history_elements')
 
-    task_id = db.Column(db.Integer, db.ForeignKey('task.id', ondelete='SET NULL'))
+    task_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey('task.id', ondelete='SET NULL')), active_history=True)
     task = db.relationship('Task', uselist=False, back_populates='history_elements')
 
+    # elements are selected by time frame (`end > ? AND start < ?`), possibly for some tasks or devices.
+    # Ids are never reused (`AUTOINCREMENT`), since they must remain unique with the archived elements
+    __table_args__ = (
+        db.Index('ix_history_element_end_start', 'end', 'start'),
+        db.Index('ix_history_element_task_end', 'task_id', 'end'),
+        db.Index('ix_history_element_device_end', 'timeflip_device_id', 'end'),
+        db.Index('ix_history_element_device_start', 'timeflip_device_id', 'start', 'original_facet'),
+        {'sqlite_autoincrement': True}
+    )
+
     @classmethod
     def create(
             cls,
@@ -147,3 +222,612 @@ class HistoryElement(BaseModel):
             return 0
         else:
             return int((min(end, self.end) - max(start, self.start)).total_seconds())
+
+    @classmethod
+    def duration_expr(cls, start: datetime = None, end: datetime = None):
+        """SQL counterpart of `duration()`, to be used on elements that overlap the time frame.
+        Dates are stored as epochs (in microseconds), so the difference is computed in microseconds then truncated,
+        as in `duration()`. Without time frame, the stored length is used.
+        """
+
+        if start is None:
+            start = datetime.min
+
+        if end is None:
+            end = datetime.max
+
+        if start > end:
+            raise ValueError('start > end')
+
+        if start == datetime.min and end == datetime.max:
+            return cls.length / 1000000
+
+        clipped_end = db.func.min(cls.end, db.literal(end, EpochDateTime))
+        clipped_start = db.func.max(cls.start, db.literal(start, EpochDateTime))
+
+        return db.type_coerce(clipped_end - clipped_start, db.Integer) / 1000000
+
+    @classmethod
+    def epochs(cls) -> Tuple[Any, Any]:
+        """Get the start and end columns as stored (epochs, in microseconds), to skip the conversion to datetimes
+        """
+
+        return db.type_coerce(cls.start, db.Integer), db.type_coerce(cls.end, db.Integer)
+
+    @classmethod
+    def create_rtree(cls, connection, populate: bool = False):
+        """Create the R*Tree that mirrors the time frames of the elements (and the triggers that keep it in sync)
+        """
+
+        for statement in HISTORY_ELEMENT_RTREE_DDL:
+            connection.exec_driver_sql(statement)
+
+        if populate:
+            connection.exec_driver_sql('DELETE FROM history_element_rtree')
+            connection.exec_driver_sql(
+                'INSERT INTO history_element_rtree SELECT id, {}, {} FROM history_element'.format(
+                    RTREE_START.format(element=''), RTREE_END.format(element='')))
+
+    @classmethod
+    def overlapping_ids(cls, start: datetime, end: datetime):
+        """Select the ids of the elements that may overlap `[start, end]`, using the R*Tree.
+        Coordinates are rounded outwards, so that the result should still be filtered on the actual columns.
+        """
+
+        return db.select(history_element_rtree.c.id).where(
+            history_element_rtree.c.end_epoch >= calendar.timegm(start.timetuple())).where(
+            history_element_rtree.c.start_epoch <= calendar.timegm(end.timetuple()) + 1)
+
+    @classmethod
+    def create_fts(cls, connection, populate: bool = False):
+        """Create the full-text index of the comments (and the triggers that keep it in sync)
+        """
+
+        for statement in HISTORY_ELEMENT_FTS_DDL:
+            connection.exec_driver_sql(statement)
+
+        if populate:
+            connection.exec_driver_sql("INSERT INTO history_element_fts(history_element_fts) VALUES ('rebuild')")
+
+    @classmethod
+    def matching_ids(cls, text: str, archive: int = None):
+        """Select the ids of the elements whose comment contains all the words of `text` (as prefixes),
+        using the full-text index (of the archive of year `archive`, if any).
+        Words are quoted, so that `text` cannot be interpreted as a FTS5 query.
+        """
+
+        query = ' '.join('"{}"*'.format(word.replace('"', '""')) for word in text.split())
+
+        fts = history_element_fts if archive is None else HistoryArchive.table_of(archive, 'history_element_fts')
+
+        return db.select(fts.c.rowid).where(fts.c.history_element_fts.op('MATCH')(query))
+
+
+# R*Tree mirror of the time frames of the history elements, as epochs (in seconds).
+# Since R*Tree coordinates are 32-bit floats, they are rounded outwards (a bit less than 3 minutes, currently).
+history_element_rtree = db.table(
+    'history_element_rtree', db.column('id'), db.column('start_epoch'), db.column('end_epoch'))
+
+RTREE_START = '{element}start / 1000000'
+RTREE_END = '{element}"end" / 1000000 + 1'
+
+HISTORY_ELEMENT_RTREE_DDL = (
+    'CREATE VIRTUAL TABLE IF NOT EXISTS history_element_rtree USING rtree(id, start_epoch, end_epoch)',
+    'CREATE TRIGGER IF NOT EXISTS history_element_rtree_insert AFTER INSERT ON history_element BEGIN '
+    'INSERT INTO history_element_rtree VALUES (NEW.id, {}, {}); END'.format(
+        RTREE_START.format(element='NEW.'), RTREE_END.format(element='NEW.')),
+    'CREATE TRIGGER IF NOT EXISTS history_element_rtree_update AFTER UPDATE OF start, "end" ON history_element BEGIN '
+    'UPDATE history_element_rtree SET start_epoch = {}, end_epoch = {} WHERE id = NEW.id; END'.format(
+        RTREE_START.format(element='NEW.'), RTREE_END.format(element='NEW.')),
+    'CREATE TRIGGER IF NOT EXISTS history_element_rtree_delete AFTER DELETE ON history_element BEGIN '
+    'DELETE FROM history_element_rtree WHERE id = OLD.id; END',
+)
+
+
+# Full-text index of the comments of the history elements.
+# It is an external content table, so the text is not duplicated (but the triggers must give the old values back).
+history_element_fts = db.table(
+    'history_element_fts', db.column('rowid'), db.column('history_element_fts'), db.column('comment'))
+
+HISTORY_ELEMENT_FTS_TABLE = \
+    'CREATE VIRTUAL TABLE IF NOT EXISTS {schema}history_element_fts USING fts5(' \
+    'comment, content=history_element, content_rowid=id, tokenize="unicode61 remove_diacritics 2")'
+
+HISTORY_ELEMENT_FTS_DDL = (
+    HISTORY_ELEMENT_FTS_TABLE.format(schema=''),
+    'CREATE TRIGGER IF NOT EXISTS history_element_fts_insert AFTER INSERT ON history_element BEGIN '
+    'INSERT INTO history_element_fts(rowid, comment) VALUES (NEW.id, NEW.comment); END',
+    'CREATE TRIGGER IF NOT EXISTS history_element_fts_update AFTER UPDATE OF comment ON history_element BEGIN '
+    "INSERT INTO history_element_fts(history_element_fts, rowid, comment) VALUES ('delete', OLD.id, OLD.comment); "
+    'INSERT INTO history_element_fts(rowid, comment) VALUES (NEW.id, NEW.comment); END',
+    'CREATE TRIGGER IF NOT EXISTS history_element_fts_delete AFTER DELETE ON history_element BEGIN '
+    "INSERT INTO history_element_fts(history_element_fts, rowid, comment) VALUES ('delete', OLD.id, OLD.comment); "
+    'END',
+)
+
+
+@db.event.listens_for(HistoryElement.__table__, 'after_create')
+def _create_history_element_rtree(target, connection, **kwargs):
+    HistoryElement.create_rtree(connection)
+    HistoryElement.create_fts(connection)
+
+
+@db.event.listens_for(HistoryElement.__table__, 'after_drop')
+def _drop_history_element_rtree(target, connection, **kwargs):
+    connection.exec_driver_sql('DROP TABLE IF EXISTS history_element_rtree')
+    connection.exec_driver_sql('DROP TABLE IF EXISTS history_element_fts')
+
+
+# tables of the archives (which are not created with the other ones)
+archive_metadata = db.MetaData()
+
+
+class HistoryArchive(db.Model):
+    """Yearly archive of the history elements that started during `year`, which is a separate SQLite file
+    (see `timefliptt.blueprints.history_archive`).
+    Archives are attached to a connection (as `archive_<year>`) only when a query reaches their time frame,
+    and are read-only (except that deleted tasks and devices are unlinked from their elements, see below).
+    """
+
+    MAX_ATTACHED = 10  # SQLite's default limit on the number of attached databases
+
+    __tablename__ = 'history_archive'
+
+    year = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    file_name = db.Column(db.Text, nullable=False)
+    first_start = db.Column(db.DateTime, nullable=False)
+    last_end = db.Column(db.DateTime, nullable=False)
+    num_elements = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def schema_of(year: int) -> str:
+        return 'archive_{:d}'.format(year)
+
+    @property
+    def schema(self) -> str:
+        return self.schema_of(self.year)
+
+    @classmethod
+    def table_of(cls, year: int, name: str = 'history_element') -> db.Table:
+        """Get a table (`history_element`, or `history_element_fts`) of the archive of `year`.
+
+        These are actual `Table` (in a separate metadata), since the schema of a lightweight `table()` is not part of
+        the cache key of the statements (so that the statement compiled for an archive would be used for another).
+        """
+
+        schema = cls.schema_of(year)
+        key = '{}.{}'.format(schema, name)
+
+        if key not in archive_metadata.tables:
+            if name == HistoryElement.__tablename__:
+                columns = [db.Column(c.name, c.type) for c in HistoryElement.__table__.c]
+            else:
+                columns = [db.Column(c.name) for c in history_element_fts.c]
+
+            db.Table(name, archive_metadata, *columns, schema=schema)
+
+        return archive_metadata.tables[key]
+
+    def table(self) -> db.Table:
+        return self.table_of(self.year)
+
+    @classmethod
+    def create_tables(cls, connection, year: int):
+        """Create the tables of the (attached) archive of `year`, if they do not exist yet:
+        a copy of `history_element` (same definition as in the main database), with an index on the time frame
+        and a full-text index of the comments
+        """
+
+        schema = cls.schema_of(year)
+        table = HistoryElement.__table__
+
+        create_table = connection.exec_driver_sql(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table.name, )).scalar()
+
+        connection.exec_driver_sql(create_table.replace(
+            'CREATE TABLE {}'.format(table.name), 'CREATE TABLE IF NOT EXISTS {}.{}'.format(schema, table.name), 1))
+        connection.exec_driver_sql(
+            'CREATE INDEX IF NOT EXISTS {}.ix_history_element_end_start ON history_element ("end", start)'.format(
+                schema))
+        connection.exec_driver_sql(HISTORY_ELEMENT_FTS_TABLE.format(schema=schema + '.'))
+
+    @classmethod
+    def attach(cls, connection, year: int, path: str):
+        """Attach the archive of `year`, if it is not already attached to `connection`.
+        Since SQLite limits the number of attached databases, the other archives are detached if needed
+        (which is only possible for the ones that were not written in the current transaction).
+        """
+
+        attached = connection.info.setdefault('timefliptt_archives', set())
+
+        if year not in attached:
+            for other in sorted(attached):
+                if len(attached) < cls.MAX_ATTACHED:
+                    break
+
+                try:
+                    connection.exec_driver_sql('DETACH DATABASE {}'.format(cls.schema_of(other)))
+                    attached.discard(other)
+                except OperationalError:  # still in use
+                    pass
+
+            connection.exec_driver_sql('ATTACH DATABASE ? AS {}'.format(cls.schema_of(year)), (path, ))
+            attached.add(year)
+
+    @classmethod
+    def paths(cls, connection) -> Dict[int, str]:
+        """Get the path of the file of each archive, by year
+        """
+
+        directory = os.path.abspath(flask.current_app.config['ARCHIVE_DIR'])
+        return dict((year, os.path.join(directory, file_name)) for year, file_name in connection.execute(
+            db.select(cls.year, cls.file_name)).all())
+
+    @classmethod
+    def read(cls, connection, year: int, path: str, select: Callable[[Any], Any]) -> List[Any]:
+        """Get the rows of `select(table)`, where `table` is the `history_element` table of the archive of `year`.
+        They are read from `connection` if the archive is attached to it, otherwise from the file (`path`) directly
+        (so that any number of archives can be read).
+        """
+
+        if year in connection.info.get('timefliptt_archives', set()):
+            return connection.execute(select(cls.table_of(year))).all()
+
+        engine = create_engine('sqlite:///{}'.format(path), poolclass=NullPool)
+
+        try:
+            with engine.connect() as archive_connection:
+                return archive_connection.execute(select(HistoryElement.__table__)).all()
+        finally:
+            engine.dispose()
+
+    @classmethod
+    def overflow(cls, connection, rows: List[Any]) -> db.Table:
+        """Copy `rows` (of `history_element` tables of archives) into a temporary table of `connection`, so that
+        the elements of the archives that could not be attached can still be queried along with the others.
+        The table is emptied first, so its content only lasts until the next call (on the same connection).
+        """
+
+        key = 'temp.history_element_overflow'
+        if key not in archive_metadata.tables:
+            db.Table(
+                'history_element_overflow',
+                archive_metadata,
+                *(db.Column(c.name, c.type) for c in HistoryElement.__table__.c),
+                schema='temp')
+
+        table = archive_metadata.tables[key]
+        table.create(connection, checkfirst=True)
+        connection.execute(table.delete())
+
+        if len(rows) > 0:
+            connection.execute(table.insert(), [row._mapping for row in rows])
+
+        return table
+
+    @classmethod
+    def max_id(cls, connection, year: int, path: str) -> int:
+        """Get the largest id of the elements of the archive of `year` (0 if there is none)
+        """
+
+        return cls.read(connection, year, path, lambda table: db.select(db.func.max(table.c.id)))[0][0] or 0
+
+    @classmethod
+    def unlink(cls, paths: List[str], column: str, value: int):
+        """Set `column` (`task_id` or `timeflip_device_id`) to `NULL` where it is `value`, in the archives
+        in `paths`. Each archive is opened on its own (so that they do not need to be attached together).
+        """
+
+        table = HistoryElement.__table__
+
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+
+            engine = create_engine('sqlite:///{}'.format(path), poolclass=NullPool)
+            try:
+                with engine.begin() as connection:
+                    connection.execute(table.update().where(table.c[column] == value).values({column: None}))
+            finally:
+                engine.dispose()
+
+    @classmethod
+    def reaching(cls, start: datetime, end: datetime) -> List['HistoryArchive']:
+        """Get the archives that contain elements within `[start, end]`
+        """
+
+        return cls.query\
+            .filter(cls.last_end > start)\
+            .filter(cls.first_start < end)\
+            .order_by(cls.year)\
+            .all()
+
+
+RollupKey = Tuple[int, datetime, int, int]
+RollupDelta = Tuple[int, int]  # (duration, carried)
+
+
+class HistoryRollup(db.Model):
+    """Total duration (in microseconds) of the history elements that have a task, per task and device,
+    within hourly and daily buckets.
+    Each element accounts for whole seconds (see `contributions()`), so that the durations agree with the ones
+    computed from the elements (which are truncated per element), as long as the time frame does not cut an element
+    that starts at a fraction of second: `carried` counts such elements in the buckets after the one they start in.
+    It is kept up to date when history elements are created, modified or deleted (see the mapper events below).
+    """
+
+    __tablename__ = 'history_rollup'
+
+    RESOLUTIONS = (3600, 86400)
+
+    id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.Integer, nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False)
+    duration = db.Column(db.Integer, nullable=False, default=0)
+    carried = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    timeflip_device_id = db.Column(db.Integer, db.ForeignKey('timeflip_device.id'))
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'))
+
+    __table_args__ = (
+        db.Index('ix_history_rollup_bucket', 'resolution', 'bucket', 'task_id', 'timeflip_device_id'),
+    )
+
+    @staticmethod
+    def floor(moment: datetime, resolution: int) -> datetime:
+        """Get the start of the bucket that contains `moment`
+        """
+
+        midnight = datetime.combine(moment.date(), datetime.min.time())
+        return midnight + timedelta(seconds=(moment - midnight).seconds // resolution * resolution)
+
+    @classmethod
+    def contributions(cls, start: datetime, end: datetime) -> Iterator[Tuple[int, datetime, int, int]]:
+        """Split `[start, end]` into buckets, and yield the duration (in microseconds) within each of them, and
+        whether the element is carried over the start of the bucket.
+        The seconds are counted from `start` and truncated, so that consecutive buckets add up to the truncated
+        duration of the element (as in `HistoryElement.duration()`).
+        If `start` is at a fraction of second, a bucket after the first one does not get the truncated duration
+        of the element within it (e.g., `[00:59:59.5, 01:00:00.7]` accounts for 1 second in `[01:00, 02:00]`
+        instead of 0): the element is then carried over the start of the bucket (if it accounts for any duration).
+        """
+
+        def elapsed(moment: datetime) -> int:  # whole seconds since `start`
+            delta = moment - start
+            return delta.days * 86400 + delta.seconds
+
+        for resolution in cls.RESOLUTIONS:
+            bucket = cls.floor(start, resolution)
+            while bucket < end:
+                next_bucket = bucket + timedelta(seconds=resolution)
+                duration = (elapsed(min(end, next_bucket)) - elapsed(max(start, bucket))) * 1000000
+                carried = int(bucket > start and start.microsecond != 0 and duration > 0)
+
+                yield resolution, bucket, duration, carried
+                bucket = next_bucket
+
+    @classmethod
+    def deltas(
+            cls,
+            start: datetime,
+            end: datetime,
+            task_id: int,
+            timeflip_device_id: int,
+            sign: int = 1,
+            deltas: Dict[RollupKey, RollupDelta] = None
+    ) -> Dict[RollupKey, RollupDelta]:
+        """Accumulate (in `deltas`) the changes in rollups caused by adding (`sign=1`) or removing (`sign=-1`)
+        an element
+        """
+
+        if deltas is None:
+            deltas = {}
+
+        if task_id is not None:
+            for resolution, bucket, duration, carried in cls.contributions(start, end):
+                key = (resolution, bucket, task_id, timeflip_device_id)
+                previous_duration, previous_carried = deltas.get(key, (0, 0))
+                deltas[key] = (previous_duration + sign * duration, previous_carried + sign * carried)
+
+        return deltas
+
+    @classmethod
+    def apply(cls, connection, deltas: Dict[RollupKey, RollupDelta]):
+        """Apply the changes to the rollups, with a few set-based statements (whatever the number of changes)
+        """
+
+        table = cls.__table__
+        deltas = dict((key, delta) for key, delta in deltas.items() if delta != (0, 0))
+
+        if len(deltas) == 0:
+            return
+
+        # find out which rollups already exist
+        buckets = [key[1] for key in deltas]
+        within = db.and_(
+            table.c.resolution.in_(set(key[0] for key in deltas)),
+            table.c.bucket.between(min(buckets), max(buckets)),
+            table.c.task_id.in_(set(key[2] for key in deltas))
+        )
+
+        existing = set(connection.execute(db.select(
+            table.c.resolution, table.c.bucket, table.c.task_id, table.c.timeflip_device_id).where(within)))
+
+        updates, inserts = [], []
+        for (resolution, bucket, task_id, timeflip_device_id), (delta, carried) in deltas.items():
+            values = dict(
+                r_resolution=resolution,
+                r_bucket=bucket,
+                r_task_id=task_id,
+                r_timeflip_device_id=timeflip_device_id,
+                r_delta=delta,
+                r_carried=carried
+            )
+
+            if (resolution, bucket, task_id, timeflip_device_id) in existing:
+                updates.append(values)
+            else:
+                inserts.append(values)
+
+        if len(updates) > 0:
+            connection.execute(table.update().where(db.and_(
+                table.c.resolution == db.bindparam('r_resolution'),
+                table.c.bucket == db.bindparam('r_bucket'),
+                table.c.task_id == db.bindparam('r_task_id'),
+                table.c.timeflip_device_id.is_(db.bindparam('r_timeflip_device_id'))
+            )).values(
+                duration=table.c.duration + db.bindparam('r_delta'),
+                carried=table.c.carried + db.bindparam('r_carried')
+            ), updates)
+
+        if len(inserts) > 0:
+            connection.execute(table.insert().values(
+                resolution=db.bindparam('r_resolution'),
+                bucket=db.bindparam('r_bucket'),
+                task_id=db.bindparam('r_task_id'),
+                timeflip_device_id=db.bindparam('r_timeflip_device_id'),
+                duration=db.bindparam('r_delta'),
+                carried=db.bindparam('r_carried')
+            ), inserts)
+
+        if any(delta < 0 for delta, _ in deltas.values()):
+            connection.execute(table.delete().where(within).where(table.c.duration <= 0))
+
+    @classmethod
+    def rebuild(cls, connection, archives: bool = True):
+        """Recompute all the rollups from the history, including the archived elements (unless `archives` is
+        `False`, e.g., if there is no catalog of the archives yet)
+        """
+
+        def select(table):
+            return db.select(table.c.start, table.c.end, table.c.task_id, table.c.timeflip_device_id)\
+                .where(table.c.task_id.isnot(None))
+
+        rows = connection.execute(select(HistoryElement.__table__)).all()
+
+        if archives:
+            for year, path in HistoryArchive.paths(connection).items():
+                if os.path.exists(path):
+                    rows.extend(HistoryArchive.read(connection, year, path, select))
+
+        deltas = {}
+        for start, end, task_id, timeflip_device_id in rows:
+            cls.deltas(start, end, task_id, timeflip_device_id, deltas=deltas)
+
+        connection.execute(cls.__table__.delete())
+
+        rows = [
+            dict(
+                resolution=resolution,
+                bucket=bucket,
+                task_id=task_id,
+                timeflip_device_id=device_id,
+                duration=delta,
+                carried=carried)
+            for (resolution, bucket, task_id, device_id), (delta, carried) in deltas.items() if delta > 0
+        ]
+
+        if len(rows) > 0:
+            connection.execute(cls.__table__.insert(), rows)
+
+
+class DataVersion(db.Model):
+    """Version of the data, which is bumped in the same transaction as every write (see
+    `timefliptt.blueprints.api.cache`), so that every process that uses the database sees the changes
+    (a single row).
+    """
+
+    __tablename__ = 'data_version'
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def get(cls, connection) -> int:
+        return connection.execute(db.select(cls.version)).scalar() or 0
+
+    @classmethod
+    def bump(cls, connection):
+        table = cls.__table__
+
+        if connection.execute(table.update().values(version=table.c.version + 1)).rowcount == 0:
+            connection.execute(table.insert().values(id=1, version=1))
+
+
+@db.event.listens_for(HistoryElement, 'after_insert')
+def _rollup_inserted_element(mapper, connection, target: HistoryElement):
+    HistoryRollup.apply(
+        connection, HistoryRollup.deltas(target.start, target.end, target.task_id, target.timeflip_device_id))
+
+
+@db.event.listens_for(HistoryElement, 'after_update')
+def _rollup_updated_element(mapper, connection, target: HistoryElement):
+    state = db.inspect(target)
+    attributes = ('start', 'end', 'task_id', 'timeflip_device_id')
+
+    if not any(state.attrs[name].history.has_changes() for name in attributes):
+        return
+
+    def previous(name: str):
+        history = state.attrs[name].history
+        return history.deleted[0] if history.deleted else getattr(target, name)
+
+    deltas = HistoryRollup.deltas(*(previous(name) for name in attributes), sign=-1)
+    HistoryRollup.deltas(target.start, target.end, target.task_id, target.timeflip_device_id, deltas=deltas)
+    HistoryRollup.apply(connection, deltas)
+
+
+@db.event.listens_for(HistoryElement, 'after_delete')
+def _rollup_deleted_element(mapper, connection, target: HistoryElement):
+    HistoryRollup.apply(
+        connection, HistoryRollup.deltas(target.start, target.end, target.task_id, target.timeflip_device_id, sign=-1))
+
+
+# When a task or a device is deleted, the elements of the main database are unlinked by the ORM (and their rollups
+# follow). What remains in the rollups thus comes from archived elements, which are unlinked once the deletion is
+# committed (archives are separate files, which cannot be detached once written in a transaction).
+
+def _unlink_archived(target: Any, connection, column: str):
+    session = object_session(target)
+    if session is None or not flask.has_app_context():
+        return
+
+    paths = list(HistoryArchive.paths(connection).values())
+    if len(paths) > 0:
+        session.info.setdefault('timefliptt_unlinked', []).append((paths, column, target.id))
+
+
+@db.event.listens_for(Task, 'after_delete')
+def _forget_deleted_task(mapper, connection, target: Task):
+    table = HistoryRollup.__table__
+    connection.execute(table.delete().where(table.c.task_id == target.id))
+
+    _unlink_archived(target, connection, 'task_id')
+
+
+@db.event.listens_for(TimeFlipDevice, 'after_delete')
+def _forget_deleted_device(mapper, connection, target: TimeFlipDevice):
+    table = HistoryRollup.__table__
+
+    # move the remaining rollups to "no device", like the elements
+    deltas = {}
+    for resolution, bucket, task_id, duration in connection.execute(
+            db.select(table.c.resolution, table.c.bucket, table.c.task_id, table.c.duration)
+            .where(table.c.timeflip_device_id == target.id)):
+        deltas[(resolution, bucket, task_id, target.id)] = -duration
+        deltas[(resolution, bucket, task_id, None)] = deltas.get((resolution, bucket, task_id, None), 0) + duration
+
+    HistoryRollup.apply(connection, deltas)
+
+    _unlink_archived(target, connection, 'timeflip_device_id')
+
+
+@db.event.listens_for(Session, 'after_commit')
+def _unlink_archived_committed(session: Session):
+    for paths, column, value in session.info.pop('timefliptt_unlinked', []):
+        HistoryArchive.unlink(paths, column, value)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _unlink_archived_rolled_back(session: Session):
+    session.info.pop('timefliptt_unlinked', None)
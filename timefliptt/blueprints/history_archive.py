@@ -0,0 +1,85 @@
+import os
+from datetime import datetime
+
+from sqlalchemy.engine import Connection
+
+from timefliptt.app import db
+from timefliptt.blueprints.base_models import HistoryElement, HistoryArchive
+
+
+class HistoryArchiver:
+    """Move the history elements that ended before a cutoff into yearly archives (by start), which are SQLite files
+    in `directory` (see `HistoryArchive`).
+
+    An archive contains a copy of the `history_element` table, with an index on the time frame and a full-text
+    index of the comments, so that it can be queried like the main database.
+    Rollups are computed from all the history, so they are kept as is.
+    Everything happens in the transaction of `connection`, except the creation of the files.
+    Since the archives that are written remain attached until the end of the transaction, at most
+    `HistoryArchive.MAX_ATTACHED` years are archived at once: `remaining` is then the number of years that are left
+    (to archive in another transaction).
+    """
+
+    def __init__(self, connection: Connection, directory: str):
+        self.connection = connection
+        self.directory = os.path.abspath(directory)
+
+        self.archived = 0
+        self.remaining = 0
+
+    def run(self, cutoff: datetime) -> int:
+        """Archive the elements that ended before `cutoff`, and return their number
+        """
+
+        table = HistoryElement.__table__
+
+        year_of_start = db.func.strftime('%Y', db.type_coerce(table.c.start, db.Integer) / 1000000, 'unixepoch')
+        years = [int(year) for year, in self.connection.execute(
+            db.select(db.func.distinct(year_of_start)).where(table.c.end <= cutoff))]
+
+        years = sorted(years)
+        self.remaining = max(0, len(years) - HistoryArchive.MAX_ATTACHED)
+
+        for year in years[:HistoryArchive.MAX_ATTACHED]:
+            self.archive_year(year, cutoff)
+
+        return self.archived
+
+    def archive_year(self, year: int, cutoff: datetime):
+        table = HistoryElement.__table__
+        archive_table = HistoryArchive.table_of(year)
+
+        # attach (and create) the archive
+        file_name = 'history-{:d}.sqlite'.format(year)
+        os.makedirs(self.directory, exist_ok=True)
+        HistoryArchive.attach(self.connection, year, os.path.join(self.directory, file_name))
+
+        HistoryArchive.create_tables(self.connection, year)
+
+        # move the elements
+        selected = db.and_(
+            table.c.end <= cutoff, table.c.start >= datetime(year, 1, 1), table.c.start < datetime(year + 1, 1, 1))
+
+        columns = [c.name for c in table.c if c.computed is None]
+        self.connection.execute(archive_table.insert().from_select(
+            columns, db.select(*(table.c[name] for name in columns)).where(selected)))
+
+        fts = HistoryArchive.table_of(year, 'history_element_fts')
+        self.connection.execute(fts.insert().from_select(
+            ['rowid', 'comment'], db.select(table.c.id, table.c.comment).where(selected)))
+
+        self.archived += self.connection.execute(table.delete().where(selected)).rowcount
+
+        # update the catalog
+        first_start, last_end, num_elements = self.connection.execute(db.select(
+            db.func.min(archive_table.c.start), db.func.max(archive_table.c.end), db.func.count())).one()
+
+        catalog = HistoryArchive.__table__
+        self.connection.execute(catalog.delete().where(catalog.c.year == year))
+        self.connection.execute(catalog.insert().values(
+            year=year,
+            file_name=file_name,
+            first_start=first_start,
+            last_end=last_end,
+            num_elements=num_elements
+        ))
@@ -0,0 +1,137 @@
+from datetime import datetime
+
+from typing import Iterable, Iterator, List, Tuple, Optional
+
+from sqlalchemy.engine import Connection
+
+from timefliptt.app import db
+from timefliptt.blueprints.base_models import TimeFlipDevice, HistoryElement, HistoryRollup
+
+Row = Tuple[int, datetime, datetime, int, Optional[int], Optional[str]]
+
+
+class HistoryCompactor:
+    """Merge the runs of history elements of a device that touch end to end and have the same facet and task
+    (e.g., after a pause), so that each run is a single element.
+
+    The history of each device is read once, sorted by start (using the index on the natural key).
+    The first element of a run is extended to the end of the run, and gets the (distinct) comments of the run,
+    while the other ones are deleted.
+    Since durations are truncated per element, the merged element may account for more seconds than its parts,
+    so the rollups are updated as well (the parts are removed, and the merged element is added).
+    """
+
+    BATCH_SIZE = 5000
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+
+        self.merged = 0  # number of runs
+        self.removed = 0  # number of deleted elements
+
+        self._updates = []
+        self._deletes = []
+        self._deltas = {}
+
+    def run(self, timeflip_device_ids: Iterable[int] = None, since: datetime = None) -> int:
+        """Compact the history of the devices (all of them by default), only considering the elements that end
+        after `since` (if any). Returns the number of elements that were removed.
+        """
+
+        if timeflip_device_ids is None:
+            timeflip_device_ids = [i for i, in self.connection.execute(db.select(TimeFlipDevice.id))]
+
+        for timeflip_device_id in timeflip_device_ids:
+            run: List[Row] = []
+
+            for row in self.elements(timeflip_device_id, since):
+                if len(run) > 0 and self.compatible(run[-1], row):
+                    run.append(row)
+                else:
+                    self.merge(run, timeflip_device_id)
+                    run = [row]
+
+            self.merge(run, timeflip_device_id)
+
+        self.flush()
+
+        return self.removed
+
+    @staticmethod
+    def compatible(previous: Row, row: Row) -> bool:
+        _, _, end, facet, task_id, _ = previous
+        _, next_start, _, next_facet, next_task_id, _ = row
+
+        return end == next_start and facet == next_facet and task_id == next_task_id
+
+    def elements(self, timeflip_device_id: int, since: datetime = None) -> Iterator[Row]:
+        """Yield the elements of a device, sorted by start, fetched by pages
+        """
+
+        query = db.select(
+            HistoryElement.id,
+            HistoryElement.start,
+            HistoryElement.end,
+            HistoryElement.original_facet,
+            HistoryElement.task_id,
+            HistoryElement.comment
+        ).where(HistoryElement.timeflip_device_id == timeflip_device_id)
+
+        if since is not None:
+            query = query.where(HistoryElement.end >= since)
+
+        query = query.order_by(HistoryElement.start, HistoryElement.id).limit(self.BATCH_SIZE)
+        page = self.connection.execute(query).all()
+
+        while len(page) > 0:
+            yield from page
+
+            last_start, last_id = page[-1][1], page[-1][0]
+            page = self.connection.execute(query.where(
+                db.tuple_(HistoryElement.start, HistoryElement.id) > db.tuple_(
+                    db.literal(last_start, HistoryElement.start.type), last_id))).all()
+
+    def merge(self, run: List[Row], timeflip_device_id: int):
+        if len(run) < 2:
+            return
+
+        task_id = run[0][4]
+        for _, start, end, _, _, _ in run:
+            HistoryRollup.deltas(start, end, task_id, timeflip_device_id, sign=-1, deltas=self._deltas)
+
+        HistoryRollup.deltas(run[0][1], run[-1][2], task_id, timeflip_device_id, deltas=self._deltas)
+
+        comments = list(dict.fromkeys(row[5] for row in run if row[5]))  # distinct, in order
+
+        self._updates.append(dict(
+            r_id=run[0][0],
+            r_end=run[-1][2],
+            r_comment='\n'.join(comments) if len(comments) > 0 else None
+        ))
+
+        self._deletes.extend(row[0] for row in run[1:])
+
+        self.merged += 1
+        self.removed += len(run) - 1
+
+        if len(self._deletes) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        table = HistoryElement.__table__
+
+        if len(self._updates) > 0:
+            self.connection.execute(
+                table.update().where(table.c.id == db.bindparam('r_id')).values(
+                    end=db.bindparam('r_end'), comment=db.bindparam('r_comment')),
+                self._updates
+            )
+
+        for i in range(0, len(self._deletes), self.BATCH_SIZE):
+            self.connection.execute(table.delete().where(table.c.id.in_(self._deletes[i:i + self.BATCH_SIZE])))
+
+        HistoryRollup.apply(self.connection, self._deltas)
+
+        self._updates = []
+        self._deletes = []
+        self._deltas = {}
@@ -0,0 +1,236 @@
+import csv
+import json
+import os
+from typing import Iterable, Iterator, Dict, List, Tuple, Any, TextIO, Optional
+
+from marshmallow import Schema, fields, validate, pre_load, ValidationError, EXCLUDE
+from sqlalchemy.engine import Connection
+
+from timefliptt.app import db
+from timefliptt.blueprints.base_models import TimeFlipDevice, Category, Task, HistoryElement, HistoryRollup, \
+    HistoryArchive
+from timefliptt.blueprints.api.schemas import NaiveDateTime
+
+
+class HistoryImportError(Exception):
+    def __init__(self, errors: Dict[int, Any]):
+        super().__init__('{} invalid row(s)'.format(len(errors)))
+        self.errors = errors
+
+
+class ImportRowSchema(Schema):
+    """A row, with the same columns as the export (`id`, `task_name`, `category` and `category_name` are only used
+    to resolve the task if `task` is not given)
+    """
+
+    class Meta:
+        unknown = EXCLUDE
+
+    start = NaiveDateTime(required=True)  # (in UTC, if there is an offset)
+    end = NaiveDateTime(required=True)
+    original_facet = fields.Integer(required=True, validate=validate.Range(min=0))
+    comment = fields.Str(allow_none=True)
+
+    timeflip_device = fields.Str(required=True)  # id, address or name
+    task = fields.Integer(allow_none=True)
+    task_name = fields.Str(allow_none=True)
+    category_name = fields.Str(allow_none=True)
+
+    @pre_load
+    def empty_is_none(self, data, **kwargs):
+        # CSV cells are strings, and empty when missing
+        return dict((k, v if v != '' else None) for k, v in data.items() if v is not None)
+
+    @pre_load
+    def device_as_str(self, data, **kwargs):
+        if isinstance(data.get('timeflip_device', None), int):
+            data['timeflip_device'] = str(data['timeflip_device'])
+        return data
+
+
+class HistoryImporter:
+    """Import history elements in bulk, from rows of the export format.
+
+    Devices and tasks are resolved against maps that are loaded once, rows are validated and inserted by batches
+    (with a Core `executemany`), and rollups are updated accordingly.
+    Rows whose natural key (device, start, facet) already exists (archived or not) are skipped, so that importing
+    twice is harmless.
+    Everything happens in the transaction of `connection`, which should be rolled back if an error is raised.
+    """
+
+    BATCH_SIZE = 5000
+    MAX_ERRORS = 100
+
+    FORMATS = ('csv', 'ndjson')
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+
+        self.imported = 0
+        self.skipped = 0
+        self.errors: Dict[int, Any] = {}
+
+        # devices, by id, address and name
+        self.devices: Dict[str, int] = {}
+        for device_id, address, name in connection.execute(
+                db.select(TimeFlipDevice.id, TimeFlipDevice.address, TimeFlipDevice.name)):
+            if name is not None:
+                self.devices[name] = device_id
+            self.devices[address.upper()] = device_id
+            self.devices[str(device_id)] = device_id
+
+        # tasks, by id and name (with or without category)
+        self.task_ids = set()
+        self.tasks: Dict[Tuple[Optional[str], str], Optional[int]] = {}
+        ids_by_name: Dict[str, set] = {}
+        for task_id, name, category_name in connection.execute(
+                db.select(Task.id, Task.name, Category.name).outerjoin(Category, Category.id == Task.category_id)):
+            self.task_ids.add(task_id)
+            self.tasks[(category_name, name)] = task_id
+            ids_by_name.setdefault(name, set()).add(task_id)
+
+        for name, ids in ids_by_name.items():
+            self.tasks[(None, name)] = next(iter(ids)) if len(ids) == 1 else None  # ambiguous
+
+        self.archives = HistoryArchive.paths(connection)
+
+    @classmethod
+    def read(cls, fp: TextIO, format: str) -> Iterator[dict]:
+        """Read the rows of a CSV or NDJSON file
+        """
+
+        if format == 'csv':
+            yield from csv.DictReader(fp)
+        elif format == 'ndjson':
+            for line in fp:
+                if line.strip() != '':
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield {}  # will be reported as invalid
+        else:
+            raise ValueError('unknown format {}'.format(format))
+
+    def run(self, rows: Iterable[dict]):
+        """Import the rows. Raises `HistoryImportError` if some of them are invalid
+        """
+
+        batch = []
+        first = 1
+
+        for row in rows:
+            batch.append(row)
+
+            if len(batch) == self.BATCH_SIZE:
+                self.import_batch(batch, first)
+                first += len(batch)
+                batch = []
+
+            if len(self.errors) >= self.MAX_ERRORS:
+                break
+
+        if len(batch) > 0 and len(self.errors) < self.MAX_ERRORS:
+            self.import_batch(batch, first)
+
+        if len(self.errors) > 0:
+            raise HistoryImportError(self.errors)
+
+    def resolve_task(self, row: dict) -> Optional[int]:
+        if row.get('task', None) is not None:
+            if row['task'] not in self.task_ids:
+                raise ValidationError('Unknown task with id={}'.format(row['task']), 'task')
+            return row['task']
+        elif row.get('task_name', None) is not None:
+            task_id = self.tasks.get((row.get('category_name', None), row['task_name']), None)
+            if task_id is None:
+                raise ValidationError('Unknown (or ambiguous) task {}'.format(row['task_name']), 'task_name')
+            return task_id
+        else:
+            return None
+
+    def import_batch(self, batch: List[dict], first: int):
+        """Validate and insert a batch of rows, `first` being the number of the first one
+        """
+
+        try:
+            rows = ImportRowSchema(many=True).load(batch)
+        except ValidationError as e:
+            for i, messages in e.messages.items():
+                self.errors[first + i] = messages
+            return
+
+        elements = []
+
+        for i, row in enumerate(rows, start=first):
+            try:
+                device_id = self.devices.get(row['timeflip_device'], self.devices.get(
+                    row['timeflip_device'].upper(), None))
+                if device_id is None:
+                    raise ValidationError('Unknown device {}'.format(row['timeflip_device']), 'timeflip_device')
+
+                if row['start'] > row['end']:
+                    raise ValidationError('start > end', 'start')
+
+                elements.append(dict(
+                    start=row['start'],
+                    end=row['end'],
+                    original_facet=row['original_facet'],
+                    comment=row.get('comment', None),
+                    timeflip_device_id=device_id,
+                    task_id=self.resolve_task(row)
+                ))
+            except ValidationError as e:
+                self.errors[i] = e.messages
+
+        if len(self.errors) > 0 or len(elements) == 0:  # no need to insert anything, it will be rolled back
+            return
+
+        # skip the elements that already exist (or that are repeated)
+        existing = self.existing_keys(elements)
+        new_elements = []
+        for element in elements:
+            key = (element['timeflip_device_id'], element['start'], element['original_facet'])
+            if key not in existing:
+                existing.add(key)
+                new_elements.append(element)
+
+        self.skipped += len(elements) - len(new_elements)
+
+        if len(new_elements) > 0:
+            self.connection.execute(HistoryElement.__table__.insert(), new_elements)
+
+            deltas = {}
+            for element in new_elements:
+                HistoryRollup.deltas(
+                    element['start'], element['end'], element['task_id'], element['timeflip_device_id'], deltas=deltas)
+
+            HistoryRollup.apply(self.connection, deltas)
+            self.imported += len(new_elements)
+
+    def existing_keys(self, elements: List[dict]) -> set:
+        """Get the natural keys of the history that could conflict with `elements`
+        """
+
+        keys = set()
+        devices = {}
+
+        for element in elements:
+            bounds = devices.setdefault(element['timeflip_device_id'], [element['start'], element['start']])
+            bounds[0] = min(bounds[0], element['start'])
+            bounds[1] = max(bounds[1], element['start'])
+
+        for device_id, (start, end) in devices.items():
+            def select(table):
+                return db.select(table.c.timeflip_device_id, table.c.start, table.c.original_facet)\
+                    .where(table.c.timeflip_device_id == device_id)\
+                    .where(table.c.start.between(start, end))
+
+            keys.update(self.connection.execute(select(HistoryElement.__table__)))
+
+            # ... and the archives (by year of start)
+            for year in range(start.year, end.year + 1):
+                path = self.archives.get(year, None)
+                if path is not None and os.path.exists(path):
+                    keys.update(HistoryArchive.read(self.connection, year, path, select))
+
+        return keys
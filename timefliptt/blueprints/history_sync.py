@@ -0,0 +1,183 @@
+import queue
+import time
+from datetime import datetime, timedelta
+from threading import Thread
+
+from typing import Iterator, List, Tuple, Optional
+
+import flask
+
+from timefliptt.app import db
+from timefliptt.timeflip import History
+from timefliptt.blueprints.base_models import TimeFlipDevice, FacetToTask, HistoryElement, HistoryRollup
+from timefliptt.blueprints.history_compaction import HistoryCompactor
+
+Batch = Tuple[str, History, datetime]  # (address, history, end date)
+
+
+def timed_history(history: History, end_date: datetime) -> Iterator[Tuple[datetime, datetime, int]]:
+    """Get the start, end and facet of each element of the history, which ends at `end_date`
+    """
+
+    start = end_date - timedelta(seconds=sum(h[1] for h in history))
+    start -= timedelta(microseconds=start.microsecond)  # set microsecond to zero
+
+    for facet, duration, _ in history:
+        end = start + timedelta(seconds=duration)
+        yield start, end, facet
+        start = end
+
+
+def split_history(history: History, end_date: datetime, size: int) -> Iterator[Tuple[History, datetime]]:
+    """Split the history, which ends at `end_date`, into parts of at most `size` elements (the oldest first),
+    with the date at which each of them ends
+    """
+
+    for i in range(0, len(history), size):
+        yield history[i:i + size], end_date - timedelta(seconds=sum(h[1] for h in history[i + size:]))
+
+
+class HistoryWriter:
+    """Store the history that the daemon pulls from the devices (see `timeflip.sync_start()`).
+
+    `put()` only queues the history, so that the loop of the daemon never waits for the database.
+    A thread of its own writes what is queued, several batches at once (up to `batch_size` elements per transaction,
+    longer histories being split), with a Core `executemany` and the rollups updated accordingly, so that requests
+    are never kept waiting for long by the lock of the database.
+    If a transaction fails, it is tried again (up to `retries` times, waiting longer each time from `retry_delay`
+    seconds), since the history is already deleted from the device.
+    """
+
+    def __init__(self, app: flask.Flask, batch_size: int = 500, retries: int = 3, retry_delay: float = 1.):
+        self.app = app
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.written = 0  # number of elements
+
+        self._queue: 'queue.Queue[Optional[Batch]]' = queue.Queue()
+        self._thread: Optional[Thread] = None
+
+    def put(self, address: str, history: History, end_date: datetime):
+        for part, part_end_date in split_history(history, end_date, self.batch_size):
+            self._queue.put((address, part, part_end_date))
+
+    def start(self):
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write what remains in the queue, then stop
+        """
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        stop = False
+        carried: Optional[Batch] = None  # does not fit in the previous transaction
+
+        while not stop:
+            batch = carried if carried is not None else self._queue.get()
+            carried = None
+
+            if batch is None:
+                break
+
+            batches = [batch]
+            size = len(batch[1])
+
+            # gather what is waiting as well
+            while size < self.batch_size:
+                try:
+                    batch = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if batch is None:
+                    stop = True
+                    break
+
+                if size + len(batch[1]) > self.batch_size:
+                    carried = batch
+                    break
+
+                batches.append(batch)
+                size += len(batch[1])
+
+            self.write_or_retry(batches, size)
+
+    def write_or_retry(self, batches: List[Batch], size: int):
+        """Write the batches, trying again if it fails (the thread must survive whatever happens)
+        """
+
+        for attempt in range(self.retries + 1):
+            with self.app.app_context():
+                try:
+                    self.write(batches)
+                    return
+                except Exception as e:
+                    db.session.rollback()
+
+                    if attempt < self.retries:
+                        self.app.logger.warning('history sync: cannot write {} element(s) ({}), trying again'.format(
+                            size, e))
+                    else:
+                        self.app.logger.exception('history sync: cannot write {} element(s), which are lost'.format(
+                            size))
+                        return
+
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+    def write(self, batches: List[Batch]):
+        """Store the history of each batch, in a single transaction
+        """
+
+        from timefliptt.blueprints.api.cache import mark_data_changed
+
+        connection = db.session.connection()
+
+        devices = dict(connection.execute(db.select(TimeFlipDevice.address, TimeFlipDevice.id)).all())
+        facet_to_task = dict(
+            ((device_id, facet), task_id) for device_id, facet, task_id in connection.execute(
+                db.select(FacetToTask.timeflip_device_id, FacetToTask.facet, FacetToTask.task_id)))
+
+        elements = []
+        for address, history, end_date in batches:
+            device_id = devices.get(address, None)
+            if device_id is None:  # the device was removed in the meantime
+                continue
+
+            for start, end, facet in timed_history(history, end_date):
+                elements.append(dict(
+                    start=start,
+                    end=end,
+                    original_facet=facet,
+                    comment=None,
+                    timeflip_device_id=device_id,
+                    task_id=facet_to_task.get((device_id, facet), None)
+                ))
+
+        if len(elements) == 0:
+            return
+
+        connection.execute(HistoryElement.__table__.insert(), elements)
+
+        deltas = {}
+        for element in elements:
+            HistoryRollup.deltas(
+                element['start'], element['end'], element['task_id'], element['timeflip_device_id'], deltas=deltas)
+
+        HistoryRollup.apply(connection, deltas)
+
+        if flask.current_app.config.get('COMPACT_HISTORY'):
+            HistoryCompactor(connection).run(
+                set(e['timeflip_device_id'] for e in elements), min(e['start'] for e in elements))
+
+        mark_data_changed()
+        db.session.commit()
+
+        self.written += len(elements)
@@ -1,7 +1,6 @@
 import flask
 from flask import Blueprint
 
-from timefliptt.timeflip import hard_logout
 from timefliptt.blueprints.base_models import TimeFlipDevice
 from timefliptt.blueprints.base_views import RenderTemplateView
 
@@ -37,10 +36,6 @@ blueprint.add_url_rule('/timeflip-<int:id>', view_func=TimeflipView.as_view('tim
 class TimeflipAddView(RenderTemplateView):
     template_name = 'visitors/timeflip-add.html'
 
-    def get(self, *args, **kwargs):
-        hard_logout()  # otherwise, this messed up the search for new devices
-        return super().get(*args, **kwargs)
-
 
 blueprint.add_url_rule('/timeflip-add', view_func=TimeflipAddView.as_view('timeflip-add'))
 
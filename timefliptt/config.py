@@ -17,6 +17,17 @@ class Config:
     DB_FILE = 'timeflip-tt.sqlite'
     SECRET_KEY = '_wH@t3v3R'
     WITH_TIMEFLIP = True
+    COUNT_QUERIES = False  # report the number of SQL queries of each request in the `X-Query-Count` header
+    ARCHIVE_DIR = 'timeflip-tt-archives'  # where the yearly archives of the history are stored
+    ARCHIVE_AFTER = 365  # number of days after which history elements are archived (by the `-A` command)
+    COMPACT_HISTORY = False  # merge the elements that touch end to end after getting the history of a device
+    MAX_CONNECTIONS = 4  # number of devices the daemon keeps connected (the least recently used one is disconnected)
+    OPERATION_DEADLINE = 10  # seconds a request waits for a BLE operation, before answering with where to poll it
+    HISTORY_SYNC_INTERVAL = 300  # seconds between two pulls of the history of the connected devices (0 to disable)
+    HISTORY_SYNC_BATCH_SIZE = 500  # maximum number of history elements written in a single transaction by the sync
+    DISCOVERY_TTL = 60  # seconds during which the result of a discovery of the devices around is reused
+    DISCOVERY_CONCURRENCY = 4  # number of devices that are probed at the same time during a discovery
+    DISCOVERY_TIMEOUT = 5  # seconds after which a probed device is not considered to be a TimeFlip
 
     # App info
     APP_INFO = {
@@ -0,0 +1,203 @@
+"""Upgrade existing databases in place.
+
+The version of the schema is stored in the ``user_version`` of the SQLite file,
+and is the number of migrations that were applied (a new database is directly created at the latest version).
+"""
+
+import os
+from typing import Callable, List, Tuple
+
+import flask
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn
+
+from timefliptt.app import db
+from timefliptt.blueprints.base_models import HistoryRollup, HistoryElement, HistoryArchive, DataVersion
+
+
+MIN_SQLITE_VERSION = (3, 31, 0)  # for the generated columns (`HistoryElement.length`)
+
+
+def check_sqlite_version(connection: Connection):
+    version = connection.execute(db.text('SELECT sqlite_version()')).scalar()
+
+    if tuple(int(v) for v in version.split('.')) < MIN_SQLITE_VERSION:
+        raise RuntimeError('SQLite {} is too old, at least {} is required'.format(
+            version, '.'.join(str(v) for v in MIN_SQLITE_VERSION)))
+
+
+def get_version(connection: Connection) -> int:
+    return connection.execute(db.text('PRAGMA user_version')).scalar()
+
+
+def set_version(connection: Connection, version: int):
+    connection.execute(db.text('PRAGMA user_version = {:d}'.format(version)))
+
+
+def _create_missing_indexes(connection: Connection):
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _add_rollups(connection: Connection):
+    HistoryRollup.__table__.create(connection, checkfirst=True)
+    HistoryRollup.rebuild(connection, archives=False)  # (no archives yet)
+
+
+def _add_history_rtree(connection: Connection):
+    HistoryElement.create_rtree(connection, populate=True)
+
+
+def _add_history_fts(connection: Connection):
+    HistoryElement.create_fts(connection, populate=True)
+
+
+def _add_archive_catalog(connection: Connection):
+    HistoryArchive.__table__.create(connection, checkfirst=True)
+
+
+# `YYYY-MM-DD HH:MM:SS.ffffff` text (SQLAlchemy's `DateTime` in SQLite) to epoch in microseconds
+TEXT_TO_EPOCH = "CAST(strftime('%s', substr({0}, 1, 19)) AS INTEGER) * 1000000 + CAST(substr({0}, 21, 6) AS INTEGER)"
+
+
+def _copy_history_as_epochs(connection: Connection, schema: str):
+    """Copy the elements of `{schema}.history_element_text` into `{schema}.history_element`, converting the dates
+    """
+
+    columns = [c.name for c in HistoryElement.__table__.c if c.computed is None]
+    values = [TEXT_TO_EPOCH.format('"{}"'.format(c)) if c in ('start', 'end') else '"{}"'.format(c) for c in columns]
+
+    connection.exec_driver_sql('INSERT INTO {0}.history_element ({1}) SELECT {2} FROM {0}.history_element_text'.format(
+        schema, ', '.join('"{}"'.format(c) for c in columns), ', '.join(values)))
+    connection.exec_driver_sql('DROP TABLE {}.history_element_text'.format(schema))
+
+
+def _recreate_history_table(connection: Connection, renamed_to: str):
+    """Rename `history_element` to `renamed_to`, and create it again from the model.
+    The R*Tree, the full-text index and the indexes are created again with the table (and filled by the triggers).
+    """
+
+    for virtual_table in ('history_element_rtree', 'history_element_fts'):
+        for trigger in ('insert', 'update', 'delete'):
+            connection.exec_driver_sql('DROP TRIGGER IF EXISTS {}_{}'.format(virtual_table, trigger))
+        connection.exec_driver_sql('DROP TABLE IF EXISTS {}'.format(virtual_table))
+
+    for index in HistoryElement.__table__.indexes:
+        connection.exec_driver_sql('DROP INDEX IF EXISTS {}'.format(index.name))
+
+    connection.exec_driver_sql('ALTER TABLE history_element RENAME TO {}'.format(renamed_to))
+    HistoryElement.__table__.create(connection)
+
+
+def _store_history_dates_as_epochs(connection: Connection):
+    _recreate_history_table(connection, 'history_element_text')
+    _copy_history_as_epochs(connection, 'main')
+
+    # same for the archives
+    directory = os.path.abspath(flask.current_app.config['ARCHIVE_DIR'])
+
+    for year, file_name in connection.execute(db.select(HistoryArchive.year, HistoryArchive.file_name)).all():
+        path = os.path.join(directory, file_name)
+        if not os.path.exists(path):
+            continue
+
+        HistoryArchive.attach(connection, year, path)
+        schema = HistoryArchive.schema_of(year)
+
+        connection.exec_driver_sql('DROP TABLE IF EXISTS {}.history_element_fts'.format(schema))
+        connection.exec_driver_sql('DROP INDEX IF EXISTS {}.ix_history_element_end_start'.format(schema))
+        connection.exec_driver_sql('ALTER TABLE {}.history_element RENAME TO history_element_text'.format(schema))
+
+        HistoryArchive.create_tables(connection, year)
+        _copy_history_as_epochs(connection, schema)
+        connection.exec_driver_sql(
+            "INSERT INTO {}.history_element_fts(history_element_fts) VALUES ('rebuild')".format(schema))
+
+
+def _never_reuse_history_ids(connection: Connection):
+    create_table = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'history_element'").scalar()
+
+    if 'AUTOINCREMENT' not in create_table.upper():
+        _recreate_history_table(connection, 'history_element_old')
+
+        columns = ', '.join('"{}"'.format(c.name) for c in HistoryElement.__table__.c if c.computed is None)
+        connection.exec_driver_sql(
+            'INSERT INTO history_element ({0}) SELECT {0} FROM history_element_old'.format(columns))
+        connection.exec_driver_sql('DROP TABLE history_element_old')
+
+    # the next ids come after the ones of the archived elements as well
+    max_id = max([connection.execute(db.select(db.func.max(HistoryElement.id))).scalar() or 0] + [
+        HistoryArchive.max_id(connection, year, path)
+        for year, path in HistoryArchive.paths(connection).items() if os.path.exists(path)
+    ])
+
+    connection.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'history_element'")
+    connection.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES ('history_element', ?)", (max_id, ))
+
+
+def _add_missing_rollup_columns(connection: Connection):
+    existing = set(column['name'] for column in db.inspect(connection).get_columns(HistoryRollup.__tablename__))
+
+    for column in HistoryRollup.__table__.c:
+        if column.name not in existing:
+            connection.exec_driver_sql('ALTER TABLE {} ADD COLUMN {}'.format(
+                HistoryRollup.__tablename__, CreateColumn(column).compile(dialect=connection.dialect)))
+
+
+def _rebuild_rollups(connection: Connection):
+    _add_missing_rollup_columns(connection)  # (e.g., `carried`, which the rebuild fills)
+    HistoryRollup.rebuild(connection)
+
+
+def _add_data_version(connection: Connection):
+    DataVersion.__table__.create(connection, checkfirst=True)
+
+
+# (description, function), in order. Migrations should not lose data, and only be appended to the list.
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ('Add hourly and daily rollups of the history', _add_rollups),
+    ('Add indexes on history elements and tasks', _create_missing_indexes),
+    ('Add an R*Tree on the time frames of history elements', _add_history_rtree),
+    ('Add an index on the natural key of history elements', _create_missing_indexes),
+    ('Add a full-text index on the comments of history elements', _add_history_fts),
+    ('Add the catalog of the archives of the history', _add_archive_catalog),
+    ('Store the dates of history elements as epochs, with their duration', _store_history_dates_as_epochs),
+    ('Never reuse the ids of history elements (which may be archived)', _never_reuse_history_ids),
+    ('Count whole seconds per history element in the rollups', _rebuild_rollups),
+    ('Add the version of the data, shared by every process', _add_data_version),
+    ('Count the elements carried over sub-second bounds in the rollups', _rebuild_rollups),
+]
+
+
+def latest_version() -> int:
+    return len(MIGRATIONS)
+
+
+def stamp(connection: Connection):
+    """Mark a database created from the current models as up to date
+    """
+
+    check_sqlite_version(connection)
+    set_version(connection, latest_version())
+
+
+def upgrade(connection: Connection) -> List[str]:
+    """Apply the missing migrations, and return their descriptions
+    """
+
+    check_sqlite_version(connection)
+
+    version = get_version(connection)
+    if version > latest_version():
+        raise RuntimeError(
+            'Database is at version {}, which is newer than this application ({})'.format(version, latest_version()))
+
+    applied = []
+    for i, (description, migration) in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(connection)
+        set_version(connection, i)
+        applied.append(description)
+
+    return applied
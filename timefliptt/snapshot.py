@@ -0,0 +1,275 @@
+"""Columnar snapshot of the history, for analytics.
+
+A snapshot is a directory that contains one ``.npy`` file per column of the history elements
+(``id``, ``start``, ``end``, ``original_facet``, ``task_id`` and ``timeflip_device_id``), sorted by start,
+and a ``meta.json`` file (number of elements, category of each task, etc).
+Dates are epochs in microseconds (naive dates are taken as is, as UTC), and missing ids are ``-1``.
+Columns are fixed-width arrays, which are read through ``numpy.memmap``, so that opening a snapshot costs nothing
+and only the pages that are actually needed are read.
+
+``HistorySnapshot`` computes the same aggregates as the statistics views.
+"""
+
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+
+from typing import Iterable, Dict, List, Tuple, Any, Optional
+
+import numpy
+
+VERSION = 1
+
+COLUMNS = {
+    'id': '<i8',
+    'start': '<i8',
+    'end': '<i8',
+    'original_facet': '<i2',
+    'task_id': '<i4',
+    'timeflip_device_id': '<i4'
+}
+
+NO_ID = -1
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def to_epoch(moment: datetime) -> int:
+    """Get the epoch of `moment`, in microseconds
+    """
+
+    return (moment - EPOCH) // MICROSECOND
+
+
+def from_epoch(epoch: int) -> datetime:
+    return EPOCH + int(epoch) * MICROSECOND
+
+
+def write_snapshot(
+        directory: str,
+        rows: Iterable[Tuple[int, datetime, datetime, int, Optional[int], Optional[int]]],
+        num_rows: int,
+        tasks: Dict[int, Optional[int]]
+):
+    """Write a snapshot of `num_rows` elements, given as `(id, start, end, original_facet, task_id,
+    timeflip_device_id)` and sorted by start. `tasks` gives the category of each task.
+
+    The snapshot is written aside, then replaces the one in `directory` (if any).
+    """
+
+    directory = os.path.abspath(directory)
+    tmp_directory = directory + '.tmp'
+
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+
+    os.makedirs(tmp_directory)
+
+    columns = dict(
+        (name, numpy.lib.format.open_memmap(
+            os.path.join(tmp_directory, '{}.npy'.format(name)), mode='w+', dtype=dtype, shape=(num_rows, )))
+        for name, dtype in COLUMNS.items()
+    )
+
+    i = 0
+    for i, (element_id, start, end, facet, task_id, timeflip_device_id) in enumerate(rows):
+        columns['id'][i] = element_id
+        columns['start'][i] = to_epoch(start)
+        columns['end'][i] = to_epoch(end)
+        columns['original_facet'][i] = facet
+        columns['task_id'][i] = NO_ID if task_id is None else task_id
+        columns['timeflip_device_id'][i] = NO_ID if timeflip_device_id is None else timeflip_device_id
+    else:
+        if num_rows > 0 and i != num_rows - 1:
+            raise ValueError('expected {} rows, got {}'.format(num_rows, i + 1))
+
+    max_duration = int((columns['end'] - columns['start']).max()) if num_rows > 0 else 0
+
+    for column in columns.values():
+        column.flush()
+
+    del columns
+
+    with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': VERSION,
+            'date_created': datetime.now().isoformat(),
+            'num_elements': num_rows,
+            'columns': COLUMNS,
+            'max_duration': max_duration,
+            'tasks': dict((str(task_id), NO_ID if c is None else c) for task_id, c in tasks.items())
+        }, f)
+
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+
+    os.rename(tmp_directory, directory)
+
+
+class HistorySnapshot:
+    """Read a snapshot. Columns are available as (read-only, memory-mapped) arrays, e.g., `snapshot.start`.
+
+    Filters are the same as the ones of the API: `start`, `end` (dates), `task`, `category` and `timeflip`
+    (lists of ids). As in the statistics views, only the elements that have a task are accounted for,
+    and durations are clipped to the time frame.
+    """
+
+    DISCRIMINANTS = ('task', 'category', 'timeflip')
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        if self.meta['version'] != VERSION:
+            raise ValueError('unsupported snapshot version {}'.format(self.meta['version']))
+
+        for name in COLUMNS:
+            setattr(self, name, numpy.load(os.path.join(directory, '{}.npy'.format(name)), mmap_mode='r'))
+
+        # category of each task, as an array indexed by task id
+        tasks = dict((int(t), c) for t, c in self.meta['tasks'].items())
+        self.task_category = numpy.full(max(tasks, default=0) + 1, NO_ID, dtype='<i4')
+        self.task_category[list(tasks.keys())] = list(tasks.values())
+
+    def __len__(self) -> int:
+        return self.meta['num_elements']
+
+    @staticmethod
+    def time_frame(start: datetime = None, end: datetime = None) -> Tuple[int, int]:
+        """Get the time frame, as epochs (unbounded time frames are bounded by the extreme values)
+        """
+
+        info = numpy.iinfo(COLUMNS['start'])
+        return (info.min if start is None else to_epoch(start)), (info.max if end is None else to_epoch(end))
+
+    def select(
+            self,
+            start: datetime = None,
+            end: datetime = None,
+            task: List[int] = None,
+            category: List[int] = None,
+            timeflip: List[int] = None
+    ) -> numpy.ndarray:
+        """Get the indices of the elements (with a task) that fit into the filters.
+        Since the elements are sorted by start, the time frame is found by bisection.
+        """
+
+        s, e = self.time_frame(start, end)
+
+        lower = 0 if start is None else numpy.searchsorted(self.start, s - self.meta['max_duration'], side='left')
+        upper = numpy.searchsorted(self.start, e, side='left')
+
+        indices = numpy.arange(lower, upper)
+        indices = indices[(self.end[lower:upper] > s) & (self.task_id[lower:upper] != NO_ID)]
+
+        if task is not None:
+            indices = indices[numpy.isin(self.task_id[indices], task)]
+        if category is not None:
+            indices = indices[numpy.isin(self.category_of(self.task_id[indices]), category)]
+        if timeflip is not None:
+            indices = indices[numpy.isin(self.timeflip_device_id[indices], timeflip)]
+
+        return indices
+
+    def category_of(self, task_ids: numpy.ndarray) -> numpy.ndarray:
+        """Get the category of each task (`NO_ID` for the ones that are not in `meta.json`)
+        """
+
+        known = (task_ids >= 0) & (task_ids < len(self.task_category))
+        return numpy.where(known, self.task_category[numpy.where(known, task_ids, 0)], NO_ID)
+
+    def discriminant(self, by: str, indices: numpy.ndarray) -> numpy.ndarray:
+        if by == 'task':
+            return self.task_id[indices]
+        elif by == 'category':
+            return self.category_of(self.task_id[indices])
+        elif by == 'timeflip':
+            return self.timeflip_device_id[indices]
+        else:
+            raise ValueError('unknown discriminant {}, expected one of {}'.format(by, ', '.join(self.DISCRIMINANTS)))
+
+    def cumulative(self, by: str = 'task', start: datetime = None, end: datetime = None, **kwargs) -> Dict[int, int]:
+        """Get the cumulative time (in seconds) of each task, category or device (`by`) within the time frame.
+        As in the statistics views, the duration of each element is truncated to the second.
+        """
+
+        indices = self.select(start, end, **kwargs)
+        s, e = self.time_frame(start, end)
+
+        durations = (numpy.minimum(self.end[indices], e) - numpy.maximum(self.start[indices], s)) // 1000000
+        keys, inverse = numpy.unique(self.discriminant(by, indices), return_inverse=True)
+
+        totals = numpy.zeros(len(keys), dtype='<i8')
+        numpy.add.at(totals, inverse.ravel(), durations)
+
+        return dict((int(k), int(t)) for k, t in zip(keys, totals))
+
+    def periodic(
+            self, period: int, start: datetime, end: datetime, by: str = 'task', **kwargs) -> List[Dict[int, int]]:
+        """Get, for each period of `period` seconds within `[start, end]` (period `i` starts at
+        `start + i * period`), the cumulative time (in seconds) of each task, category or device (`by`)
+        that has at least one element in it.
+
+        Durations are split between periods the same way as in the statistics views (with `PeriodicBuckets`).
+        """
+
+        indices = self.select(start, end, **kwargs)
+        s_frame, e_frame = self.time_frame(start, end)
+
+        span = e_frame - s_frame
+        size = period * 1000000
+        num_periods = -(-span // size)
+
+        s = self.start[indices] - s_frame
+        e = self.end[indices] - s_frame
+
+        first_period = numpy.maximum(0, s // size)
+        last_period = numpy.minimum(num_periods - 1, e // size)
+
+        s = numpy.maximum(0, s)
+        e = numpy.minimum(span, e)
+
+        keys, k = numpy.unique(self.discriminant(by, indices), return_inverse=True)
+        k = k.ravel()
+
+        partial = numpy.zeros((len(keys), num_periods), dtype='<i8')
+        full = numpy.zeros((len(keys), num_periods + 1), dtype='<i8')  # difference array
+        touched = numpy.zeros((len(keys), num_periods + 1), dtype='<i8')  # difference array
+
+        one = first_period == last_period
+        numpy.add.at(partial, (k[one], first_period[one]), (e[one] - s[one]) // 1000000)
+
+        many = ~one
+        numpy.add.at(
+            partial, (k[many], first_period[many]), ((first_period[many] + 1) * size - s[many]) // 1000000)
+        numpy.add.at(partial, (k[many], last_period[many]), (e[many] - last_period[many] * size) // 1000000)
+
+        spanning = last_period - first_period > 1
+        numpy.add.at(full, (k[spanning], first_period[spanning] + 1), period)
+        numpy.add.at(full, (k[spanning], last_period[spanning]), -period)
+
+        numpy.add.at(touched, (k, first_period), 1)
+        numpy.add.at(touched, (k, last_period + 1), -1)
+
+        durations = numpy.cumsum(full[:, :-1], axis=1) + partial
+        touched = numpy.cumsum(touched[:, :-1], axis=1) > 0
+
+        return [
+            dict((int(key), int(duration)) for key, duration, t in zip(keys, durations[:, i], touched[:, i]) if t)
+            for i in range(num_periods)
+        ]
+
+    def to_dict(self, i: int) -> Dict[str, Any]:
+        """Get element `i`, as a dictionary
+        """
+
+        return {
+            'id': int(self.id[i]),
+            'start': from_epoch(self.start[i]),
+            'end': from_epoch(self.end[i]),
+            'original_facet': int(self.original_facet[i]),
+            'task_id': None if self.task_id[i] == NO_ID else int(self.task_id[i]),
+            'timeflip_device_id': None if self.timeflip_device_id[i] == NO_ID else int(self.timeflip_device_id[i])
+        }
@@ -121,13 +121,18 @@ function apiCall(address, method='get', body= null) {
         params.body = JSON.stringify(body);
     }
 
-    return fetch(`/api/${address}`, params).then(function (response) {
-        if (!response.ok) {
-            throw new APICallError(response);
-        } else {
-            return response.json();
-        }
-    });
+    return fetch(`/api/${address}`, params).then(handleResponse);
+}
+
+function handleResponse(response) {
+    if (!response.ok) {
+        throw new APICallError(response);
+    } else if (response.status === 202) {
+        // operation on a device is still pending: poll it until it is done
+        return response.json().then((data) => fetch(`${data.url}?wait=10`).then(handleResponse));
+    } else {
+        return response.json();
+    }
 }
 
 function formatDuration(start, end) {
@@ -267,7 +272,7 @@ export class TFConnectController extends Controller {
 
     disconnectTF() {
         this.viewTarget.hidden = true;
-        apiCall('timeflips/daemon', 'delete').then(() => {
+        apiCall(`timeflips/daemon?timeflip=${this.idValue}`, 'delete').then(() => {
             this.listTF();
             this.clearInterval();
         });
@@ -444,31 +449,49 @@ export class GraphsController extends  Controller {
             query += `&task=${selected_tasks.join('&task=')}`;
 
         let period = Number(this.inputPeriodTarget.value);
-        this.makeCumulative(query);
-        this.makePerPeriod(query, period, ONE_HOUR);
-    }
 
-    makeCumulative(query) {
-        apiCall(`statistics/cumulative/tasks/?${query}`)
+        // a single request gives both the cumulative time and the time per period
+        apiCall(`statistics/pivot/?dimension=task&dimension=period&period=${period}&${query}`)
             .then((data) => {
-                this.totalTarget.innerText = `Total: ${formatDurationS(data.cumulative_time)}`;
-                this.cumulativeTarget.innerHTML = "";
-
+                let tasks = {};
                 data.tasks.forEach((task) => {
-                    let pc = (task.cumulative_time / data.cumulative_time * 100).toFixed(2);
-                    let $div = document.createElement('div');
-                    $div.classList.add('element');
-                    $div.style.width = `${pc}%`;
-                    $div.style.background = task.color;
-                    $div.title = `${task.name} (${formatDurationS(task.cumulative_time)} - ${pc}%)`;
-                    this.cumulativeTarget.append($div);
+                    tasks[task.id] = task;
                 });
+
+                this.makeCumulative(data, tasks);
+                this.makePerPeriod(data, tasks, period, ONE_HOUR);
             }).catch((err) => {
-                showToast(err.message);
+                if ('metadata' in err && err.metadata.status == 403) {
+                    showToast('Not allowed, since this would results in too many data!');
+                } else {
+                    showToast(err.message);
+                }
             });
     }
 
-    makePerPeriod(query, period, subperiod) {
+    makeCumulative(data, tasks) {
+        let cumulative_times = {};
+        data.cells.forEach((cell) => {
+            cumulative_times[cell.task] = (cumulative_times[cell.task] || 0) + cell.cumulative_time;
+        });
+
+        this.totalTarget.innerText = `Total: ${formatDurationS(data.cumulative_time)}`;
+        this.cumulativeTarget.innerHTML = "";
+
+        Object.keys(cumulative_times).forEach((task_id) => {
+            let task = tasks[task_id];
+            let cumulative_time = cumulative_times[task_id];
+            let pc = (cumulative_time / data.cumulative_time * 100).toFixed(2);
+            let $div = document.createElement('div');
+            $div.classList.add('element');
+            $div.style.width = `${pc}%`;
+            $div.style.background = task.color;
+            $div.title = `${task.name} (${formatDurationS(cumulative_time)} - ${pc}%)`;
+            this.cumulativeTarget.append($div);
+        });
+    }
+
+    makePerPeriod(data, tasks, period, subperiod) {
         let get_label = (date) => {
             let d = new Date(date);
             return `${(d.toLocaleTimeString())}`;
@@ -495,66 +518,50 @@ export class GraphsController extends  Controller {
             };
         }
 
-        apiCall(`statistics/periodic/${period}/tasks/?${query}`)
-            .then((data) => {
-                let labels = [];
-                let datasets = {};
-                let period_id = 0;
-
-                data.periods.forEach((period) => {
-                    labels.push(get_label(period.start));
-
-                    period.tasks.forEach((task) => {
-                        if(!(task.id in datasets)) {
-                            datasets[task.id] = {
-                                label: task.name,
-                                backgroundColor: task.color,
-                                data: Array(data.periods.length).fill(0)
-                            };
-                        }
-
-                        datasets[task.id].data[period_id] = task.cumulative_time / subperiod;
-                    });
+        let labels = data.periods.map((period) => get_label(period.start));
+        let datasets = {};
 
-                    period_id++;
-                });
+        data.cells.forEach((cell) => {
+            if(!(cell.task in datasets)) {
+                datasets[cell.task] = {
+                    label: tasks[cell.task].name,
+                    backgroundColor: tasks[cell.task].color,
+                    data: Array(data.periods.length).fill(0)
+                };
+            }
 
-                let $canvas = document.createElement('canvas');
-                this.perPeriodTarget.innerHTML = '';
-                this.perPeriodTarget.append($canvas);
-
-                new Chart($canvas, {
-                    type: 'bar',
-                    data: {
-                        labels: labels,
-                        datasets: Object.values(datasets)
-                    },
-                    options: {
-                        aspectRatio: 2.5,
-                        scales: {
-                          x: {
-                            stacked: true,
-                          },
-                          y: {
-                            stacked: true,
-                              title: {
-                                display: true,
-                                text: 'Number of hours'
-                              },
-                              ticks: {
-                                stepSize: 2
-                              }
-                          }
-                        }
-                    }
-                });
-            }).catch((err) => {
-                if ('metadata' in err && err.metadata.status == 403) {
-                    showToast('Not allowed, since this would results in too many data!');
-                } else {
-                    showToast(err.message);
+            datasets[cell.task].data[cell.period] = cell.cumulative_time / subperiod;
+        });
+
+        let $canvas = document.createElement('canvas');
+        this.perPeriodTarget.innerHTML = '';
+        this.perPeriodTarget.append($canvas);
+
+        new Chart($canvas, {
+            type: 'bar',
+            data: {
+                labels: labels,
+                datasets: Object.values(datasets)
+            },
+            options: {
+                aspectRatio: 2.5,
+                scales: {
+                  x: {
+                    stacked: true,
+                  },
+                  y: {
+                    stacked: true,
+                      title: {
+                        display: true,
+                        text: 'Number of hours'
+                      },
+                      ticks: {
+                        stepSize: 2
+                      }
+                  }
                 }
-            });
+            }
+        });
     }
 }
 
@@ -1183,7 +1190,7 @@ export class HistoryController extends Controller {
                        .then((data) => {
                            this.refresh();
                            modal.hide();
-                           showToast(`Updated ${checked.length} element${checked.length>1? 's': ''}`, 'bg-info');
+                           showToast(`Updated ${data.count} element${data.count>1? 's': ''}`, 'bg-info');
                        }).catch((error) => {
                            showModalMessage($modal, error.message);
                        });
@@ -1217,7 +1224,7 @@ export class HistoryController extends Controller {
                    .then((data) => {
                        this.refresh();
                        modal.hide();
-                       showToast(`Updated ${checked.length} element${checked.length>1? 's': ''}`, 'bg-info');
+                       showToast(`Updated ${data.count} element${data.count>1? 's': ''}`, 'bg-info');
                    }).catch((error) => {
                        showModalMessage($modal, error.message);
                    });
@@ -1243,7 +1250,7 @@ export class HistoryController extends Controller {
                        .then((data) => {
                            this.refresh();
                            modal.hide();
-                           showToast(`Delteted ${checked.length} element${checked.length>1? 's': ''}`, 'bg-info');
+                           showToast(`Deleted ${data.count} element${data.count>1? 's': ''}`, 'bg-info');
                        }).catch((error) => {
                            showModalMessage(modal._element, error.message);
                        });
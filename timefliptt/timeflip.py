@@ -1,187 +1,666 @@
 import asyncio.exceptions
+import concurrent.futures
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime
 from threading import Lock, Thread
-from bleak import BleakError
+from bleak import BleakScanner, BleakClient, BleakError
 
-from typing import Callable, Coroutine, Any
+from typing import Callable, Coroutine, Any, Dict, List, Optional, Tuple
 
-from pytimefliplib.async_client import AsyncClient, TimeFlipRuntimeError, NotConnectedError
+from pytimefliplib.async_client import AsyncClient, TimeFlipRuntimeError, NotConnectedError, CHARACTERISTICS
 
 
 class CoroutineError(Exception):
     pass
 
 
-_client: AsyncClient = None
+class DaemonStopped(Exception):
+    def __init__(self):
+        super().__init__('Daemon is currently stopped!')
+
+
+class OperationPending(Exception):
+    def __init__(self, operation: 'Operation'):
+        super().__init__('Operation {} is still pending'.format(operation.id))
+        self.operation = operation
+
+
+class FacetTracker:
+    """Current session of a device (its facet, and since when), kept up to date by the notifications of the device,
+    and the last segments that were completed (the most recent last).
+    Updated on the loop of the daemon, and read by the requests.
+    """
+
+    MAX_SEGMENTS = 256
+
+    def __init__(self):
+        self.facet: Optional[int] = None
+        self.start: Optional[datetime] = None
+        self.segments: 'deque[Tuple[int, datetime, datetime]]' = deque(maxlen=self.MAX_SEGMENTS)
+
+        self._lock = Lock()
+
+    def update(self, facet: int, date: datetime = None):
+        """The device is now on `facet` (since `date`, or now)
+        """
+
+        date = date or datetime.now()
+
+        with self._lock:
+            if facet == self.facet:
+                return
+
+            if self.facet is not None:
+                self.segments.append((self.facet, self.start, date))
+
+            self.facet = facet
+            self.start = date
+
+    def current(self) -> Tuple[Optional[int], Optional[datetime], List[Tuple[int, datetime, datetime]]]:
+        with self._lock:
+            return self.facet, self.start, list(self.segments)
+
+
+class PooledConnection:
+    """Connection to a device, in the pool of the daemon.
+
+    Operations on a device are serialized by its `lock` (which lives on the loop of the daemon), while operations on
+    different devices run concurrently. `client` is `None` until the first connection (or after a failure),
+    and the connection is `closed` when it is removed from the pool.
+    `calibration` is the one registered for the device (if known), which is required to synchronize its history.
+    `tracker` follows the facet of the device while it is connected (even across reconnections).
+    """
+
+    def __init__(self, address: str, password: str, calibration: int = None):
+        self.address = address
+        self.password = password
+        self.calibration = calibration
+
+        self.client: Optional[AsyncClient] = None
+        self.closed = False
+        self.tracker = FacetTracker()
+
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.client is not None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        # (created on the loop of the daemon, which is the only place where it is used)
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        return self._lock
+
+
+class Operation:
+    """Operation queued on the loop of the daemon (see `submit()`).
+
+    Its outcome is given by `result()`, which waits until a deadline (if any).
+    `then`, if any, is called (once) on the result of the coroutine by the first thread that gets it
+    (e.g., to store it in the database, with the context of the request), and gives the actual result.
+    """
+
+    def __init__(self, address: Optional[str], name: str, then: Callable[[Any], Any] = None):
+        self.id = uuid.uuid4().hex
+        self.address = address
+        self.name = name
+        self.date_submitted = datetime.now()
+
+        self.future: Optional[concurrent.futures.Future] = None
+        self.then = then
+
+        self._lock = Lock()
+        self._outcome = None  # (value, exception)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def result(self, timeout: float = None) -> Any:
+        """Get the result, waiting at most `timeout` seconds (forever if `None`).
+        Raises `OperationPending` if the operation is not done by then, or the exception raised by the operation.
+        """
+
+        concurrent.futures.wait([self.future], timeout)
+        if not self.future.done():
+            raise OperationPending(self)
+
+        with self._lock:
+            if self._outcome is None:
+                try:
+                    value = self.future.result()
+                    self._outcome = (self.then(value) if self.then is not None else value, None)
+                except Exception as e:
+                    self._outcome = (None, e)
+
+        value, exception = self._outcome
+        if exception is not None:
+            raise exception
+
+        return value
+
+    def to_dict(self) -> dict:
+        if not self.future.done():
+            status = 'pending'
+        elif self.future.cancelled() or self.future.exception() is not None:
+            status = 'failed'
+        else:
+            status = 'done'
+
+        return {
+            'id': self.id,
+            'address': self.address,
+            'name': self.name,
+            'date_submitted': self.date_submitted.isoformat(),
+            'status': status
+        }
+
+
+MAX_CONNECTIONS = 4  # default number of concurrent BLE links
+MAX_OPERATIONS = 256  # number of operations that are kept (the oldest finished ones are forgotten)
+OPERATION_TIMEOUT = 60  # seconds, after which a coroutine is cancelled
+
+History = List[Tuple[int, int, bytearray]]  # (facet, duration, _) for each element, the most recent last
+
 _loop: asyncio.AbstractEventLoop = None
 _thread: Thread = None
-_lock = Lock()
+_lock = Lock()  # protects the pool and the operations (not the BLE operations)
 
-_timeflip_address = ''
-_timeflip_password = ''
+_pool: 'OrderedDict[str, PooledConnection]' = OrderedDict()  # by address, the least recently used first
+_max_connections = MAX_CONNECTIONS
 
+_operations: 'OrderedDict[str, Operation]' = OrderedDict()  # by id, the oldest first
 
-class DaemonStopped(Exception):
-    def __init__(self):
-        super().__init__('Daemon is currently stopped!')
+_sync: Optional[concurrent.futures.Future] = None
+
+DISCOVERY_TTL = 60  # seconds during which a discovery (and whether a device is a TimeFlip) is reused
+DISCOVERY_CONCURRENCY = 4  # number of devices that are probed at the same time
+DISCOVERY_TIMEOUT = 5  # seconds, after which a device is not considered to be a TimeFlip
+
+_discovery: Optional[concurrent.futures.Future] = None
+_discovery_date = .0  # (monotonic) when the last discovery ended
+_probed: Dict[str, Tuple[float, bool]] = {}  # by address, when it was probed and whether it is a TimeFlip
 
 
-def daemon_start():
-    """Setup and start daemon
+def daemon_start(max_connections: int = MAX_CONNECTIONS):
+    """Setup and start daemon, which keeps at most `max_connections` devices connected
     """
 
-    global _loop, _thread
+    global _loop, _thread, _max_connections
 
     def _start_loop(loop):
         asyncio.set_event_loop(loop)
         loop.run_forever()
 
+    _max_connections = max(1, max_connections)
+
     _loop = asyncio.new_event_loop()
     _thread = Thread(target=_start_loop, args=(_loop,), daemon=True)
     _thread.start()
 
 
-def daemon_stop():
-    global _thread, _loop, _lock
+def daemon_stop(timeout: float = 10):
+    """Disconnect from every device (waiting at most `timeout` seconds for each of them), then stop the daemon
+    """
 
-    hard_logout()
+    global _thread, _loop, _lock, _discovery
+
+    sync_stop()
+
+    try:
+        operations = hard_logout()
+    except DaemonStopped:
+        return
+
+    for operation in operations:
+        try:
+            operation.result(timeout)
+        except (OperationPending, TimeFlipRuntimeError, BleakError):
+            pass
 
     with _lock:
-        if _loop is not None:
-            _loop.call_soon_threadsafe(_loop.stop)
-            _thread.join()
-            _loop = None
-            _thread = None
+        loop, thread = _loop, _thread
+        if loop is None:
+            return
+
+        # nothing can be submitted anymore
+        _loop = None
+        _thread = None
+        _operations.clear()
+        _probed.clear()
+        _discovery = None
 
+    # (without `_lock`, which the coroutines of the loop may need to finish)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
 
-def daemon_status():
-    global _loop, _lock, _timeflip_address
+
+def daemon_status() -> dict:
+    """Get the status of the daemon, and of each connection (the most recently used last).
+    `address` is the one of the most recently used connection, if any.
+    """
+
+    global _loop, _lock, _pool
 
     with _lock:
         if _loop is None:
             return {'daemon_status': 'stopped'}
-        elif _timeflip_address == '':
-            return {'daemon_status': 'disconnected'}
+        elif len(_pool) == 0:
+            return {'daemon_status': 'disconnected', 'connections': []}
         else:
-            return {'daemon_status': 'connected', 'address': _timeflip_address}
+            return {
+                'daemon_status': 'connected',
+                'address': next(reversed(_pool)),
+                'connections': [{'address': c.address, 'connected': c.connected} for c in _pool.values()]
+            }
 
 
-def soft_connect(address: str, password: str):
-    """Setup everything so that it will connect at next request
+def _get_connection(address: str) -> PooledConnection:
+    """Get the connection to `address` (if any), and mark it as the most recently used
     """
 
-    global _lock, _timeflip_address, _timeflip_password, _loop
+    global _lock, _loop, _pool
 
     with _lock:
         if _loop is None:
             raise DaemonStopped()
 
-        _timeflip_address = address
-        _timeflip_password = password
+        if address not in _pool:
+            raise NotConnectedError()
 
+        _pool.move_to_end(address)
+        return _pool[address]
 
-def hard_connect(address: str, password: str) -> bool:
-    """Force a connexion
+
+def _register(operation: Operation):
+    """Keep `operation`, and forget the oldest finished ones (with the lock held)
     """
 
-    global _lock, _client, _loop
+    _operations[operation.id] = operation
 
-    soft_connect(address, password)
-    return _connect()
+    if len(_operations) > MAX_OPERATIONS:
+        for operation_id in [i for i, o in _operations.items() if o.done()][:len(_operations) - MAX_OPERATIONS]:
+            del _operations[operation_id]
 
 
-def _connect() -> bool:
+def _submit(address: str, name: str, body: Callable[[], Coroutine], then: Callable[[Any], Any] = None) -> Operation:
+    """Queue `body()` on the loop, as an operation
+    """
 
-    global _lock, _loop, _client, _timeflip_address, _timeflip_password
+    global _lock, _loop
 
-    async def _connect_and_setup(client: AsyncClient, passwd: str):
-        await client.connect()
-        await client.setup(password=passwd)
+    operation = Operation(address, name, then)
 
     with _lock:
         if _loop is None:
             raise DaemonStopped()
 
-        if _timeflip_address != '' and _timeflip_password != '':
-            _client = AsyncClient(_timeflip_address)
-            _run_coro(_connect_and_setup, passwd=_timeflip_password)
-            return True
+        operation.future = asyncio.run_coroutine_threadsafe(body(), _loop)
+        _register(operation)
 
-    return False
+    return operation
 
 
-def connected_to(address: str) -> bool:
-    global _lock, _loop, _timeflip_address
+def get_operation(operation_id: str) -> Optional[Operation]:
+    global _lock, _operations
+
+    with _lock:
+        return _operations.get(operation_id, None)
+
+
+def soft_connect(address: str, password: str, calibration: int = None):
+    """Setup everything so that it will connect to `address` at next request.
+    If the pool is full, the least recently used connection is closed (in the background).
+    The `calibration` registered for the device is kept if not given.
+    """
+
+    global _lock, _loop, _pool, _max_connections
+
+    evicted: List[PooledConnection] = []
 
     with _lock:
         if _loop is None:
             raise DaemonStopped()
 
-        return address == _timeflip_address
+        if address in _pool:
+            _pool[address].password = password
+            if calibration is not None:
+                _pool[address].calibration = calibration
+            _pool.move_to_end(address)
+        else:
+            _pool[address] = PooledConnection(address, password, calibration)
 
+            while len(_pool) > _max_connections:
+                evicted.append(_pool.popitem(last=False)[1])
 
-def try_reconnect() -> bool:
-    """Attempt reconnect, if allowed"""
+    for connection in evicted:
+        _submit(connection.address, 'disconnect', lambda c=connection: _close(c))
+
+
+def hard_connect(address: str, password: str, calibration: int = None) -> Operation:
+    """Force a connexion to `address`. The operation gives whether the connection was made
+    """
 
-    return _connect()
+    soft_connect(address, password, calibration)
+    return _submit(address, 'connect', lambda: _reconnect(address))
 
 
-def hard_logout():
-    """Force logout
+async def _connect(connection: PooledConnection) -> bool:
+    """(Re)connect, with the lock of `connection` held
     """
 
-    global _lock, _client, _loop, _timeflip_address, _timeflip_password
+    if connection.closed:
+        raise NotConnectedError()
+
+    if connection.password != '':
+        client = AsyncClient(connection.address)
+        await client.connect()
+        await client.setup(
+            password=connection.password, facet_callback=lambda address, facet: connection.tracker.update(facet))
+
+        connection.client = client
+        connection.tracker.update(client.current_facet_value)
+        return True
+
+    return False
+
+
+async def _reconnect(address: str) -> bool:
+    connection = _get_connection(address)
 
-    async def _disconnect(client: AsyncClient):
+    async with connection.lock:
         try:
-            await client.disconnect()
-        except NotConnectedError:
-            pass  # oh ... well ;)
+            return await asyncio.wait_for(_connect(connection), OPERATION_TIMEOUT)
+        except asyncio.exceptions.TimeoutError as e:
+            raise TimeFlipRuntimeError(e)
+
+
+def connected_to(address: str) -> bool:
+    global _lock, _loop, _pool
+
+    with _lock:
+        if _loop is None:
+            raise DaemonStopped()
+
+        return address in _pool
+
+
+def current_session(address: str) -> Tuple[Optional[int], Optional[datetime], List[Tuple[int, datetime, datetime]]]:
+    """Get the current facet of the device (`None` if it was never connected) and since when,
+    as well as the last completed segments (facet, start, end), without communicating with the device
+    """
+
+    global _lock, _loop, _pool
 
     with _lock:
         if _loop is None:
             raise DaemonStopped()
 
-        _timeflip_address = ''
-        _timeflip_password = ''
+        if address not in _pool:
+            raise NotConnectedError()
+
+        connection = _pool[address]
+
+    return connection.tracker.current()
+
+
+def try_reconnect(address: str) -> bool:
+    """Attempt reconnect, if allowed"""
 
-        if _client is not None:
-            _run_coro(_disconnect)
-            _client = None
+    return _submit(address, 'connect', lambda: _reconnect(address)).result()
 
 
-def _run_coro(coro: Callable[[AsyncClient, Any], Coroutine], **kwargs) -> Any:
-    """Actually run the corountine (without any check!!)
+async def _close(connection: PooledConnection):
+    """Disconnect (once the operation in progress on the device, if any, is done)
     """
 
-    global _client, _loop
+    async with connection.lock:
+        connection.closed = True
 
-    try:
-        task = asyncio.run_coroutine_threadsafe(coro(_client, **kwargs), _loop)
-        return task.result()
-    except asyncio.exceptions.TimeoutError as e:
-        raise TimeFlipRuntimeError(e)
+        if connection.client is not None:
+            try:
+                await asyncio.wait_for(connection.client.disconnect(), OPERATION_TIMEOUT)
+            except (NotConnectedError, BleakError, asyncio.exceptions.TimeoutError):
+                pass  # oh ... well ;)
 
+            connection.client = None
 
-def run_coro(coro: Callable[[AsyncClient, Any], Coroutine], retry: int = 1, **kwargs) -> Any:
-    global _lock, _loop, _client, _timeflip_address
 
-    attempts = retry + 1
+def hard_logout(address: str = None) -> List[Operation]:
+    """Force logout from `address`, or from every device if `None`.
+    Devices are disconnected in the background, as the returned operations.
+    """
 
-    for attempt in range(attempts):
-        try:
-            with _lock:
-                if _loop is None:
-                    raise DaemonStopped()
+    global _lock, _loop, _pool
 
-                if _client is None:
+    with _lock:
+        if _loop is None:
+            raise DaemonStopped()
+
+        if address is None:
+            closed = list(_pool.values())
+            _pool.clear()
+        else:
+            closed = [_pool.pop(address)] if address in _pool else []
+
+    return [_submit(c.address, 'disconnect', lambda c=c: _close(c)) for c in closed]
+
+
+async def _execute(
+        address: str,
+        coro: Callable[[AsyncClient, Any], Coroutine],
+        retry: int,
+        timeout: float,
+        after: Optional[Operation],
+        kwargs: dict
+) -> Any:
+    if after is not None:
+        await asyncio.wrap_future(after.future)
+
+    for attempt in range(retry + 1):
+        connection = _get_connection(address)
+
+        async with connection.lock:
+            try:
+                if connection.closed or connection.client is None:
                     raise NotConnectedError()
 
-                return _run_coro(coro, **kwargs)
-        except (NotConnectedError, BleakError) as e:
-            if attempt < retry:
-                try_reconnect()
-            else:
-                if type(e) is BleakError:
+                return await asyncio.wait_for(coro(connection.client, **kwargs), timeout)
+            except asyncio.exceptions.TimeoutError as e:
+                raise TimeFlipRuntimeError(e)
+            except (NotConnectedError, BleakError) as e:
+                if attempt < retry:
+                    try:
+                        await asyncio.wait_for(_connect(connection), timeout)
+                    except (NotConnectedError, BleakError, TimeFlipRuntimeError, asyncio.exceptions.TimeoutError):
+                        pass  # next attempt will fail as well
+                elif type(e) is BleakError:
                     raise TimeFlipRuntimeError(e)
                 else:
                     raise e
+
+
+def submit(
+        address: str,
+        coro: Callable[[AsyncClient, Any], Coroutine],
+        retry: int = 1,
+        timeout: float = OPERATION_TIMEOUT,
+        after: Operation = None,
+        then: Callable[[Any], Any] = None,
+        **kwargs
+) -> Operation:
+    """Queue `coro(client, **kwargs)` on the loop of the daemon, with the client connected to `address`
+    ((re)connecting up to `retry` times if needed), and return the operation without waiting.
+
+    The coroutine is cancelled after `timeout` seconds. If `after` is given, the operation waits for it first
+    (and fails if it does). See `Operation` for `then`.
+    """
+
+    return _submit(address, coro.__name__, lambda: _execute(address, coro, retry, timeout, after, kwargs), then)
+
+
+def run_coro(address: str, coro: Callable[[AsyncClient, Any], Coroutine], retry: int = 1, **kwargs) -> Any:
+    """Run `coro(client, **kwargs)` with the client connected to `address`, and wait for the result
+    """
+
+    return submit(address, coro, retry, **kwargs).result()
+
+
+async def calibrated_history(client: AsyncClient, calibration: int) -> Tuple[int, Optional[History], datetime]:
+    """Get (and delete) the history, only if the calibration of the device matches `calibration`.
+    Gives the calibration of the device, the history (`None` if the calibration does not match),
+    and the date at which the history ends.
+    """
+
+    device_calibration = await client.calibration_version()
+    if device_calibration != calibration:
+        return device_calibration, None, datetime.now()
+
+    history = await client.history()
+    await client.history_delete()
+
+    return device_calibration, history, datetime.now()
+
+
+async def stored_history(
+        client: AsyncClient, calibration: int, store: Callable[[History, datetime], Any]) -> Tuple[int, Any]:
+    """Same as `calibrated_history()`, but the history is given to `store(history, end_date)` before the operation
+    completes (in another thread, since it may block), so that it is not lost even if the result of the operation
+    is never fetched.
+    Gives the calibration of the device, and the result of `store()` (`None` if the calibration does not match).
+    """
+
+    device_calibration, history, end_date = await calibrated_history(client, calibration)
+    if history is None:
+        return device_calibration, None
+
+    return device_calibration, await asyncio.get_running_loop().run_in_executor(None, store, history, end_date)
+
+
+async def _sync_history(connection: PooledConnection, handler: Callable[[str, History, datetime], None]):
+    async with connection.lock:
+        if connection.closed or connection.client is None or connection.calibration is None:
+            return
+
+        try:
+            calibration, history, end_date = await asyncio.wait_for(
+                calibrated_history(connection.client, connection.calibration), OPERATION_TIMEOUT)
+        except (NotConnectedError, BleakError, TimeFlipRuntimeError, asyncio.exceptions.TimeoutError):
+            return  # try again at next round
+
+    if history is not None and len(history) > 0:
+        handler(connection.address, history, end_date)
+
+
+async def _sync_periodically(interval: float, handler: Callable[[str, History, datetime], None]):
+    while True:
+        await asyncio.sleep(interval)
+
+        with _lock:
+            connections = list(_pool.values())
+
+        await asyncio.gather(*(_sync_history(c, handler) for c in connections))
+
+
+def sync_start(interval: float, handler: Callable[[str, History, datetime], None]):
+    """Every `interval` seconds, pull the history of the connected devices (if their calibration matches the one
+    that is registered), and give it to `handler(address, history, end_date)`.
+    The handler is called on the loop of the daemon, so it should not block (e.g., queue the history).
+    """
+
+    global _lock, _loop, _sync
+
+    with _lock:
+        if _loop is None:
+            raise DaemonStopped()
+
+        if _sync is not None:
+            _sync.cancel()
+
+        _sync = asyncio.run_coroutine_threadsafe(_sync_periodically(interval, handler), _loop)
+
+
+def sync_stop():
+    global _lock, _sync
+
+    with _lock:
+        if _sync is not None:
+            _sync.cancel()
+            _sync = None
+
+
+async def _is_timeflip(device: Any) -> bool:
+    try:
+        async with BleakClient(device) as client:
+            await client.read_gatt_char(CHARACTERISTICS['facet'])
+            return True
+    except (BleakError, asyncio.exceptions.TimeoutError):
+        return False
+
+
+async def _probe(device: Any, semaphore: asyncio.Semaphore, timeout: float) -> bool:
+    async with semaphore:
+        try:
+            return await asyncio.wait_for(_is_timeflip(device), timeout)
+        except asyncio.exceptions.TimeoutError:
+            return False
+
+
+async def _discover(ttl: float, concurrency: int, timeout: float) -> List[Tuple[str, str]]:
+    global _lock, _probed, _discovery_date
+
+    devices = await BleakScanner.discover()
+
+    # probe the devices that were not probed recently, a few at a time
+    now = time.monotonic()
+    with _lock:
+        known = dict((a, p[1]) for a, p in _probed.items() if now - p[0] < ttl)
+
+    unknown = [d for d in devices if d.address not in known]
+    semaphore = asyncio.Semaphore(concurrency)
+    probes = await asyncio.gather(*(_probe(d, semaphore, timeout) for d in unknown))
+
+    with _lock:
+        for device, is_timeflip in zip(unknown, probes):
+            known[device.address] = is_timeflip
+            _probed[device.address] = (now, is_timeflip)
+
+        _discovery_date = time.monotonic()
+
+    return [(d.address, d.name) for d in devices if known[d.address]]
+
+
+def discover(
+        ttl: float = DISCOVERY_TTL,
+        concurrency: int = DISCOVERY_CONCURRENCY,
+        timeout: float = DISCOVERY_TIMEOUT,
+        then: Callable[[Any], Any] = None
+) -> Operation:
+    """Discover the TimeFlip devices around, as an operation which gives their address and name.
+
+    The devices found by the scan are probed concurrently (at most `concurrency` at the same time, for at most
+    `timeout` seconds each), and whether a device is a TimeFlip is remembered for `ttl` seconds.
+    A discovery that ended less than `ttl` seconds ago (or that is in progress) is reused.
+    """
+
+    global _lock, _loop, _discovery
+
+    with _lock:
+        if _loop is None:
+            raise DaemonStopped()
+
+        expired = _discovery is None or (_discovery.done() and (
+            _discovery.cancelled() or _discovery.exception() is not None or time.monotonic() - _discovery_date >= ttl))
+
+        if expired:
+            _discovery = asyncio.run_coroutine_threadsafe(_discover(ttl, concurrency, timeout), _loop)
+
+        operation = Operation(None, 'discover', then)
+        operation.future = _discovery
+        _register(operation)
+
+    return operation